@@ -0,0 +1,110 @@
+"""
+In-process stand-in for the Telegram Bot API, plugged into an Application as its `request`.
+
+Every call is answered locally with a well-formed result, optionally after a delay, and
+every message the bot sends or edits is passed to `on_message`, so a load test can tell
+when the bot has answered a simulated user. File downloads return photos from imgs/.
+"""
+import os
+import json
+import time
+import asyncio
+import itertools
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+IMAGES_DIR = os.path.join(ROOT_DIR, "imgs")
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "Load test bot", "username": "load_test_bot"}
+
+# (chat_id, method, text) of a message sent or edited by the bot
+MessageListener = Callable[[int, str, str], None]
+
+
+def load_photos(count: int = 3) -> List[bytes]:
+    names = sorted(name for name in os.listdir(IMAGES_DIR) if name.lower().endswith((".jpg", ".jpeg", ".png")))
+    photos = []
+    for name in names[:count]:
+        with open(os.path.join(IMAGES_DIR, name), "rb") as file:
+            photos.append(file.read())
+    return photos
+
+
+class FakeBotApi(BaseRequest):
+    """
+    Answers Bot API calls without any network.
+    `latency_ms` is added to every call, like the round trip to api.telegram.org.
+    """
+
+    def __init__(self, on_message: Optional[MessageListener] = None, latency_ms: float = 0, photos: int = 3):
+        self.on_message = on_message
+        self.latency_ms = latency_ms
+        self.calls: Dict[str, int] = {}
+        self._photos = load_photos(photos)
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, chat_id, **fields) -> Dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    def _result(self, method: str, parameters: Dict):
+        chat_id = parameters.get("chat_id", 0)
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            text = parameters.get("text", "")
+            if self.on_message is not None:
+                self.on_message(int(chat_id), method, text)
+            return self._message(chat_id, text=text)
+        if method == "sendMediaGroup":
+            media = parameters.get("media", [])
+            if isinstance(media, str):
+                media = json.loads(media)
+            return [
+                self._message(chat_id, photo=[{"file_id": item["media"], "file_unique_id": item["media"], "width": 1280, "height": 960}])
+                for item in media
+            ]
+        if method == "getFile":
+            file_id = parameters["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": 1, "file_path": f"photos/{file_id}.jpg"}
+        # setMyCommands, deleteWebhook, sendChatAction and the like
+        return True
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ) -> Tuple[int, bytes]:
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        if "/file/bot" in url:
+            # A photo download, the same few photos are served for every file id
+            self.calls["download"] = self.calls.get("download", 0) + 1
+            return 200, self._photos[hash(url) % len(self._photos)]
+
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        parameters = request_data.parameters if request_data is not None else {}
+        body = {"ok": True, "result": self._result(api_method, parameters)}
+        return 200, json.dumps(body, ensure_ascii=False).encode("utf-8")
@@ -0,0 +1,398 @@
+"""
+Load test of both bots: simulated users walk the whole conversation at the same time.
+
+Updates are put straight into the Application's update queue, the way polling and the
+webhook deliver them, so they go through the real handlers, persistence and queues.
+Bot API calls are answered by FakeBotApi and 2GIS/OpenAI by the stand-ins of the replay
+benchmark, each with configurable latency.
+
+For every level of concurrent users the report has updates/s, completed conversations,
+reply latency per conversation step (from the update to the bot's answer, queueing
+included), event-loop lag and RSS growth. Each bot and level runs in a fresh process.
+
+    python benchmarks/load_test.py --bot both --users 10,100,1000
+    python benchmarks/load_test.py --bot telegram_bot --users 100 --telegram-latency-ms 60 --openai-latency-ms 3000
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import asyncio
+import argparse
+import itertools
+import subprocess
+import tempfile
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BOTS = ("telegram_bot", "desc_gen_bot")
+BOT_TOKEN = "100000:load-test"
+FIRST_USER_ID = 1_000_000
+LAG_SAMPLE_INTERVAL_SECONDS = 0.05
+
+from fake_bot_api import FakeBotApi
+from stand_ins import FaultInjection, StandInServer
+
+
+class Step(NamedTuple):
+    """One user turn: the updates the user sends and how to recognise the bot's answer."""
+    name: str
+    # (factory, user_id, listing) -> update dicts, none for a step that only waits for the bot
+    updates: Callable[["UpdateFactory", int, Dict[str, str]], List[Dict]]
+    reply_prefix: tuple
+
+
+class UpdateFactory:
+    def __init__(self, photos: int):
+        self.photos = photos
+        self._ids = itertools.count(1)
+
+    def _message(self, user_id: int, **fields) -> Dict:
+        update_id = next(self._ids)
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                **fields,
+            },
+        }
+
+    def text(self, user_id: int, text: str) -> List[Dict]:
+        return [self._message(user_id, text=text)]
+
+    def album(self, user_id: int) -> List[Dict]:
+        album_id = f"album-{user_id}-{next(self._ids)}"
+        return [
+            self._message(
+                user_id,
+                media_group_id=album_id,
+                photo=[{"file_id": f"{album_id}-{i}", "file_unique_id": f"{album_id}-{i}", "width": 1280, "height": 960}],
+            )
+            for i in range(self.photos)
+        ]
+
+
+# bot/telegram_bot.py: ConversationHandler, the description is generated by a queue worker
+TELEGRAM_BOT_STEPS = [
+    Step("start", lambda f, user, listing: f.text(user, "Начать создание описания"), ("Отлично! Давайте начнем",)),
+    Step("photos", lambda f, user, listing: f.album(user), ("Фотографий добавлено",)),
+    Step("photos_done", lambda f, user, listing: f.text(user, "Шаг завершен, перейти к следующему"), ("Отлично! Теперь",)),
+    Step("address", lambda f, user, listing: f.text(user, listing["address"]), ("Адрес сохранен",)),
+    Step("user_prompt", lambda f, user, listing: f.text(user, listing["user_prompt"]), ("Спасибо! Я собрал",)),
+    Step("generation", lambda f, user, listing: [], ("🎉 Ваше описание готово", "Произошла ошибка")),
+]
+
+# desc_gen_bot/main.py: process_input with the steps of UserSteps
+DESC_GEN_BOT_STEPS = [
+    Step("address", lambda f, user, listing: f.text(user, listing["address"]), ("Спасибо за адрес",)),
+    Step("photos", lambda f, user, listing: f.album(user), ("Спасибо за фотографии",)),
+    Step("flat_description", lambda f, user, listing: f.text(user, listing["user_prompt"]), ("Спасибо за данные о квартире",)),
+    Step("options", lambda f, user, listing: f.text(user, "Монолитный дом 2015 года, консьерж"), ("Спасибо за данные о доме",)),
+    # The description is followed by a hint, the step ends there
+    Step("deal_details", lambda f, user, listing: f.text(user, "Свободная продажа, один собственник"), ("Чтобы попробовать снова",)),
+]
+
+
+class Inbox:
+    """Messages the bot sent to each chat, and the simulated users waiting for them."""
+
+    def __init__(self):
+        self.messages: Dict[int, List[str]] = {}
+        self._waiters: Dict[int, list] = {}
+
+    def deliver(self, chat_id: int, method: str, text: str) -> None:
+        if method != "sendMessage":
+            return # Edits of a streamed description are not answers
+        messages = self.messages.setdefault(chat_id, [])
+        messages.append(text[:64])
+        for waiter in list(self._waiters.get(chat_id, ())):
+            prefixes, future = waiter
+            if text.startswith(prefixes) and not future.done():
+                future.set_result(len(messages))
+                self._waiters[chat_id].remove(waiter)
+
+    def expect(self, chat_id: int, prefixes: tuple, since: int) -> asyncio.Future:
+        """Resolves with the new cursor once a message starting with one of `prefixes` arrives after `since`."""
+        future = asyncio.get_running_loop().create_future()
+        messages = self.messages.get(chat_id, [])
+        for index in range(since, len(messages)):
+            if messages[index].startswith(prefixes):
+                future.set_result(index + 1)
+                return future
+        self._waiters.setdefault(chat_id, []).append((prefixes, future))
+        return future
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task that sleeps for a fixed interval."""
+
+    def __init__(self, interval: float = LAG_SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - started - self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+def rss_megabytes() -> float:
+    """Resident set size of the process."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        # Not Linux: the peak is the closest there is
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def configure_environment(stand_in: StandInServer) -> None:
+    """Points the bots' clients at the stand-ins. Must run before the bot modules are imported."""
+    os.environ.update({
+        "OPENAI_API_KEY": "load-test",
+        "TWOGIS_API_KEY": "load-test",
+        "OPENAI_BASE_URL": stand_in.openai_base_url,
+        "TWOGIS_CATALOG_URL": stand_in.catalog_url,
+        "TWOGIS_ROUTING_URL": stand_in.routing_url,
+        "STATE_BACKEND": "memory",
+        "USER_STEPS_DB_PATH": "",
+    })
+    for path in ("bot", "desc_gen_bot"):
+        sys.path.append(os.path.join(ROOT_DIR, path))
+
+
+def build_application(bot: str, transport: FakeBotApi):
+    if bot == "telegram_bot":
+        import telegram_bot
+        from clients.openai_client import OpenAIClient
+        from clients.two_gis_client import AsyncTwoGisClient
+        from clients.geocode_cache import GeocodeCache
+        from clients.places_cache import PlacesCache
+        from clients.description_cache import DescriptionCache
+
+        # The same clients as telegram_bot.main(), the URLs come from the environment
+        openai_client = OpenAIClient(api_key="load-test", description_cache=DescriptionCache())
+        two_gis_client = AsyncTwoGisClient(api_key="load-test", geocode_cache=GeocodeCache(), places_cache=PlacesCache())
+        return telegram_bot.build_application(BOT_TOKEN, openai_client, two_gis_client, request=transport)
+    import main
+    return main.build_application(BOT_TOKEN, request=transport)
+
+
+async def run_user(application, inbox: Inbox, factory: UpdateFactory, steps: List[Step], user_id: int,
+                   listing: Dict[str, str], latencies: Dict[str, List[float]], counters: Dict[str, int], args) -> None:
+    """Walks one conversation, waiting for the bot's answer after every step."""
+    from telegram import Update
+
+    await asyncio.sleep(args.ramp_up * (user_id - FIRST_USER_ID) / args.users)
+    cursor = 0
+    for step in steps:
+        reply = inbox.expect(user_id, step.reply_prefix, cursor)
+        started = time.perf_counter()
+        for data in step.updates(factory, user_id, listing):
+            # The same path as a polled update or the JSON body of a webhook call
+            await application.update_queue.put(Update.de_json(data, application.bot))
+            counters["updates"] += 1
+        cursor = await asyncio.wait_for(reply, args.step_timeout)
+        latencies.setdefault(step.name, []).append(time.perf_counter() - started)
+        await asyncio.sleep(args.think_ms / 1000)
+
+
+async def run_level(args) -> Dict:
+    """Runs `args.users` conversations against one bot. Expects configure_environment() to have run."""
+    # Imports the clients, which take their URLs from the environment
+    from replay_benchmark import load_listings, percentile
+
+    def latency_summary(samples: List[float]) -> Dict[str, float]:
+        samples_ms = [sample * 1000 for sample in samples]
+        return {
+            "count": len(samples_ms),
+            "p50_ms": round(percentile(samples_ms, 50), 1),
+            "p95_ms": round(percentile(samples_ms, 95), 1),
+            "p99_ms": round(percentile(samples_ms, 99), 1),
+            "max_ms": round(max(samples_ms, default=0), 1),
+        }
+
+    inbox = Inbox()
+    transport = FakeBotApi(inbox.deliver, latency_ms=args.telegram_latency_ms, photos=args.photos)
+    application = build_application(args.bot, transport)
+    # The bot modules configure INFO logging when imported
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    steps = TELEGRAM_BOT_STEPS if args.bot == "telegram_bot" else DESC_GEN_BOT_STEPS
+    factory = UpdateFactory(args.photos)
+    listings = load_listings(args.users)
+    latencies: Dict[str, List[float]] = {}
+    counters = {"updates": 0}
+
+    # The same sequence as run_polling(), without fetching updates
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    monitor = LoopLagMonitor()
+    rss_before = rss_megabytes()
+    monitor.start()
+    started = time.perf_counter()
+    users = [
+        asyncio.create_task(run_user(
+            application, inbox, factory, steps, FIRST_USER_ID + i,
+            # Distinct addresses, so the geocode and places caches don't answer everything
+            {**listings[i], "address": f"{listings[i]['address']}, кв. {i + 1}"},
+            latencies, counters, args,
+        ))
+        for i in range(args.users)
+    ]
+    done, pending = await asyncio.wait(users, timeout=args.timeout)
+    elapsed = time.perf_counter() - started
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    await monitor.stop()
+    rss_after = rss_megabytes()
+
+    # Updates still queued after a timeout would otherwise all be handled during the shutdown
+    while not application.update_queue.empty():
+        application.update_queue.get_nowait()
+        application.update_queue.task_done()
+    await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+    failed = sum(1 for task in done if task.exception() is not None)
+    lag_ms = [sample * 1000 for sample in monitor.samples]
+    return {
+        "bot": args.bot,
+        "users": args.users,
+        "completed": len(done) - failed,
+        "failed": failed,
+        "timed_out": len(pending),
+        "wall_seconds": round(elapsed, 2),
+        "updates": counters["updates"],
+        "updates_per_second": round(counters["updates"] / elapsed, 1),
+        "steps": {step.name: latency_summary(latencies.get(step.name, [])) for step in steps},
+        "loop_lag_ms": {
+            "p50": round(percentile(lag_ms, 50), 1),
+            "p99": round(percentile(lag_ms, 99), 1),
+            "max": round(max(lag_ms, default=0), 1),
+        },
+        "rss_mb": {"before": round(rss_before, 1), "after": round(rss_after, 1), "growth": round(rss_after - rss_before, 1)},
+        "bot_api_calls": dict(sorted(transport.calls.items())),
+    }
+
+
+def run_single(args) -> Dict:
+    """One bot at one level, in this process."""
+    stand_in_faults = FaultInjection(args.latency_ms, args.jitter_ms, args.error_rate)
+    openai_faults = FaultInjection(args.openai_latency_ms, args.jitter_ms, args.openai_error_rate, error_status=500)
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch_dir, StandInServer(
+        default_faults=stand_in_faults, faults={"openai": openai_faults}, seed=args.seed
+    ) as stand_in:
+        # The bots keep their caches, queues and databases in relative paths, they go to the scratch dir
+        shutil.copy(os.path.join(ROOT_DIR, "prompt.txt"), scratch_dir)
+        os.chdir(scratch_dir)
+        try:
+            configure_environment(stand_in)
+            result = asyncio.run(run_level(args))
+        finally:
+            os.chdir(working_dir)
+        result["stand_in_requests"] = {endpoint: stats["requests"] for endpoint, stats in stand_in.stats_snapshot().items()}
+    return result
+
+
+def print_report(results: List[Dict]) -> None:
+    for result in results:
+        print(
+            f"\n{result['bot']}, {result['users']} users: {result['completed']} completed, "
+            f"{result['failed']} failed, {result['timed_out']} timed out in {result['wall_seconds']} s, "
+            f"{result['updates_per_second']} updates/s"
+        )
+        print(f"  {'step':<20}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, values in result["steps"].items():
+            print(
+                f"  {name:<20}{values['count']:>7}{values['p50_ms']:>10}"
+                f"{values['p95_ms']:>10}{values['p99_ms']:>10}{values['max_ms']:>10}"
+            )
+        lag, rss = result["loop_lag_ms"], result["rss_mb"]
+        print(f"  event loop lag: p50 {lag['p50']} ms, p99 {lag['p99']} ms, max {lag['max']} ms")
+        print(f"  RSS: {rss['before']} MB -> {rss['after']} MB ({rss['growth']:+} MB)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bot", choices=BOTS + ("both",), default="both")
+    parser.add_argument("--users", default="10,100,1000", help="comma-separated numbers of concurrent users")
+    parser.add_argument("--photos", type=int, default=3, help="photos in each user's album")
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="seconds over which the users start")
+    parser.add_argument("--think-ms", type=float, default=200, help="pause of a user between steps")
+    parser.add_argument("--step-timeout", type=float, default=300, help="seconds a user waits for an answer")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds a level may run")
+    parser.add_argument("--telegram-latency-ms", type=float, default=30, help="latency of every Bot API call")
+    parser.add_argument("--latency-ms", type=float, default=50, help="latency of every 2GIS response")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 2GIS requests answered with 503")
+    parser.add_argument("--openai-latency-ms", type=float, default=1500, help="latency of every completion")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the bots")
+    # Internal: run one bot at one level and write the result to this file
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.result_file:
+        args.users = int(args.users)
+        result = run_single(args)
+        with open(args.result_file, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False)
+        return
+
+    bots = BOTS if args.bot == "both" else (args.bot,)
+    levels = [int(users) for users in args.users.split(",")]
+    results = []
+    for bot in bots:
+        for users in levels:
+            # A fresh process per run: module-level state and memory don't carry over
+            with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as result_file:
+                result_path = result_file.name
+            command = [sys.executable, os.path.abspath(__file__), "--bot", bot, "--users", str(users), "--result-file", result_path]
+            for name, value in vars(args).items():
+                if name not in ("bot", "users", "save", "verbose", "result_file"):
+                    command += ["--" + name.replace("_", "-"), str(value)]
+            if args.verbose:
+                command.append("--verbose")
+            print(f"Running {bot} with {users} users...", flush=True)
+            try:
+                subprocess.run(command, check=True, stdout=None if args.verbose else subprocess.DEVNULL)
+                with open(result_path, encoding="utf-8") as file:
+                    results.append(json.load(file))
+            finally:
+                os.remove(result_path)
+
+    print_report(results)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
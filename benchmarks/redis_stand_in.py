@@ -0,0 +1,237 @@
+"""
+A local stand-in for Redis, speaking enough of its protocol for RedisStateStore.
+
+Connections start with RESP2 and switch to RESP3 with HELLO 3, like redis-py 8 does by default.
+Supported commands: HELLO, PING, SELECT, CLIENT, GET, SET (EX/PX/NX), DEL, INCR, INCRBY, EXPIRE, PEXPIRE,
+RPUSH, LRANGE, SADD, SREM, SMEMBERS and MULTI/EXEC/DISCARD. A transaction runs under one
+lock, so it is atomic towards the other connections like in Redis.
+Values live in memory only, keys expire lazily when they are read.
+"""
+import sys
+import time
+import threading
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class RedisError(Exception):
+    pass
+
+
+WRONGTYPE = RedisError("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+
+class RedisStandIn:
+    """Serves the stand-in on 127.0.0.1 from a background thread, use `url` as REDIS_URL."""
+
+    def __init__(self):
+        # Key -> (str, list or set, expiry on the monotonic clock or None)
+        self._data: Dict[bytes, Tuple[Any, Optional[float]]] = {}
+        self._lock = threading.Lock()
+        self.commands = 0
+        self._server = ThreadingTCPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self) -> "RedisStandIn":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="redis-stand-in", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "RedisStandIn":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    # --- Data, the callers hold the lock ---
+
+    def _alive(self, key: bytes):
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return item
+
+    def _typed(self, key: bytes, kind: type):
+        item = self._alive(key)
+        if item is not None and not isinstance(item[0], kind):
+            raise WRONGTYPE
+        return item
+
+    def _expire(self, key: bytes, seconds: float) -> int:
+        item = self._alive(key)
+        if item is None:
+            return 0
+        self._data[key] = (item[0], time.monotonic() + seconds)
+        return 1
+
+    def _execute(self, name: str, args: List[bytes]):
+        if name == "PING":
+            return "PONG"
+        if name in ("SELECT", "CLIENT"):
+            return "OK"
+        if name == "GET":
+            item = self._typed(args[0], bytes)
+            return item[0] if item is not None else None
+        if name == "SET":
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            expires_at = None
+            if b"PX" in options:
+                expires_at = time.monotonic() + int(args[2 + options.index(b"PX") + 1]) / 1000
+            elif b"EX" in options:
+                expires_at = time.monotonic() + int(args[2 + options.index(b"EX") + 1])
+            if b"NX" in options and self._alive(key) is not None:
+                return None
+            self._data[key] = (value, expires_at)
+            return "OK"
+        if name == "DEL":
+            return sum(self._alive(key) is not None and self._data.pop(key) is not None for key in args)
+        if name in ("INCR", "INCRBY"):
+            item = self._typed(args[0], bytes)
+            value, expires_at = item if item is not None else (b"0", None)
+            try:
+                count = int(value) + (int(args[1]) if name == "INCRBY" else 1)
+            except ValueError:
+                raise RedisError("ERR value is not an integer or out of range")
+            self._data[args[0]] = (str(count).encode(), expires_at)
+            return count
+        if name == "EXPIRE":
+            return self._expire(args[0], int(args[1]))
+        if name == "PEXPIRE":
+            return self._expire(args[0], int(args[1]) / 1000)
+        if name == "RPUSH":
+            item = self._typed(args[0], list)
+            values, expires_at = item if item is not None else ([], None)
+            values.extend(args[1:])
+            self._data[args[0]] = (values, expires_at)
+            return len(values)
+        if name == "LRANGE":
+            item = self._typed(args[0], list)
+            values = item[0] if item is not None else []
+            start, stop = int(args[1]), int(args[2])
+            stop = len(values) + stop if stop < 0 else stop
+            return values[start:stop + 1]
+        if name in ("SADD", "SREM"):
+            item = self._typed(args[0], set)
+            members, expires_at = item if item is not None else (set(), None)
+            before = len(members)
+            if name == "SADD":
+                members.update(args[1:])
+            else:
+                members.difference_update(args[1:])
+            self._data[args[0]] = (members, expires_at)
+            return abs(len(members) - before)
+        if name == "SMEMBERS":
+            item = self._typed(args[0], set)
+            return set(item[0]) if item is not None else set()
+        raise RedisError(f"ERR unknown command '{name}'")
+
+    def _run(self, name: str, args: List[bytes]):
+        with self._lock:
+            self.commands += 1
+            try:
+                return self._execute(name, args)
+            except RedisError as e:
+                return e
+
+    def _run_transaction(self, queued: List[Tuple[str, List[bytes]]]):
+        with self._lock:
+            results = []
+            for name, args in queued:
+                self.commands += 1
+                try:
+                    results.append(self._execute(name, args))
+                except RedisError as e:
+                    results.append(e)
+            return results
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(StreamRequestHandler):
+            def _read_command(self) -> Optional[List[bytes]]:
+                line = self.rfile.readline()
+                if not line:
+                    return None
+                if not line.startswith(b"*"):
+                    # Inline command, e.g. from telnet
+                    return line.split()
+                parts = []
+                for _ in range(int(line[1:])):
+                    length = int(self.rfile.readline()[1:])
+                    parts.append(self.rfile.read(length + 2)[:-2])
+                return parts
+
+            protocol = 2
+
+            def _encode(self, value) -> bytes:
+                if value is None:
+                    return b"_\r\n" if self.protocol == 3 else b"$-1\r\n"
+                if isinstance(value, dict):
+                    return b"%" + str(len(value)).encode() + b"\r\n" + b"".join(
+                        self._encode(key) + self._encode(item) for key, item in value.items()
+                    )
+                if isinstance(value, set):
+                    prefix = b"~" if self.protocol == 3 else b"*"
+                    return prefix + str(len(value)).encode() + b"\r\n" + b"".join(self._encode(item) for item in value)
+                if isinstance(value, RedisError):
+                    return b"-" + str(value).encode() + b"\r\n"
+                if isinstance(value, str):
+                    return b"+" + value.encode() + b"\r\n"
+                if isinstance(value, int):
+                    return b":" + str(value).encode() + b"\r\n"
+                if isinstance(value, bytes):
+                    return b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
+                return b"*" + str(len(value)).encode() + b"\r\n" + b"".join(self._encode(item) for item in value)
+
+            def handle(self):
+                queued: Optional[List[Tuple[str, List[bytes]]]] = None
+                while True:
+                    command = self._read_command()
+                    if not command:
+                        return
+                    name, args = command[0].decode().upper(), command[1:]
+                    if name == "HELLO":
+                        self.protocol = int(args[0]) if args else self.protocol
+                        reply = {b"server": b"redis", b"version": b"7.0.0", b"proto": self.protocol}
+                    elif name == "MULTI":
+                        queued, reply = [], "OK"
+                    elif name == "DISCARD":
+                        queued, reply = None, "OK"
+                    elif name == "EXEC":
+                        reply = server._run_transaction(queued) if queued is not None else RedisError("ERR EXEC without MULTI")
+                        queued = None
+                    elif queued is not None:
+                        queued.append((name, args))
+                        reply = "QUEUED"
+                    else:
+                        reply = server._run(name, args)
+                    self.wfile.write(self._encode(reply))
+
+        return Handler
+
+
+if __name__ == "__main__":
+    # Serves the stand-in until Ctrl-C, e.g. for running two bot replicas by hand
+    stand_in = RedisStandIn().start()
+    print(f"REDIS_URL={stand_in.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stand_in.stop()
+        sys.exit(0)
@@ -0,0 +1,250 @@
+"""
+Offline benchmark of the generation pipeline against the local stand-in APIs.
+
+Every listing from fixtures/listings.jsonl (repeated as needed) goes through
+get_infrastructure_summary and create_description end to end. The report has
+p50/p95/p99 latencies of both phases and of the whole listing, the per-stage
+metrics recorded by the clients, and request counts and payload bytes per listing.
+
+    python benchmarks/replay_benchmark.py --listings 50 --concurrency 8 --latency-ms 80 --jitter-ms 40
+    python benchmarks/replay_benchmark.py --save baseline.json
+    python benchmarks/replay_benchmark.py --places-cache --baseline baseline.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(ROOT_DIR, "desc_gen_bot"))
+
+from clients.two_gis_client import AsyncTwoGisClient, TwoGisClient, DEFAULT_MAX_CONCURRENCY, DISTANCE_MODES
+from clients.openai_client import OpenAIClient, close_shared_http_client
+from clients.image_preprocessing import shutdown_executor
+from clients.geocode_cache import GeocodeCache
+from clients.places_cache import PlacesCache
+from clients.metrics import registry
+from stand_ins import FIXTURES_DIR, FaultInjection, StandInServer
+
+IMAGES_DIR = os.path.join(ROOT_DIR, "imgs")
+PHASES = ("infrastructure", "description", "total")
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Nearest-rank percentile, q in 0..100."""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def load_listings(count: int) -> List[Dict[str, str]]:
+    with open(os.path.join(FIXTURES_DIR, "listings.jsonl"), encoding="utf-8") as file:
+        recorded = [json.loads(line) for line in file if line.strip()]
+    return [recorded[i % len(recorded)] for i in range(count)]
+
+
+def load_images(count: int) -> List[bytes]:
+    names = sorted(name for name in os.listdir(IMAGES_DIR) if name.lower().endswith((".jpg", ".jpeg", ".png")))
+    images = []
+    for name in names[:count]:
+        with open(os.path.join(IMAGES_DIR, name), "rb") as file:
+            images.append(file.read())
+    return images
+
+
+def build_clients(args, stand_in: StandInServer, cache_dir: str):
+    two_gis_options = dict(
+        api_key="benchmark",
+        geocode_cache=GeocodeCache(os.path.join(cache_dir, "geocode.sqlite3")) if args.geocode_cache else None,
+        places_cache=PlacesCache() if args.places_cache else None,
+        distance_mode=args.distance_mode,
+        catalog_url=stand_in.catalog_url,
+        routing_url=stand_in.routing_url,
+    )
+    if args.client == "async":
+        two_gis = AsyncTwoGisClient(max_concurrency=args.twogis_concurrency, **two_gis_options)
+    else:
+        two_gis = TwoGisClient(**two_gis_options)
+    openai = OpenAIClient(
+        api_key="benchmark",
+        prompt_path=os.path.join(ROOT_DIR, "prompt.txt"),
+        base_url=stand_in.openai_base_url,
+    )
+    return two_gis, openai
+
+
+async def run_async(args, two_gis, openai, listings, images) -> List[Dict[str, float]]:
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_listing(listing):
+        async with semaphore:
+            started = time.perf_counter()
+            infra = await two_gis.get_infrastructure_summary(listing["address"])
+            infra_done = time.perf_counter()
+            request = dict(
+                user_prompt=listing["user_prompt"],
+                infrastructure_summary=infra,
+                image_paths=images,
+                address=listing["address"],
+            )
+            if args.stream:
+                async for _ in openai.stream_description(**request):
+                    pass
+            else:
+                await openai.create_description_async(**request)
+            done = time.perf_counter()
+        return {"infrastructure": infra_done - started, "description": done - infra_done, "total": done - started}
+
+    try:
+        return await asyncio.gather(*(run_listing(listing) for listing in listings))
+    finally:
+        await two_gis.aclose()
+        await close_shared_http_client()
+
+
+def run_sync(args, two_gis, openai, listings, images) -> List[Dict[str, float]]:
+    def run_listing(listing):
+        started = time.perf_counter()
+        infra = two_gis.get_infrastructure_summary(listing["address"])
+        infra_done = time.perf_counter()
+        openai.create_description(
+            user_prompt=listing["user_prompt"],
+            infrastructure_summary=infra,
+            image_paths=images,
+            address=listing["address"],
+        )
+        done = time.perf_counter()
+        return {"infrastructure": infra_done - started, "description": done - infra_done, "total": done - started}
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            return list(pool.map(run_listing, listings))
+    finally:
+        two_gis.close()
+
+
+def summarize(timings: List[Dict[str, float]], endpoint_stats: Dict[str, Dict[str, int]], wall_seconds: float) -> Dict:
+    listings = len(timings)
+    latency = {}
+    for phase in PHASES:
+        samples = [timing[phase] * 1000 for timing in timings]
+        latency[phase] = {
+            "p50_ms": round(percentile(samples, 50), 1),
+            "p95_ms": round(percentile(samples, 95), 1),
+            "p99_ms": round(percentile(samples, 99), 1),
+            "mean_ms": round(sum(samples) / listings, 1),
+        }
+    per_listing = {
+        endpoint: {name: round(value / listings, 2) for name, value in stats.items()}
+        for endpoint, stats in endpoint_stats.items()
+    }
+    return {
+        "listings": listings,
+        "wall_seconds": round(wall_seconds, 2),
+        "listings_per_second": round(listings / wall_seconds, 2),
+        "latency": latency,
+        "requests": endpoint_stats,
+        "per_listing": per_listing,
+        "stages": registry.snapshot()["stages"],
+    }
+
+
+def _delta(current: float, baseline: float) -> str:
+    if not baseline:
+        return ""
+    return f" ({(current - baseline) / baseline * 100:+.1f}%)"
+
+
+def print_report(result: Dict, baseline: Dict = None) -> None:
+    baseline = baseline or {}
+    print(f"\n{result['listings']} listings in {result['wall_seconds']} s, {result['listings_per_second']} listings/s"
+          + _delta(result["listings_per_second"], baseline.get("listings_per_second", 0)))
+
+    print(f"\n{'phase':<16}{'p50 ms':>18}{'p95 ms':>18}{'p99 ms':>18}")
+    for phase, values in result["latency"].items():
+        base = baseline.get("latency", {}).get(phase, {})
+        cells = "".join(
+            f"{str(values[key]) + _delta(values[key], base.get(key, 0)):>18}" for key in ("p50_ms", "p95_ms", "p99_ms")
+        )
+        print(f"{phase:<16}{cells}")
+
+    print(f"\n{'stage':<28}{'count':>8}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}")
+    for stage, outcomes in result["stages"].items():
+        for outcome, values in outcomes.items():
+            print(f"{stage + ' ' + outcome:<28}{values['count']:>8}{values['p50']:>8}{values['p95']:>8}{values['p99']:>8}")
+
+    print(f"\n{'endpoint':<12}{'requests':>10}{'errors':>8}{'req/listing':>13}{'KB out/listing':>16}{'KB in/listing':>15}")
+    for endpoint, stats in result["requests"].items():
+        per_listing = result["per_listing"][endpoint]
+        base = baseline.get("per_listing", {}).get(endpoint, {})
+        print(
+            f"{endpoint:<12}{stats['requests']:>10}{stats['errors']:>8}"
+            f"{per_listing['requests']:>13}"
+            # bytes_in is what the stand-in received, i.e. what the client uploaded
+            f"{per_listing['bytes_in'] / 1024:>16.1f}{per_listing['bytes_out'] / 1024:>15.1f}"
+            + _delta(per_listing["requests"], base.get("requests", 0))
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--listings", type=int, default=20, help="number of listings to run")
+    parser.add_argument("--concurrency", type=int, default=4, help="listings processed at the same time")
+    parser.add_argument("--client", choices=("async", "sync"), default="async")
+    parser.add_argument("--stream", action="store_true", help="stream the completions (async client only)")
+    parser.add_argument("--images", type=int, default=3, help="photos per listing, taken from imgs/")
+    parser.add_argument("--distance-mode", choices=DISTANCE_MODES, default="routing")
+    parser.add_argument("--twogis-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="max 2GIS requests in flight (async client)")
+    parser.add_argument("--geocode-cache", action="store_true", help="use a fresh geocode cache")
+    parser.add_argument("--places-cache", action="store_true", help="use a fresh places cache")
+    parser.add_argument("--latency-ms", type=float, default=50, help="latency added to every 2GIS response")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="random extra latency, up to this much")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 2GIS requests answered with 503")
+    parser.add_argument("--openai-latency-ms", type=float, default=800, help="latency of every completion")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the injected jitter and errors")
+    parser.add_argument("--save", help="write the results as JSON, e.g. to use as a baseline later")
+    parser.add_argument("--baseline", help="JSON written by --save to compare against")
+    args = parser.parse_args()
+    if args.stream and args.client != "async":
+        parser.error("--stream needs the async client")
+
+    twogis_faults = FaultInjection(args.latency_ms, args.jitter_ms, args.error_rate)
+    openai_faults = FaultInjection(args.openai_latency_ms, args.jitter_ms, args.openai_error_rate, error_status=500)
+    listings = load_listings(args.listings)
+    images = load_images(args.images)
+
+    with tempfile.TemporaryDirectory() as cache_dir, StandInServer(
+        default_faults=twogis_faults, faults={"openai": openai_faults}, seed=args.seed
+    ) as stand_in:
+        two_gis, openai = build_clients(args, stand_in, cache_dir)
+        started = time.perf_counter()
+        try:
+            if args.client == "async":
+                timings = asyncio.run(run_async(args, two_gis, openai, listings, images))
+            else:
+                timings = run_sync(args, two_gis, openai, listings, images)
+        finally:
+            shutdown_executor()
+        result = summarize(timings, stand_in.stats_snapshot(), time.perf_counter() - started)
+
+    result["config"] = vars(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+    print_report(result, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+Local stand-ins for the 2GIS and OpenAI HTTP APIs, serving recorded responses.
+
+One threaded HTTP server answers:
+    GET  /3.0/items/geocode     2GIS geocoder       (fixtures/twogis_geocode.json)
+    GET  /3.0/items             2GIS places search  (fixtures/twogis_places.json)
+    POST /get_dist_matrix       2GIS Distance Matrix
+    POST /v1/chat/completions   OpenAI chat completions, plain or streamed (fixtures/openai_chat_completion.json)
+
+Recorded places are stored as offsets from the search point, so they fit any listing.
+Distance Matrix answers are computed from the request: great-circle distance times a detour factor.
+Every response can be delayed and a share of them replaced by errors, see FaultInjection.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+EARTH_RADIUS_METERS = 6371000
+ROUTE_DETOUR_FACTOR = 1.3
+# Rough size of a token, used to fill in the prompt usage of recorded completions
+BYTES_PER_TOKEN = 4
+
+
+class FaultInjection(NamedTuple):
+    """Latency added to every response, in milliseconds, and the share of requests answered with `error_status`."""
+    latency_ms: float = 0
+    jitter_ms: float = 0
+    error_rate: float = 0
+    error_status: int = 503
+
+
+class EndpointStats:
+    __slots__ = ("requests", "errors", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def load_fixture(name: str):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _haversine_meters(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+class StandInServer:
+    """
+    Serves the stand-in APIs on 127.0.0.1 from a background thread.
+    `faults` maps an endpoint name ("geocode", "places", "routing", "openai") to its FaultInjection,
+    endpoints without an entry use `default_faults`.
+    """
+
+    def __init__(
+        self,
+        default_faults: FaultInjection = FaultInjection(),
+        faults: Optional[Dict[str, FaultInjection]] = None,
+        seed: int = 0,
+    ):
+        self.default_faults = default_faults
+        self.faults = faults or {}
+        self.stats: Dict[str, EndpointStats] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._geocode = load_fixture("twogis_geocode.json")
+        self._places = load_fixture("twogis_places.json")
+        self._completion = load_fixture("openai_chat_completion.json")
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def catalog_url(self) -> str:
+        return f"{self.base_url}/3.0/items"
+
+    @property
+    def routing_url(self) -> str:
+        return f"{self.base_url}/get_dist_matrix"
+
+    @property
+    def openai_base_url(self) -> str:
+        return f"{self.base_url}/v1"
+
+    def start(self) -> "StandInServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stand-in-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "StandInServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.stats = {}
+
+    def stats_snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {endpoint: stats.as_dict() for endpoint, stats in sorted(self.stats.items())}
+
+    # --- Request handling, runs in the server threads ---
+
+    def _record(self, endpoint: str, bytes_in: int, bytes_out: int, error: bool) -> None:
+        with self._lock:
+            stats = self.stats.setdefault(endpoint, EndpointStats())
+            stats.requests += 1
+            stats.errors += error
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+
+    def _inject(self, endpoint: str) -> bool:
+        """Sleeps for the configured latency, returns True if the request should fail."""
+        faults = self.faults.get(endpoint, self.default_faults)
+        with self._lock:
+            delay = faults.latency_ms + self._random.uniform(0, faults.jitter_ms)
+            fail = self._random.random() < faults.error_rate
+        if delay > 0:
+            time.sleep(delay / 1000)
+        return fail
+
+    def _geocode_response(self, query: Dict[str, str]):
+        address = query.get("q", "")
+        point = self._geocode["addresses"].get(address)
+        if point is None:
+            # Addresses without a recording get a stable point in central Moscow
+            digest = hashlib.sha256(address.encode("utf-8")).digest()
+            point = {"lat": 55.70 + digest[0] / 255 * 0.1, "lon": 37.45 + digest[1] / 255 * 0.2}
+        return {
+            "meta": self._geocode["meta"],
+            "result": {"items": [{"point": point, "type": "building", "full_name": address}], "total": 1},
+        }
+
+    def _places_response(self, query: Dict[str, str]):
+        items = self._places["queries"].get(query.get("q", ""))
+        if not items:
+            return {"meta": {**self._places["meta"], "code": 404, "error": {"type": "itemNotFound"}}}
+        lon, lat = (float(value) for value in query["point"].split(","))
+        radius = float(query.get("radius", 1000))
+        found = []
+        for item in items:
+            point = {"lat": round(lat + item["offset"]["lat"], 6), "lon": round(lon + item["offset"]["lon"], 6)}
+            if _haversine_meters(lat, lon, point["lat"], point["lon"]) <= radius:
+                found.append({key: value for key, value in item.items() if key != "offset"} | {"point": point})
+        if not found:
+            return {"meta": {**self._places["meta"], "code": 404, "error": {"type": "itemNotFound"}}}
+        return {"meta": self._places["meta"], "result": {"items": found, "total": len(found)}}
+
+    @staticmethod
+    def _routing_response(payload):
+        points = payload["points"]
+        routes = []
+        for source in payload["sources"]:
+            for target in payload["targets"]:
+                distance = _haversine_meters(
+                    points[source]["lat"], points[source]["lon"], points[target]["lat"], points[target]["lon"]
+                ) * ROUTE_DETOUR_FACTOR
+                routes.append({
+                    "source_id": source,
+                    "target_id": target,
+                    "distance": round(distance),
+                    "duration": round(distance / 1.3),
+                    "status": "OK",
+                })
+        return {"generation_time": 0.01, "routes": routes}
+
+    def _completion_response(self, request_bytes: int):
+        completion = json.loads(json.dumps(self._completion))
+        prompt_tokens = request_bytes // BYTES_PER_TOKEN
+        completion["usage"]["prompt_tokens"] = prompt_tokens
+        completion["usage"]["total_tokens"] = prompt_tokens + completion["usage"]["completion_tokens"]
+        return completion
+
+    @staticmethod
+    def _completion_stream(completion) -> bytes:
+        """The recorded completion as server-sent events, a few words per chunk, usage in the last one."""
+        base = {key: completion[key] for key in ("id", "created", "model", "system_fingerprint")}
+        base["object"] = "chat.completion.chunk"
+        words = completion["choices"][0]["message"]["content"].split(" ")
+        events = [{**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]}]
+        for i in range(0, len(words), 3):
+            text = " ".join(words[i:i + 3]) + (" " if i + 3 < len(words) else "")
+            events.append({**base, "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]})
+        events.append({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        events.append({**base, "choices": [], "usage": completion["usage"]})
+        body = "".join(f"data: {json.dumps(event, ensure_ascii=False)}\n\n" for event in events)
+        return (body + "data: [DONE]\n\n").encode("utf-8")
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so connection pooling in the clients is measured too
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, endpoint: str, status: int, body: bytes, content_type: str, bytes_in: int) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                server._record(endpoint, bytes_in, len(body), status >= 400)
+
+            def _send_json(self, endpoint: str, status: int, data, bytes_in: int) -> None:
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                self._send(endpoint, status, body, "application/json", bytes_in)
+
+            def _dispatch(self, method: str) -> None:
+                url = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                bytes_in = len(self.requestline) + len(str(self.headers)) + len(body)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+                if method == "GET" and url.path == "/3.0/items/geocode":
+                    endpoint = "geocode"
+                elif method == "GET" and url.path == "/3.0/items":
+                    endpoint = "places"
+                elif method == "POST" and url.path == "/get_dist_matrix":
+                    endpoint = "routing"
+                elif method == "POST" and url.path == "/v1/chat/completions":
+                    endpoint = "openai"
+                else:
+                    self._send_json("unknown", 404, {"error": "not found"}, bytes_in)
+                    return
+
+                if server._inject(endpoint):
+                    status = server.faults.get(endpoint, server.default_faults).error_status
+                    self._send_json(endpoint, status, {"error": {"message": "Injected error", "type": "server_error"}}, bytes_in)
+                    return
+
+                if endpoint == "geocode":
+                    self._send_json(endpoint, 200, server._geocode_response(query), bytes_in)
+                elif endpoint == "places":
+                    self._send_json(endpoint, 200, server._places_response(query), bytes_in)
+                elif endpoint == "routing":
+                    self._send_json(endpoint, 200, server._routing_response(json.loads(body)), bytes_in)
+                else:
+                    completion = server._completion_response(len(body))
+                    if json.loads(body).get("stream"):
+                        self._send(endpoint, 200, server._completion_stream(completion), "text/event-stream", bytes_in)
+                    else:
+                        self._send_json(endpoint, 200, completion, bytes_in)
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+        return Handler
+
+
+if __name__ == "__main__":
+    # Serves the stand-ins until Ctrl-C, e.g. for running a bot against them by hand
+    faults = FaultInjection(latency_ms=float(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    stand_in = StandInServer(default_faults=faults).start()
+    print(f"2GIS catalog:  {stand_in.catalog_url}")
+    print(f"2GIS routing:  {stand_in.routing_url}")
+    print(f"OpenAI:        {stand_in.openai_base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stand_in.stop()
@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+GENERATION_QUEUE_PATH = "data/generation_jobs.sqlite3"
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", "4"))
+# A job is tried at most this many times, counting the attempts cut short by a crash
+MAX_ATTEMPTS = 3
+# A failed job waits this long before its next attempt, doubled after every failure
+RETRY_DELAY_SECONDS = 15
+# Failed jobs are kept this long for inspection, finished ones are deleted right away
+FAILED_JOB_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+# Finished jobs are deleted, there is no "done" status
+PENDING, RUNNING, FAILED = "pending", "running", "failed"
+
+
+class GenerationJob:
+    __slots__ = ("id", "chat_id", "payload", "attempts")
+
+    def __init__(self, job_id: int, chat_id: int, payload: Dict[str, Any], attempts: int):
+        self.id = job_id
+        self.chat_id = chat_id
+        self.payload = payload
+        self.attempts = attempts
+
+
+class GenerationQueue:
+    """
+    Description jobs stored in SQLite and drained by a fixed number of asyncio workers.
+
+    A job holds everything needed to run it again after a restart. Jobs that were running
+    when the process stopped go back to the queue on the next start().
+    Objects that can't be stored (like photos already downloaded into memory) can be
+    attached to a job with `extras`; they are passed to the handler only in the same process.
+    A handler that raises has its job retried after a delay, up to MAX_ATTEMPTS attempts.
+
+    SQLite is only used from one dedicated thread, so its writes and their fsyncs stay off the
+    event loop and the queries of the workers never interleave.
+    """
+
+    def __init__(self, path: str = GENERATION_QUEUE_PATH, workers: int = GENERATION_WORKERS):
+        if workers < 1:
+            raise ValueError("At least one worker is required.")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generation-queue")
+        # Created here, then used from the executor thread only
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " chat_id INTEGER NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "run_after" not in columns:
+            # Queues created before retries
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN run_after REAL NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_id ON jobs (status, id)")
+        self._extras: Dict[int, Any] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    async def _db(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _insert(self, chat_id: int, payload: Dict[str, Any], extras: Any) -> GenerationJob:
+        now = time.time()
+        cursor = self._conn.execute(
+            "INSERT INTO jobs (chat_id, payload, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, json.dumps(payload, ensure_ascii=False), PENDING, now, now),
+        )
+        job = GenerationJob(cursor.lastrowid, chat_id, payload, 0)
+        # Attached before a worker can claim the job
+        if extras is not None:
+            self._extras[job.id] = extras
+        return job
+
+    async def enqueue(self, chat_id: int, payload: Dict[str, Any], extras: Any = None) -> GenerationJob:
+        job = await self._db(self._insert, chat_id, payload, extras)
+        self._wakeup.set()
+        return job
+
+    def _position(self, job_id: int) -> int:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ? AND id < ?", (PENDING, job_id)
+        ).fetchone()[0]
+
+    async def position(self, job_id: int) -> int:
+        """Number of pending jobs ahead of this one."""
+        return await self._db(self._position, job_id)
+
+    def _pending_count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (PENDING,)).fetchone()[0]
+
+    async def pending_count(self) -> int:
+        return await self._db(self._pending_count)
+
+    def _recover(self) -> None:
+        now = time.time()
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, updated_at = ? WHERE status = ? AND attempts >= ?",
+            (FAILED, now, RUNNING, MAX_ATTEMPTS),
+        )
+        recovered = self._conn.execute(
+            "UPDATE jobs SET status = ?, updated_at = ? WHERE status = ?", (PENDING, now, RUNNING)
+        ).rowcount
+        if recovered:
+            logger.info("Re-enqueued %d unfinished generation jobs", recovered)
+
+    def _prune(self) -> None:
+        self._conn.execute(
+            "DELETE FROM jobs WHERE status = ? AND updated_at < ?",
+            (FAILED, time.time() - FAILED_JOB_RETENTION_SECONDS),
+        )
+
+    def _next_run_delay(self) -> Optional[float]:
+        """Seconds until a pending job waiting for its retry is due, None if there is none."""
+        run_after = self._conn.execute("SELECT MIN(run_after) FROM jobs WHERE status = ?", (PENDING,)).fetchone()[0]
+        return max(0.0, run_after - time.time()) if run_after is not None else None
+
+    def _claim_next(self) -> Optional[GenerationJob]:
+        # All queries run on the one executor thread, so nothing can run between the SELECT and the UPDATE
+        row = self._conn.execute(
+            "SELECT id, chat_id, payload, attempts FROM jobs WHERE status = ? AND run_after <= ? ORDER BY id LIMIT 1",
+            (PENDING, time.time()),
+        ).fetchone()
+        if row is None:
+            return None
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            (RUNNING, time.time(), row[0]),
+        )
+        return GenerationJob(row[0], row[1], json.loads(row[2]), row[3] + 1)
+
+    def _finish(self, job: GenerationJob) -> None:
+        self._conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+        self._extras.pop(job.id, None)
+
+    def _fail(self, job: GenerationJob) -> None:
+        now = time.time()
+        if job.attempts < MAX_ATTEMPTS:
+            delay = RETRY_DELAY_SECONDS * 2 ** (job.attempts - 1)
+            logger.warning("Generation job %d failed, attempt %d of %d, retrying in %ds", job.id, job.attempts, MAX_ATTEMPTS, delay)
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, run_after = ?, updated_at = ? WHERE id = ?", (PENDING, now + delay, now, job.id)
+            )
+            return
+        self._conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?", (FAILED, now, job.id))
+        self._extras.pop(job.id, None)
+        self._prune()
+
+    async def _worker(self, handler: Callable[[GenerationJob, Any], Awaitable[None]]) -> None:
+        while True:
+            # Cleared before looking, so a job enqueued while the query runs still wakes this worker
+            self._wakeup.clear()
+            job = await self._db(self._claim_next)
+            if job is None:
+                try:
+                    # Woken up by a new job, or when a retry is due
+                    await asyncio.wait_for(self._wakeup.wait(), await self._db(self._next_run_delay))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await handler(job, self._extras.get(job.id))
+                await self._db(self._finish, job)
+            except asyncio.CancelledError:
+                # Shutdown: the job stays "running" and is picked up again on the next start
+                raise
+            except Exception:
+                logger.exception("Generation job %d failed", job.id)
+                await self._db(self._fail, job)
+                self._wakeup.set()
+
+    def _start(self) -> None:
+        self._recover()
+        self._prune()
+
+    async def start(self, handler: Callable[[GenerationJob, Any], Awaitable[None]]) -> None:
+        """Re-enqueues unfinished jobs and starts the workers."""
+        await self._db(self._start)
+        self._wakeup.set()
+        self._tasks = [asyncio.create_task(self._worker(handler)) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._db(self._conn.close)
+        self._executor.shutdown()
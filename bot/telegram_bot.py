@@ -12,9 +12,12 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-import tempfile
+import time
 import asyncio
+from typing import Optional
 from telegram import InputMediaPhoto
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import BaseRequest
 from dotenv import load_dotenv
 
 # --- Add project root to sys.path ---
@@ -22,9 +25,23 @@ from dotenv import load_dotenv
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-
-from two_gis_client import TwoGisClient
-from openai_client import OpenAIClient
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'desc_gen_bot')))
+
+from clients.two_gis_client import AsyncTwoGisClient
+from clients.geocode_cache import GeocodeCache
+from clients.places_cache import PlacesCache
+from clients.openai_client import OpenAIClient, close_shared_http_client
+from clients.provider_router import description_router
+from clients.image_preprocessing import shutdown_executor
+from clients.description_cache import DescriptionCache
+from clients.token_budget import preload_encoding
+from clients.metrics import start_metrics_reporting, stop_metrics_reporting, track_stage
+from photo_batch import PhotoBatch, PhotoBatches
+from media_group import MediaGroupCollector
+from webhook import run_application
+from state_store import get_state_store
+from bot_persistence import StateStorePersistence, SharedConversationHandler
+from generation_queue import GenerationQueue, GenerationJob, MAX_ATTEMPTS
 
 # Load environment variables from .env file
 # load_dotenv() # Temporarily remove dotenv
@@ -39,6 +56,12 @@ logger = logging.getLogger(__name__)
 # --- State definitions for conversation ---
 PHOTOS, ADDRESS, USER_PROMPT, FEEDBACK = range(4)
 
+# Telegram allows about one message edit per second in a chat
+STREAM_EDIT_INTERVAL_SECONDS = 1.5
+TELEGRAM_MESSAGE_LIMIT = 4096
+# The final text must not be lost to flood control, it is retried after the wait Telegram asks for
+FLOOD_CONTROL_ATTEMPTS = 3
+
 
 # --- Bot Handlers ---
 
@@ -56,8 +79,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def start_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the description creation process."""
-    context.user_data['photos'] = [] # Initialize photos list
-    context.user_data['photo_paths'] = [] # Initialize photo paths list
+    # Photos are downloaded into memory, downloads of an abandoned conversation are dropped
+    context.bot_data['photo_batches'].start(update.effective_user.id)
+    context.user_data['photo_ids'] = [] # The shared state only keeps the ids
     
     button_text = "Шаг завершен, перейти к следующему"
     
@@ -71,31 +95,44 @@ async def start_description(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def save_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores photos sent as either compressed photo or uncompressed document."""
     user = update.message.from_user
-    photo_file = None
-    
+    attachment = None
+
     if update.message.photo:
         # User sent a compressed photo
-        photo_file = await update.message.photo[-1].get_file()
+        attachment = update.message.photo[-1]
         logger.info("Photo (as photo) received from %s", user.first_name)
     elif update.message.document and update.message.document.mime_type.startswith('image/'):
         # User sent an uncompressed image file
-        photo_file = await update.message.document.get_file()
+        attachment = update.message.document
         logger.info("Photo (as document) received from %s", user.first_name)
-    
-    if photo_file:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_photo:
-            await photo_file.download_to_drive(temp_photo.name)
-            context.user_data['photos'].append(photo_file.file_id) # keep file_id for sending back
-            context.user_data['photo_paths'].append(temp_photo.name) # save path for openai
-    
+
+    if attachment:
+        context.user_data.setdefault('photo_ids', []).append(attachment.file_id)
+        # The download runs in the background, the handler doesn't wait for it
+        context.bot_data['photo_batches'].get(user.id).add(attachment)
+        # Photos of an album, or sent one by one in quick succession, are acknowledged with one reply
+        user_data = context.user_data
+        await context.bot_data['media_groups'].submit(
+            update.message, lambda messages: acknowledge_photos(messages, user_data)
+        )
+
     return PHOTOS # Stay in the same state to receive more photos
 
 
+async def acknowledge_photos(messages, user_data) -> None:
+    await messages[-1].reply_text(
+        f"Фотографий добавлено: {len(messages)}, всего: {len(user_data.get('photo_ids', []))}. "
+        "Отправьте еще или нажмите «Шаг завершен, перейти к следующему»."
+    )
+
+
 async def photos_done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Moves to the next step after user is done sending photos."""
     user = update.message.from_user
-    photos_list = context.user_data.get('photos', [])
+    photos_list = context.user_data.get('photo_ids', [])
     logger.info("User %s finished uploading %d photos.", user.first_name, len(photos_list))
+    # The step is over, photos that are not acknowledged yet don't need a reply
+    context.bot_data['media_groups'].discard(update.effective_chat.id)
     
     if not photos_list:
         await update.message.reply_text(
@@ -124,86 +161,186 @@ async def address(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def user_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    Stores the user prompt, triggers the description generation, 
+    Stores the user prompt, puts the description generation into the queue,
     and ends the conversation.
     """
-    user_prompt_text = update.message.text
-    context.user_data['user_prompt'] = user_prompt_text
     chat_id = update.effective_chat.id
+    photo_ids = context.user_data.get('photo_ids', [])
+    photos = context.bot_data['photo_batches'].pop(update.effective_user.id)
+    if photos is not None and photos.file_ids != photo_ids:
+        # Some photos were received by another replica, the worker downloads them all by id
+        photos.cancel()
+        photos = None
+    # Everything needed to run the job again after a restart
+    payload = {
+        'address': context.user_data.get('address'),
+        'user_prompt': update.message.text,
+        'photo_ids': photo_ids,
+    }
+    generation_queue = context.bot_data['generation_queue']
+    job = await generation_queue.enqueue(chat_id, payload, extras=photos)
+    context.user_data.clear()
+    # Kept for /regenerate
+    context.user_data['last_request'] = payload
+
+    text = "Спасибо! Я собрал всю информацию. Начинаю генерацию описания. Это может занять некоторое время..."
+    position = await generation_queue.position(job.id)
+    if position:
+        text = (
+            f"Спасибо! Я собрал всю информацию. Ваш запрос в очереди, перед вами: {position}. "
+            "Я начну генерацию описания, как только подойдет ваша очередь."
+        )
+    await context.bot.send_message(chat_id=chat_id, text=text)
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text="Спасибо! Я собрал всю информацию. Начинаю генерацию описания. Это может занять некоторое время..."
-    )
+    return ConversationHandler.END
 
-    # Trigger the async description generation
-    asyncio.create_task(generate_and_send_description(update, context))
 
-    return ConversationHandler.END
+async def regenerate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Puts the last description request into the queue again, bypassing the description cache."""
+    last_request = context.user_data.get('last_request')
+    if not last_request:
+        await update.message.reply_text("Пока нечего генерировать заново. Начните с команды /start")
+        return
 
+    generation_queue = context.bot_data['generation_queue']
+    job = await generation_queue.enqueue(update.effective_chat.id, dict(last_request, regenerate=True))
+    text = "Генерирую новый вариант описания. Это может занять некоторое время..."
+    position = await generation_queue.position(job.id)
+    if position:
+        text = f"Новый вариант описания в очереди, перед вами: {position}."
+    await update.message.reply_text(text)
 
-async def generate_and_send_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+async def generate_and_send_description(application: Application, job: GenerationJob, photos: Optional[PhotoBatch]):
     """
-    An async helper function to generate and send the description, 
-    allowing the bot to remain responsive.
+    Generates and sends the description of one queued job.
+    Runs in a worker of the generation queue, so the bot stays responsive.
+    Errors are raised to the queue, which retries the job up to MAX_ATTEMPTS times.
     """
-    chat_id = update.effective_chat.id
+    chat_id = job.chat_id
+    bot = application.bot
     try:
-        # --- 1. Get data from context ---
-        photo_paths = context.user_data.get('photo_paths', [])
-        address = context.user_data.get('address')
-        user_prompt_text = context.user_data.get('user_prompt')
+        # --- 1. Get data from the job ---
+        address = job.payload.get('address')
+        user_prompt_text = job.payload.get('user_prompt')
+        if photos is None:
+            # The job was restored after a restart, the photos have to be downloaded again
+            photos = PhotoBatch.from_file_ids(bot, job.payload.get('photo_ids', []))
 
         # --- 2. Initialize clients ---
-        openai_client = context.bot_data['openai_client']
-        two_gis_client = context.bot_data['two_gis_client']
+        description_generator = application.bot_data['description_generator']
+        two_gis_client = application.bot_data['two_gis_client']
 
-        # --- 3. Fetch infrastructure and generate description ---
-        infra_summary = two_gis_client.get_infrastructure_summary(address)
-        description = openai_client.create_description(
-            user_prompt=user_prompt_text,
-            infrastructure_summary=infra_summary,
-            image_paths=photo_paths,
-            address=address,
-        )
+        # --- 3. Fetch infrastructure ---
+        with track_stage("infrastructure"):
+            infra_summary = await two_gis_client.get_infrastructure_summary(address)
 
         # --- 4. Send Result ---
-        # Send photos first as a media group
-        photo_ids = context.user_data.get('photos', [])
+        # Send photos first as a media group, the description is streamed below them
+        photo_ids = photos.file_ids
         if photo_ids:
             media_group = [InputMediaPhoto(media=pid) for pid in photo_ids]
             # We can only send up to 10 photos in a media group
-            await context.bot.send_media_group(chat_id=chat_id, media=media_group[:10])
-
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="🎉 Ваше описание готово! 🎉"
-        )
-
-        # A simple replacement to fix bolding issues from the model
-        final_description = description.replace('**', '*')
+            with track_stage("telegram_send"):
+                await bot.send_media_group(chat_id=chat_id, media=media_group[:10])
 
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=final_description,
-            parse_mode='Markdown' # Fall back to simple Markdown, it's more forgiving
+        deltas = description_generator.stream_description(
+            user_prompt=user_prompt_text,
+            infrastructure_summary=infra_summary,
+            image_paths=await photos.images(),
+            address=address,
+            # A retry after a failed send or a double tap gets the same text for free,
+            # /regenerate asks for a new one
+            use_cache=not job.payload.get('regenerate', False),
         )
+        with track_stage("generation"):
+            await stream_description_to_chat(bot, chat_id, deltas)
+
+        with track_stage("telegram_send"):
+            await bot.send_message(
+                chat_id=chat_id,
+                text="🎉 Ваше описание готово! 🎉\nДругой вариант описания - /regenerate"
+            )
         # We will ask for feedback in the next step
-            
+
     except Exception as e:
-        logger.error("Error during description generation for chat %d: %s", chat_id, e, exc_info=True)
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"Произошла ошибка при создании описания: {e}\nПопробуйте начать заново с команды /start"
-        )
-    finally:
-        # Clean up user data and temporary files
-        for path in context.user_data.get('photo_paths', []):
+        if job.attempts < MAX_ATTEMPTS:
+            text = f"Произошла ошибка при создании описания: {e}\nЯ попробую еще раз через некоторое время."
+        else:
+            text = f"Произошла ошибка при создании описания: {e}\nПопробуйте начать заново с команды /start"
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+        except Exception:
+            logger.exception("Could not notify chat %d about the failed generation", chat_id)
+        raise
+
+
+async def call_with_flood_control(call, *args, **kwargs):
+    """Runs a Bot API call, on RetryAfter sleeps as long as Telegram asks and tries again."""
+    for attempt in range(1, FLOOD_CONTROL_ATTEMPTS + 1):
+        try:
+            return await call(*args, **kwargs)
+        except RetryAfter as e:
+            if attempt == FLOOD_CONTROL_ATTEMPTS:
+                raise
+            logger.info("Flood control, retrying in %ss", e.retry_after)
+            await asyncio.sleep(e.retry_after)
+
+
+async def stream_description_to_chat(bot, chat_id: int, deltas) -> str:
+    """
+    Shows the description while it is being generated: one placeholder message is
+    edited as text arrives, no more often than STREAM_EDIT_INTERVAL_SECONDS.
+    When the stream ends the text is re-sent with Markdown formatting.
+    """
+    with track_stage("telegram_send"):
+        message = await bot.send_message(chat_id=chat_id, text="✍️ Пишу описание...")
+    description = ""
+    shown_text = ""
+    last_edit = time.monotonic()
+
+    async for delta in deltas:
+        description += delta
+        if time.monotonic() - last_edit < STREAM_EDIT_INTERVAL_SECONDS:
+            continue
+        # Until the end the text is shown as is, unfinished Markdown can't be parsed
+        preview = description[:TELEGRAM_MESSAGE_LIMIT - 2].rstrip() + " ▌"
+        if preview != shown_text:
+            try:
+                with track_stage("telegram_edit"):
+                    await message.edit_text(preview)
+                shown_text = preview
+            except RetryAfter as e:
+                # Flood control: skip edits for as long as Telegram asks
+                last_edit = time.monotonic() + e.retry_after
+                continue
+            except BadRequest as e:
+                logger.warning("Could not update streamed description in chat %d: %s", chat_id, e)
+        last_edit = time.monotonic()
+
+    # A simple replacement to fix bolding issues from the model
+    final_description = description.strip().replace('**', '*')
+    parts = [
+        final_description[i:i + TELEGRAM_MESSAGE_LIMIT]
+        for i in range(0, len(final_description), TELEGRAM_MESSAGE_LIMIT)
+    ] or ["Не удалось сгенерировать описание."]
+
+    for i, part in enumerate(parts):
+        with track_stage("telegram_send"):
             try:
-                os.remove(path)
-            except OSError:
-                pass
-        context.user_data.clear()
+                # Fall back to simple Markdown, it's more forgiving
+                if i == 0:
+                    await call_with_flood_control(message.edit_text, part, parse_mode='Markdown')
+                else:
+                    await call_with_flood_control(bot.send_message, chat_id=chat_id, text=part, parse_mode='Markdown')
+            except BadRequest:
+                # The model produced Markdown that Telegram can't parse, send the text as is
+                if i == 0:
+                    await call_with_flood_control(message.edit_text, part)
+                else:
+                    await call_with_flood_control(bot.send_message, chat_id=chat_id, text=part)
+
+    return final_description
 
 
 async def post_init(application: Application):
@@ -212,32 +349,58 @@ async def post_init(application: Application):
     """
     await application.bot.set_my_commands([
         BotCommand("start", "Запустить/перезапустить бота"),
+        BotCommand("regenerate", "Другой вариант последнего описания"),
     ])
 
-def main() -> None:
-    """Run the bot."""
-    # --- Initialize clients ---
-    load_dotenv()
-    openai_api_key = os.environ.get("OPENAI_API_KEY")
-    two_gis_api_key = os.environ.get("TWOGIS_API_KEY")
-    telegram_bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
+    async def handle_job(job: GenerationJob, photos: Optional[PhotoBatch]):
+        await generate_and_send_description(application, job, photos)
 
-    if not all([openai_api_key, two_gis_api_key, telegram_bot_token]):
-        logger.error("One or more environment variables are missing.")
-        return
+    await application.bot_data['generation_queue'].start(handle_job)
+    # The tokenizer may have to be downloaded, that must not happen inside the first generation
+    preload_encoding()
+    await start_metrics_reporting()
 
-    openai_client = OpenAIClient(api_key=openai_api_key)
-    two_gis_client = TwoGisClient(api_key=two_gis_api_key)
-
-    # --- Bot Setup ---
-    application = Application.builder().token(telegram_bot_token).post_init(post_init).build()
+async def post_shutdown(application: Application):
+    """
+    Stops the generation workers and closes the HTTP connections held by the API clients.
+    """
+    await application.bot_data['media_groups'].close()
+    await stop_metrics_reporting()
+    await application.bot_data['generation_queue'].stop()
+    await application.bot_data['two_gis_client'].aclose()
+    await close_shared_http_client()
+    shutdown_executor()
+
+def build_application(
+    telegram_bot_token: str,
+    openai_client: OpenAIClient,
+    two_gis_client: AsyncTwoGisClient,
+    request: Optional[BaseRequest] = None,
+    generation_queue: Optional[GenerationQueue] = None,
+) -> Application:
+    """
+    Builds the bot with all its handlers, without starting it.
+    `request` replaces the HTTP transport to the Bot API, e.g. with a fake one in load tests.
+    """
+    # Conversations and user data live in the state store, so replicas can share them (STATE_BACKEND=redis)
+    persistence = StateStorePersistence(get_state_store())
+    builder = Application.builder().token(telegram_bot_token).persistence(persistence)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.post_init(post_init).post_shutdown(post_shutdown).build()
     
     # Store clients in bot_data
     application.bot_data['openai_client'] = openai_client
+    # OpenAI, hedged with Mistral when MISTRAL_API_KEY is set
+    application.bot_data['description_generator'] = description_router(openai_client)
     application.bot_data['two_gis_client'] = two_gis_client
+    application.bot_data['generation_queue'] = generation_queue or GenerationQueue()
+    application.bot_data['media_groups'] = MediaGroupCollector(group_singles=True)
+    application.bot_data['photo_batches'] = PhotoBatches() # Downloads started by this process, by user id
 
     # --- Conversation Handler ---
-    conv_handler = ConversationHandler(
+    conv_handler = SharedConversationHandler(
+        persistence,
         entry_points=[MessageHandler(filters.Regex('^Начать создание описания$'), start_description)],
         states={
             PHOTOS: [
@@ -246,18 +409,46 @@ def main() -> None:
             ],
             ADDRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, address)],
             USER_PROMPT: [MessageHandler(filters.TEXT & ~filters.COMMAND, user_prompt)],
-            FEEDBACK: [MessageHandler(filters.TEXT & ~filters.COMMAND, feedback)]
         },
         fallbacks=[],
+        name="description",
+        persistent=True,
     )
 
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("regenerate", regenerate))
+    # Reads the conversation state from the store before the handlers of group 0 check the update
+    application.add_handler(conv_handler.refresh_handler(), group=-1)
     application.add_handler(conv_handler)
+    return application
+
+def main() -> None:
+    """Run the bot."""
+    # --- Initialize clients ---
+    load_dotenv()
+    openai_api_key = os.environ.get("OPENAI_API_KEY")
+    two_gis_api_key = os.environ.get("TWOGIS_API_KEY")
+    telegram_bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
+
+    if not all([openai_api_key, two_gis_api_key, telegram_bot_token]):
+        logger.error("One or more environment variables are missing.")
+        return
+
+    openai_client = OpenAIClient(api_key=openai_api_key, description_cache=DescriptionCache())
+    two_gis_client = AsyncTwoGisClient(
+        api_key=two_gis_api_key,
+        geocode_cache=GeocodeCache(),
+        places_cache=PlacesCache(),
+        distance_mode=os.environ.get("TWOGIS_DISTANCE_MODE", "routing"),
+    )
+
+    # --- Bot Setup ---
+    application = build_application(telegram_bot_token, openai_client, two_gis_client)
 
     # --- Start Bot ---
     logger.info("Bot is starting...")
-    application.run_polling()
+    run_application(application) # Long polling, or a webhook server with BOT_MODE=webhook
 
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,8 +1,9 @@
+import asyncio
 from telegram import Update
 from telegram.ext import ContextTypes
 from clients import mistral
 from localdb import append_line_to_file, read_file
-from rate_limits import build_filename_for_current_date, create_or_append_request_info, get_current_rate_limit
+from rate_limits import increment_request_count
 
 USER_POSTS_FILENAME = "user_posts/data.txt"
 USER_DATA = "user_data"
@@ -30,13 +31,13 @@ async def analyze(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         # сохраняем запрос в файл для будущего
         append_line_to_file(USER_POSTS_FILENAME, f"-----\n{user_id}\n{user_post}\n-----\n\n")
 
-        current_request_count = get_current_rate_limit(user_id)
-        if current_request_count > MAX_REQUESTS_PER_USER_IN_DAY:
+        # Counted in one atomic step, concurrent requests can't both slip under the quota
+        request_count = await asyncio.to_thread(increment_request_count, user_id)
+        if request_count > MAX_REQUESTS_PER_USER_IN_DAY:
             await update.message.reply_text("Вы превысыли вашу дневную квоту на кол-во запросов. Попробуйте завтра или оформите подписку.")
             return
-        
-        print(f"{user_id}: {current_request_count} + 1 request for analyze")
-        create_or_append_request_info(build_filename_for_current_date(user_id), current_request_count+1)
+
+        print(f"{user_id}: request {request_count} for analyze")
 
         await update.message.reply_text("Обрабатываю запрос... 🤓")
         analyze_result = mistral.req(f"{TASK} {user_post}", user_context)
@@ -0,0 +1,436 @@
+"""
+Descriptions for a whole listings feed, e.g. overnight.
+
+    python desc_gen_bot/batch.py run listings.csv --out described.csv
+    python desc_gen_bot/batch.py export listings.csv --requests requests.jsonl
+    python desc_gen_bot/batch.py join listings.csv --batch-output batch_output.jsonl --out described.csv
+
+Listings are read from CSV or JSONL with the fields `address`, `user_prompt` (details of the
+listing), optional `id` (the row number by default) and optional `photos` (paths relative to
+the listings file, separated with ";" in CSV). Other fields are passed through to the output.
+
+`run` generates the descriptions right away. Infrastructure is looked up once per distinct
+address, while completions for other listings are already running.
+`export` writes the same requests as a Batch API input file instead; `join` reads the
+batch output back. Finished listings are appended to a progress file as they complete,
+so an interrupted run continues where it stopped and failed listings are retried.
+"""
+import os
+import csv
+import json
+import time
+import asyncio
+import logging
+import argparse
+from typing import Any, Awaitable, Dict, Iterator, List, NamedTuple, Optional
+
+from clients.two_gis_client import AsyncTwoGisClient
+from clients.openai_client import MAX_CONCURRENT_GENERATIONS, OpenAIClient, close_shared_http_client
+from clients.image_preprocessing import shutdown_executor
+from clients.geocode_cache import GeocodeCache, normalize_address
+from clients.places_cache import PlacesCache
+from clients.description_cache import DescriptionCache
+from clients.token_budget import load_encoding
+
+logger = logging.getLogger(__name__)
+
+# Distinct addresses whose infrastructure is looked up at once
+INFRASTRUCTURE_CONCURRENCY = 4
+# An overnight run rather waits out a rate limit than fails the listing
+BATCH_MAX_RETRIES = 6
+PHOTO_SEPARATOR = ";"
+# The Batch API accepts input files of up to 200 MB, larger exports are split into parts
+BATCH_FILE_MAX_BYTES = 190 * 2 ** 20
+PROGRESS_LOG_EVERY = 10
+
+OK, ERROR, PENDING = "ok", "error", "pending"
+
+
+class Listing(NamedTuple):
+    id: str
+    address: str
+    user_prompt: str
+    photos: List[str]
+    # The row as it was read, written back with the results
+    fields: Dict[str, Any]
+
+
+def read_listings(path: str) -> List[Listing]:
+    """Reads listings from a .csv file or from JSON lines."""
+    with open(path, encoding="utf-8-sig", newline="") as file:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(file))
+        else:
+            rows = [json.loads(line) for line in file if line.strip()]
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    listings = []
+    seen_ids = set()
+    for number, row in enumerate(rows, start=1):
+        listing_id = str(row.get("id") or number)
+        if listing_id in seen_ids:
+            raise ValueError(f"Listing id {listing_id!r} appears more than once in {path}.")
+        seen_ids.add(listing_id)
+        if not row.get("address"):
+            raise ValueError(f"Listing {listing_id!r} in {path} has no address.")
+        photos = row.get("photos") or []
+        if isinstance(photos, str):
+            photos = [photo.strip() for photo in photos.split(PHOTO_SEPARATOR) if photo.strip()]
+        listings.append(Listing(
+            id=listing_id,
+            address=row["address"],
+            user_prompt=row.get("user_prompt") or "",
+            photos=[os.path.join(base_dir, photo) for photo in photos],
+            fields=row,
+        ))
+    return listings
+
+
+class Checkpoint:
+    """
+    Results of finished listings, one JSON line each, appended as they finish.
+    A listing is done once it has an "ok" line; the last line of a listing wins.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.results: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        result = json.loads(line)
+                        self.results[result["id"]] = result
+        self._file = open(path, "a", encoding="utf-8")
+
+    def is_done(self, listing_id: str) -> bool:
+        return self.results.get(listing_id, {}).get("status") == OK
+
+    def record(self, listing_id: str, status: str, description: Optional[str] = None, error: Optional[str] = None) -> None:
+        result = {"id": listing_id, "status": status, "description": description, "error": error}
+        self.results[listing_id] = result
+        self._file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        # Written out right away, an interrupted run must not lose paid completions
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class InfrastructureResolver:
+    """Looks up the infrastructure of every distinct address once, however many listings share it."""
+
+    def __init__(self, two_gis_client: AsyncTwoGisClient, concurrency: int = INFRASTRUCTURE_CONCURRENCY):
+        self.two_gis_client = two_gis_client
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lookups: Dict[str, asyncio.Task] = {}
+
+    async def _lookup(self, address: str) -> Dict[str, List[Dict[str, Any]]]:
+        async with self._semaphore:
+            return await self.two_gis_client.get_infrastructure_summary(address)
+
+    def summary(self, address: str) -> Awaitable[Dict[str, List[Dict[str, Any]]]]:
+        key = normalize_address(address)
+        lookup = self._lookups.get(key)
+        if lookup is None:
+            lookup = self._lookups[key] = asyncio.create_task(self._lookup(address))
+        return lookup
+
+    @property
+    def distinct_addresses(self) -> int:
+        return len(self._lookups)
+
+
+class Progress:
+    def __init__(self, total: int, action: str):
+        self.total = total
+        self.action = action
+        self.finished = 0
+        self.failed = 0
+        self._started = time.monotonic()
+
+    def step(self, failed: bool = False) -> None:
+        self.finished += 1
+        self.failed += failed
+        if self.finished % PROGRESS_LOG_EVERY == 0 or self.finished == self.total:
+            elapsed = time.monotonic() - self._started
+            logger.info(
+                "%s %d/%d listings (%d failed), %.2f listings/s",
+                self.action, self.finished, self.total, self.failed, self.finished / elapsed if elapsed else 0,
+            )
+
+
+async def run_descriptions(
+    listings: List[Listing],
+    checkpoint: Checkpoint,
+    resolver: InfrastructureResolver,
+    openai_client: OpenAIClient,
+    concurrency: int,
+    regenerate: bool = False,
+) -> None:
+    """
+    Generates the descriptions of the listings that aren't done yet, `concurrency` completions at a time.
+    With `regenerate` the description cache is skipped and every description is generated anew.
+    """
+    pending = [listing for listing in listings if not checkpoint.is_done(listing.id)]
+    logger.info("%d of %d listings to describe", len(pending), len(listings))
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = Progress(len(pending), "Described")
+
+    async def describe(listing: Listing) -> None:
+        # Looked up outside the semaphore, so lookups run ahead of the completions
+        infrastructure = await resolver.summary(listing.address)
+        async with semaphore:
+            try:
+                description = await openai_client.create_description_async(
+                    user_prompt=listing.user_prompt,
+                    infrastructure_summary=infrastructure,
+                    image_paths=listing.photos,
+                    address=listing.address,
+                    # A rerun after changing nothing costs nothing
+                    use_cache=not regenerate,
+                    raise_errors=True,
+                )
+            except Exception as e:
+                logger.warning("Could not describe listing %s: %s", listing.id, e)
+                checkpoint.record(listing.id, ERROR, error=str(e))
+                progress.step(failed=True)
+                return
+        checkpoint.record(listing.id, OK, description=description)
+        progress.step()
+
+    await asyncio.gather(*(describe(listing) for listing in pending))
+    logger.info("Infrastructure was looked up for %d distinct addresses", resolver.distinct_addresses)
+
+
+class BatchRequestWriter:
+    """
+    Appends Batch API requests to `path`. Once a file would grow past `max_bytes`,
+    the next part is started: requests.jsonl, requests.2.jsonl, requests.3.jsonl...
+    """
+
+    def __init__(self, path: str, max_bytes: int = BATCH_FILE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._file = None
+        self._size = 0
+
+    def part_path(self, number: int) -> str:
+        if number == 1:
+            return self.path
+        stem, extension = os.path.splitext(self.path)
+        return f"{stem}.{number}{extension}"
+
+    def existing_parts(self) -> Iterator[str]:
+        number = 1
+        while os.path.exists(self.part_path(number)):
+            yield self.part_path(number)
+            number += 1
+
+    def written_ids(self) -> set:
+        """custom_ids already exported, e.g. by an interrupted run."""
+        ids = set()
+        for part in self.existing_parts():
+            with open(part, encoding="utf-8") as file:
+                ids.update(json.loads(line)["custom_id"] for line in file if line.strip())
+        return ids
+
+    def write(self, request: Dict[str, Any]) -> None:
+        line = (json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8")
+        if self._file is None:
+            parts = list(self.existing_parts())
+            self._open(len(parts) or 1)
+        if self._size and self._size + len(line) > self.max_bytes:
+            self._file.close()
+            self._open(self._number + 1)
+        self._file.write(line)
+        self._file.flush()
+        self._size += len(line)
+
+    def _open(self, number: int) -> None:
+        self._number = number
+        path = self.part_path(number)
+        self._file = open(path, "ab")
+        self._size = os.path.getsize(path)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+async def export_requests(
+    listings: List[Listing],
+    writer: BatchRequestWriter,
+    resolver: InfrastructureResolver,
+    openai_client: OpenAIClient,
+    concurrency: int,
+) -> None:
+    """Writes a Batch API request for every listing that isn't in the output yet."""
+    written = writer.written_ids()
+    pending = [listing for listing in listings if listing.id not in written]
+    logger.info("%d of %d listings to export", len(pending), len(listings))
+    # Photos of this many listings are encoded at once
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = Progress(len(pending), "Exported")
+
+    async def export(listing: Listing) -> None:
+        infrastructure = await resolver.summary(listing.address)
+        async with semaphore:
+            request = await openai_client.create_batch_request(
+                custom_id=listing.id,
+                user_prompt=listing.user_prompt,
+                infrastructure_summary=infrastructure,
+                image_paths=listing.photos,
+                address=listing.address,
+            )
+        writer.write(request)
+        progress.step()
+
+    await asyncio.gather(*(export(listing) for listing in pending))
+
+
+def import_batch_output(paths: List[str], checkpoint: Checkpoint) -> None:
+    """Records the completions of Batch API output (and error) files in the checkpoint."""
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                listing_id = result["custom_id"]
+                response = result.get("response") or {}
+                body = response.get("body") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    error = result.get("error") or body.get("error") or f"status {response.get('status_code')}"
+                    checkpoint.record(listing_id, ERROR, error=json.dumps(error, ensure_ascii=False))
+                else:
+                    checkpoint.record(listing_id, OK, description=body["choices"][0]["message"]["content"].strip())
+
+
+def write_results(listings: List[Listing], checkpoint: Checkpoint, path: str) -> None:
+    """Writes the listings with their descriptions, as CSV or JSON lines depending on the extension."""
+    rows = []
+    for listing in listings:
+        result = checkpoint.results.get(listing.id, {"status": PENDING})
+        rows.append({
+            **listing.fields,
+            "description": result.get("description"),
+            "status": result["status"],
+            "error": result.get("error"),
+        })
+
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        if path.lower().endswith(".csv"):
+            fieldnames = list(dict.fromkeys(name for row in rows for name in row))
+            writer = csv.DictWriter(file, fieldnames=fieldnames)
+            writer.writeheader()
+            for row in rows:
+                if isinstance(row.get("photos"), list):
+                    row["photos"] = PHOTO_SEPARATOR.join(row["photos"])
+                writer.writerow(row)
+        else:
+            for row in rows:
+                file.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    statuses = [row["status"] for row in rows]
+    logger.info(
+        "Wrote %s: %d described, %d failed, %d pending",
+        path, statuses.count(OK), statuses.count(ERROR), statuses.count(PENDING),
+    )
+
+
+def build_two_gis_client() -> AsyncTwoGisClient:
+    return AsyncTwoGisClient(
+        api_key=os.environ.get("TWOGIS_API_KEY"),
+        geocode_cache=GeocodeCache(),
+        places_cache=PlacesCache(),
+        distance_mode=os.environ.get("TWOGIS_DISTANCE_MODE", "routing"),
+    )
+
+
+async def run_command(args, listings: List[Listing]) -> None:
+    two_gis_client = build_two_gis_client()
+    resolver = InfrastructureResolver(two_gis_client, args.infra_concurrency)
+    try:
+        # Nothing else runs yet, the tokenizer can be loaded right away
+        await asyncio.to_thread(load_encoding)
+        if args.command == "run":
+            openai_client = OpenAIClient(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                description_cache=DescriptionCache(),
+                max_retries=args.max_retries,
+            )
+            checkpoint = Checkpoint(args.checkpoint or args.out + ".progress.jsonl")
+            try:
+                await run_descriptions(listings, checkpoint, resolver, openai_client, args.concurrency, args.regenerate)
+                write_results(listings, checkpoint, args.out)
+            finally:
+                checkpoint.close()
+        else:
+            # Nothing is sent to OpenAI, the client only builds the requests
+            openai_client = OpenAIClient(api_key=os.environ.get("OPENAI_API_KEY") or "batch-export")
+            writer = BatchRequestWriter(args.requests)
+            try:
+                await export_requests(listings, writer, resolver, openai_client, args.concurrency)
+            finally:
+                writer.close()
+            logger.info("Batch input: %s", ", ".join(writer.existing_parts()))
+    finally:
+        await two_gis_client.aclose()
+        await close_shared_http_client()
+        shutdown_executor()
+
+
+def main() -> None:
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="generate the descriptions now")
+    run.add_argument("listings", help="listings as .csv or .jsonl")
+    run.add_argument("--out", required=True, help="listings with descriptions, .csv or .jsonl")
+    run.add_argument("--checkpoint", help="progress file, OUT.progress.jsonl by default")
+    run.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_GENERATIONS,
+                     help="completions in flight, also capped by OPENAI_MAX_CONCURRENT_GENERATIONS")
+    run.add_argument("--infra-concurrency", type=int, default=INFRASTRUCTURE_CONCURRENCY,
+                     help="addresses looked up at once")
+    run.add_argument("--max-retries", type=int, default=BATCH_MAX_RETRIES,
+                     help="retries of a rate-limited or failed completion")
+    run.add_argument("--regenerate", action="store_true",
+                     help="generate new descriptions instead of reusing cached ones")
+
+    export = commands.add_parser("export", help="write a Batch API input file")
+    export.add_argument("listings", help="listings as .csv or .jsonl")
+    export.add_argument("--requests", default="requests.jsonl", help="Batch API input file, split into parts if needed")
+    export.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_GENERATIONS, help="listings encoded at once")
+    export.add_argument("--infra-concurrency", type=int, default=INFRASTRUCTURE_CONCURRENCY,
+                        help="addresses looked up at once")
+
+    join = commands.add_parser("join", help="join Batch API output back to the listings")
+    join.add_argument("listings", help="listings as .csv or .jsonl")
+    join.add_argument("--batch-output", nargs="+", required=True, help="Batch API output and error files")
+    join.add_argument("--out", required=True, help="listings with descriptions, .csv or .jsonl")
+    join.add_argument("--checkpoint", help="progress file, OUT.progress.jsonl by default")
+    args = parser.parse_args()
+
+    listings = read_listings(args.listings)
+    if args.command == "join":
+        checkpoint = Checkpoint(args.checkpoint or args.out + ".progress.jsonl")
+        try:
+            import_batch_output(args.batch_output, checkpoint)
+            write_results(listings, checkpoint, args.out)
+        finally:
+            checkpoint.close()
+        return
+
+    if not os.environ.get("TWOGIS_API_KEY") or (args.command == "run" and not os.environ.get("OPENAI_API_KEY")):
+        logger.error("TWOGIS_API_KEY and OPENAI_API_KEY must be set.")
+        return
+    asyncio.run(run_command(args, listings))
+
+
+if __name__ == '__main__':
+    main()
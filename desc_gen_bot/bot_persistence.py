@@ -0,0 +1,151 @@
+import json
+import asyncio
+from typing import Any, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BasePersistence, ContextTypes, ConversationHandler, PersistenceInput, TypeHandler
+
+from state_store import StateStore
+
+# Conversations and user data of users who went silent are dropped after a week
+PERSISTENCE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+class StateStorePersistence(BasePersistence):
+    """
+    python-telegram-bot persistence on top of a StateStore.
+
+    Nothing is loaded at startup: user and chat data are re-read from the store before every
+    handler call, so with a shared store each replica sees what the others wrote.
+    Data must be JSON-serializable; keep process-local objects (tasks, clients) in bot_data,
+    which is not stored by default.
+    """
+
+    def __init__(
+        self,
+        state_store: StateStore,
+        store_data: Optional[PersistenceInput] = None,
+        ttl: Optional[float] = PERSISTENCE_TTL_SECONDS,
+        update_interval: float = 60,
+    ):
+        super().__init__(
+            store_data=store_data or PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.state_store = state_store
+        self.ttl = ttl
+
+    async def _run(self, function, *args):
+        # A networked store must not block the event loop
+        if self.state_store.shared:
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+
+    def _load(self, key: str) -> Optional[Any]:
+        value = self.state_store.get(key)
+        return json.loads(value) if value is not None else None
+
+    def _save(self, key: str, data: Any) -> None:
+        self.state_store.set(key, json.dumps(data, ensure_ascii=False), ttl=self.ttl)
+
+    @staticmethod
+    def _conversation_key(name: str, key) -> str:
+        return f"conversation:{name}:" + ":".join(str(part) for part in key)
+
+    async def load_conversation(self, name: str, key) -> Optional[object]:
+        """Current state of one conversation, None if it isn't running."""
+        return await self._run(self._load, self._conversation_key(name, key))
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        return await self._run(self._load, "bot_data") or {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        # States are read one by one by SharedConversationHandler.refresh_handler
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state: Optional[object]) -> None:
+        conversation_key = self._conversation_key(name, key)
+        if new_state is None:
+            await self._run(self.state_store.delete, conversation_key)
+        else:
+            await self._run(self._save, conversation_key, new_state)
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        await self._run(self._save, f"user_data:{user_id}", data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict[str, Any]) -> None:
+        await self._run(self._save, f"chat_data:{chat_id}", data)
+
+    async def update_bot_data(self, data: Dict[str, Any]) -> None:
+        await self._run(self._save, "bot_data", data)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._run(self.state_store.delete, f"chat_data:{chat_id}")
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._run(self.state_store.delete, f"user_data:{user_id}")
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        stored = await self._run(self._load, f"user_data:{user_id}")
+        user_data.clear()
+        user_data.update(stored or {})
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[str, Any]) -> None:
+        stored = await self._run(self._load, f"chat_data:{chat_id}")
+        chat_data.clear()
+        chat_data.update(stored or {})
+
+    async def refresh_bot_data(self, bot_data: Dict[str, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+
+class SharedConversationHandler(ConversationHandler):
+    """
+    ConversationHandler whose state is read from the persistence on every update and written
+    back right after the handler ran, so the next message can be handled by any replica.
+    Must be persistent, named, and the application must use `persistence`.
+    check_update can't wait for the store, so the state is read by `refresh_handler()`,
+    which has to be added in a group that runs before this handler's group.
+    """
+
+    def __init__(self, persistence: StateStorePersistence, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shared_persistence = persistence
+
+    def refresh_handler(self) -> TypeHandler:
+        return TypeHandler(Update, self._refresh)
+
+    async def _refresh(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not (update.effective_chat and update.effective_user):
+            return
+        key = self._get_key(update)
+        state = await self._shared_persistence.load_conversation(self.name, key)
+        if state is None:
+            self._conversations.pop(key, None)
+        elif self._conversations.get(key) != state:
+            self._conversations[key] = state
+
+    async def handle_update(self, update, application, check_result, context):
+        try:
+            return await super().handle_update(update, application, check_result, context)
+        finally:
+            # Other replicas must see the new state and user data before the next message
+            application.mark_data_for_update_persistence(
+                chat_ids=update.effective_chat.id, user_ids=update.effective_user.id
+            )
+            await application.update_persistence()
@@ -0,0 +1,67 @@
+import hashlib
+from typing import Iterable, Optional
+from clients.disk_cache import DiskCache
+
+DESCRIPTION_CACHE_PATH = "cache/descriptions.sqlite3"
+DESCRIPTION_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+DESCRIPTION_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+
+def image_digest(image) -> str:
+    """SHA-256 of the image content. `image` is a file path or the image bytes."""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(image).hexdigest()
+    digest = hashlib.sha256()
+    try:
+        with open(image, "rb") as image_file:
+            for block in iter(lambda: image_file.read(1024 * 1024), b""):
+                digest.update(block)
+    except OSError:
+        # Missing files are skipped by the client, they must not change the key either
+        return "missing"
+    return digest.hexdigest()
+
+
+def description_cache_key(
+    model: str,
+    system_prompt: str,
+    address: str,
+    infrastructure_text: str,
+    user_prompt: str,
+    image_digests: Iterable[str],
+    image_options: Optional[tuple] = None,
+    token_budget: Optional[tuple] = None,
+    max_tokens: Optional[int] = None,
+) -> str:
+    """
+    A stable hash of everything that goes into a description request.
+    The token budget decides which places and photos are sent and `max_tokens` caps the answer,
+    so they are part of the key too.
+    """
+    digest = hashlib.sha256()
+    parts = [
+        model, system_prompt, address, infrastructure_text, user_prompt,
+        repr(image_options), repr(token_budget), repr(max_tokens),
+    ]
+    parts.extend(image_digests)
+    for part in parts:
+        encoded = part.encode("utf-8")
+        # Length prefixes keep ("ab", "c") and ("a", "bc") apart
+        digest.update(len(encoded).to_bytes(8, "big"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class DescriptionCache(DiskCache):
+    """
+    Disk-backed cache of generated descriptions, keyed on description_cache_key().
+    The total size of the stored descriptions is bounded by `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        path: str = DESCRIPTION_CACHE_PATH,
+        ttl_seconds: Optional[float] = DESCRIPTION_CACHE_TTL_SECONDS,
+        max_bytes: Optional[int] = DESCRIPTION_CACHE_MAX_BYTES,
+    ):
+        super().__init__(path, ttl_seconds=ttl_seconds, max_bytes=max_bytes)
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, Optional
+
+
+class DiskCache:
+    """
+    A small key/value cache stored in a SQLite file.
+    Values are JSON-serialized. Entries older than `ttl_seconds` are treated as missing,
+    and once more than `max_entries` are stored, or the values take more than `max_bytes`,
+    the least recently used ones are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL,"
+            " size INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(cache)")]
+        if "size" not in columns:
+            # Cache files created before size accounting
+            self._conn.execute("ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("UPDATE cache SET size = length(CAST(value AS BLOB))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the cached value, or None if the key is missing or expired."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or self._is_expired(row[1], now):
+                if row is not None:
+                    self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        serialized = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created_at, accessed_at, size) VALUES (?, ?, ?, ?, ?)",
+                (key, serialized, now, now, len(serialized.encode("utf-8"))),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        if self.ttl_seconds is not None:
+            self._conn.execute("DELETE FROM cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        if self.max_entries is not None:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN ("
+                " SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        if self.max_bytes is not None:
+            total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            if total_bytes > self.max_bytes:
+                rows = self._conn.execute("SELECT key, size FROM cache ORDER BY accessed_at").fetchall()
+                evicted = []
+                for key, size in rows:
+                    if total_bytes <= self.max_bytes:
+                        break
+                    evicted.append((key,))
+                    total_bytes -= size
+                self._conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
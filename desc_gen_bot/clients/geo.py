@@ -0,0 +1,29 @@
+import math
+import numpy as np
+from typing import Dict, List
+
+EARTH_RADIUS_METERS = 6_371_000
+
+
+def haversine_meters(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in meters."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+def haversine_distances(origin: Dict[str, float], points: List[Dict[str, float]]) -> np.ndarray:
+    """
+    Great-circle distances in meters from the origin to every point, computed in one vectorized pass.
+    Points are {"lat": ..., "lon": ...} dicts, as returned by 2GIS.
+    """
+    if not points:
+        return np.empty(0)
+    coords = np.radians(np.array([(p["lat"], p["lon"]) for p in points], dtype=float))
+    lat0, lon0 = math.radians(origin["lat"]), math.radians(origin["lon"])
+    d_phi = coords[:, 0] - lat0
+    d_lambda = coords[:, 1] - lon0
+    a = np.sin(d_phi / 2) ** 2 + math.cos(lat0) * np.cos(coords[:, 0]) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
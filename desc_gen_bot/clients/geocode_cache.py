@@ -0,0 +1,70 @@
+import re
+from typing import Dict, Optional
+from clients.disk_cache import DiskCache
+
+GEOCODE_CACHE_PATH = "cache/geocode.sqlite3"
+# Buildings don't move, but 2GIS occasionally corrects coordinates
+GEOCODE_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+GEOCODE_CACHE_MAX_ENTRIES = 100_000
+# Bumped whenever normalize_address changes, so entries stored under the old keys are not reused
+GEOCODE_KEY_VERSION = 2
+
+# Full and abbreviated forms of address words are mapped to a single short form.
+# "пр." is left as it is: it stands for both проспект and проезд
+ADDRESS_ABBREVIATIONS = {
+    "город": "г", "г.": "г",
+    "улица": "ул", "ул.": "ул",
+    "дом": "д", "д.": "д",
+    "корпус": "к", "корп": "к", "корп.": "к", "к.": "к",
+    "строение": "стр", "стр.": "стр",
+    "проспект": "пр-т", "просп": "пр-т", "просп.": "пр-т", "пр-кт": "пр-т",
+    "переулок": "пер", "пер.": "пер",
+    "площадь": "пл", "пл.": "пл",
+    "шоссе": "ш", "ш.": "ш",
+    "бульвар": "б-р", "бул.": "б-р",
+    "набережная": "наб", "наб.": "наб",
+    "проезд": "пр-д",
+    "микрорайон": "мкр", "мкр.": "мкр",
+}
+
+
+def normalize_address(address: str) -> str:
+    """
+    Brings differently typed versions of the same address to one form:
+    "Москва, Улица  Тверская, дом 6" and "москва, ул. тверская, д. 6" both become "москва, ул тверская, д 6".
+    """
+    text = address.casefold().replace("ё", "е")
+    # Separate commas and glued abbreviations ("ул.тверская") into their own tokens
+    text = re.sub(r"\s*,\s*", " , ", text)
+    text = re.sub(r"(?<=\.)(?=[^\s.,])", " ", text)
+
+    tokens = []
+    for token in text.split():
+        tokens.append(ADDRESS_ABBREVIATIONS.get(token, token))
+
+    normalized = " ".join(tokens).replace(" , ", ", ")
+    return normalized.strip(" ,")
+
+
+class GeocodeCache(DiskCache):
+    """
+    Disk-backed cache of geocoding results, keyed on the normalized address.
+    """
+
+    def __init__(
+        self,
+        path: str = GEOCODE_CACHE_PATH,
+        ttl_seconds: Optional[float] = GEOCODE_CACHE_TTL_SECONDS,
+        max_entries: Optional[int] = GEOCODE_CACHE_MAX_ENTRIES,
+    ):
+        super().__init__(path, ttl_seconds=ttl_seconds, max_entries=max_entries)
+
+    @staticmethod
+    def _key(address: str) -> str:
+        return f"v{GEOCODE_KEY_VERSION}:{normalize_address(address)}"
+
+    def get_coordinates(self, address: str) -> Optional[Dict[str, float]]:
+        return self.get(self._key(address))
+
+    def set_coordinates(self, address: str, coordinates: Dict[str, float]) -> None:
+        self.set(self._key(address), coordinates)
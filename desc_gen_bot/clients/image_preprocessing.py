@@ -0,0 +1,105 @@
+import io
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional
+from PIL import Image, ImageOps
+from clients.metrics import track_stage
+
+# OpenAI scales high-detail images to fit 2048x2048 and then to 768px on the short side,
+# so anything larger than this only costs upload time
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1536"))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG")
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "80"))
+# Images that fit into a single 512px tile look the same to the model in "low" detail
+LOW_DETAIL_MAX_EDGE = 512
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+class PreparedImage(NamedTuple):
+    data: bytes
+    mime_type: str
+    detail: str
+
+
+class ImageOptions(NamedTuple):
+    max_edge: int = IMAGE_MAX_EDGE
+    image_format: str = IMAGE_FORMAT
+    quality: int = IMAGE_QUALITY
+
+
+def _read_source(source) -> bytes:
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, (bytearray, memoryview)):
+        return bytes(source)
+    with open(source, "rb") as image_file:
+        return image_file.read()
+
+
+def prepare_image(source, options: ImageOptions = ImageOptions()) -> Optional[PreparedImage]:
+    """
+    Downscales the image to `options.max_edge`, drops its metadata (EXIF included)
+    and re-encodes it. `source` is a file path or the image bytes.
+    Returns None if the image can't be read.
+    """
+    try:
+        raw = _read_source(source)
+    except FileNotFoundError:
+        print(f"Warning: Image file not found at {source}. Skipping.")
+        return None
+
+    try:
+        with Image.open(io.BytesIO(raw)) as image:
+            # Phone photos are often stored sideways with an EXIF rotation flag
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.thumbnail((options.max_edge, options.max_edge), Image.Resampling.LANCZOS)
+
+            output = io.BytesIO()
+            # No exif= argument, so the metadata is not written back
+            image.save(output, format=options.image_format, quality=options.quality, optimize=True)
+            detail = "low" if max(image.size) <= LOW_DETAIL_MAX_EDGE else "high"
+    except Exception as e:
+        # Not something Pillow can decode, send it as it is
+        print(f"Could not preprocess image, sending the original: {e}")
+        return PreparedImage(raw, "image/jpeg", "auto")
+
+    return PreparedImage(output.getvalue(), MIME_TYPES.get(options.image_format.upper(), "image/jpeg"), detail)
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def _shared_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # The bot runs threads (HTTP pools, SQLite, tiktoken), forking it could copy a held lock into a worker
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _executor
+
+
+async def prepare_images(sources: List, options: ImageOptions = ImageOptions()) -> List[PreparedImage]:
+    """
+    Prepares the images in a process pool, so resizing and encoding don't hold the event loop.
+    Images that can't be read are left out.
+    """
+    loop = asyncio.get_running_loop()
+    executor = _shared_executor()
+    with track_stage("image_encoding"):
+        prepared = await asyncio.gather(*(
+            loop.run_in_executor(executor, prepare_image, source, options) for source in sources
+        ))
+    return [image for image in prepared if image is not None]
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import asyncio
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# With METRICS_PORT set, Prometheus metrics are served on http://METRICS_HOST:METRICS_PORT/metrics,
+# otherwise a JSON summary is logged every METRICS_LOG_INTERVAL_SECONDS
+METRICS_PORT = os.environ.get("METRICS_PORT")
+# /metrics has no authentication, it is only reachable from this machine unless METRICS_HOST
+# is set to a public address (e.g. 0.0.0.0 for a scraper in another container)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_LOG_INTERVAL_SECONDS = float(os.environ.get("METRICS_LOG_INTERVAL_SECONDS", "60"))
+METRIC_PREFIX = "desc_gen_"
+# Stages range from cache lookups (milliseconds) to completions (a minute and more)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        # The last slot counts the observations above the largest bucket
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """Stage latency histograms labeled by stage and outcome, and plain labeled counters."""
+
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, outcome: str = "ok") -> None:
+        with self._lock:
+            histogram = self._histograms.get((stage, outcome))
+            if histogram is None:
+                histogram = self._histograms[(stage, outcome)] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            stages = {}
+            for (stage, outcome), histogram in sorted(self._histograms.items()):
+                stages.setdefault(stage, {})[outcome] = {
+                    "count": histogram.count,
+                    "avg": round(histogram.sum / histogram.count, 4),
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "p99": histogram.quantile(0.99),
+                }
+            counters = {
+                name + "".join(f",{label}={value}" for label, value in labels): amount
+                for (name, labels), amount in sorted(self._counters.items())
+            }
+        return {"stages": stages, "counters": counters}
+
+    def render_prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format."""
+        name = f"{METRIC_PREFIX}stage_duration_seconds"
+        lines = [
+            f"# HELP {name} Duration of a pipeline stage.",
+            f"# TYPE {name} histogram",
+        ]
+        with self._lock:
+            for (stage, outcome), histogram in sorted(self._histograms.items()):
+                labels = f'stage="{stage}",outcome="{outcome}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+            typed = set()
+            for (counter, labels), amount in sorted(self._counters.items()):
+                full_name = METRIC_PREFIX + counter
+                if full_name not in typed:
+                    lines.append(f"# TYPE {full_name} counter")
+                    typed.add(full_name)
+                label_text = ",".join(f'{label}="{value}"' for label, value in labels)
+                lines.append(f"{full_name}{{{label_text}}} {amount}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class StageTimer:
+    __slots__ = ("stage", "outcome")
+
+    def __init__(self, stage: str, outcome: str):
+        self.stage = stage
+        # Can be changed inside the block, e.g. to "cache_hit" or "error"
+        self.outcome = outcome
+
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[StageTimer]:
+    """
+    Times the block and records it under `stage`.
+    The outcome is "ok" unless changed on the yielded timer, "error" if the block raises
+    and "cancelled" if it is cancelled or abandoned.
+    """
+    timer = StageTimer(stage, "ok")
+    started = time.perf_counter()
+    try:
+        yield timer
+    except (asyncio.CancelledError, GeneratorExit):
+        timer.outcome = "cancelled"
+        raise
+    except BaseException:
+        timer.outcome = "error"
+        raise
+    finally:
+        registry.observe(stage, time.perf_counter() - started, timer.outcome)
+
+
+def increment(name: str, amount: float = 1, **labels: str) -> None:
+    registry.increment(name, amount, **labels)
+
+
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        # Headers are not needed, but have to be read before answering
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", registry.render_prometheus().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def _log_metrics_periodically(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("metrics %s", json.dumps(registry.snapshot(), ensure_ascii=False))
+
+
+_server: Optional[asyncio.AbstractServer] = None
+_log_task: Optional[asyncio.Task] = None
+
+
+async def start_metrics_reporting(port: Optional[str] = METRICS_PORT, host: str = METRICS_HOST) -> None:
+    """Serves /metrics if a port is configured, otherwise starts logging JSON summaries."""
+    global _server, _log_task
+    if port:
+        _server = await asyncio.start_server(_handle_metrics_request, host, int(port))
+        logger.info("Metrics are served on http://%s:%s/metrics", host, port)
+    else:
+        _log_task = asyncio.create_task(_log_metrics_periodically(METRICS_LOG_INTERVAL_SECONDS))
+
+
+async def stop_metrics_reporting() -> None:
+    global _server, _log_task
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
+    if _log_task is not None:
+        _log_task.cancel()
+        _log_task = None
+    # The last summary, so short runs are not lost
+    logger.info("metrics %s", json.dumps(registry.snapshot(), ensure_ascii=False))
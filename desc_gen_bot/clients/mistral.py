@@ -1,6 +1,8 @@
 from mistralai import Mistral
 from telegram import Update
 from telegram.ext import ContextTypes
+from typing import Any, AsyncIterator, Dict, List, Optional
+from clients.metrics import track_stage
 import os
 
 # можно тестить, но без фанатизма
@@ -59,4 +61,72 @@ def req_final_description(user_id, user_steps):
         ]
     )
 
-    return chat_response.choices[0].message.content
\ No newline at end of file
+    return chat_response.choices[0].message.content
+
+# Multimodal, takes the same messages as the OpenAI description request
+DESCRIPTION_MODEL = os.environ.get("MISTRAL_DESCRIPTION_MODEL", "mistral-medium-latest")
+REQUEST_TIMEOUT_MS = 180_000
+
+
+class MistralClient:
+    """
+    Generates property descriptions with Mistral, with the same interface as OpenAIClient.
+    The request is the one `request_builder` (an OpenAIClient) would send to OpenAI,
+    so the prompt, the photos and the token budget are the same for both providers.
+    complete_prepared and stream_prepared take a request the builder has already prepared.
+    """
+
+    def __init__(self, request_builder, api_key: Optional[str] = MISTRAL_API_KEY, model: str = DESCRIPTION_MODEL, server_url: Optional[str] = None):
+        if not api_key:
+            raise ValueError("Mistral API key is required.")
+        self.client = Mistral(api_key=api_key, server_url=server_url, timeout_ms=REQUEST_TIMEOUT_MS)
+        self.request_builder = request_builder
+        self.model = model
+
+    def _params(self, prepared) -> Dict[str, Any]:
+        return {"model": self.model, "messages": prepared.params["messages"], "max_tokens": prepared.params["max_tokens"]}
+
+    async def create_description_async(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+        use_cache: bool = False,
+        raise_errors: bool = False,
+    ) -> str:
+        """Mistral answers are not cached, `use_cache` is only there for the common interface."""
+        prepared = await self.request_builder.prepare_request(user_prompt, infrastructure_summary, image_paths, address)
+        return await self.complete_prepared(prepared, raise_errors=raise_errors)
+
+    async def complete_prepared(self, prepared, raise_errors: bool = False) -> str:
+        try:
+            with track_stage("mistral"):
+                response = await self.client.chat.complete_async(**self._params(prepared))
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            if raise_errors:
+                raise
+            print(f"An error occurred with the Mistral API: {e}")
+            return f"Error: Could not generate description. {e}"
+
+    async def stream_description(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+        use_cache: bool = False,
+    ) -> AsyncIterator[str]:
+        prepared = await self.request_builder.prepare_request(user_prompt, infrastructure_summary, image_paths, address)
+        async for piece in self.stream_prepared(prepared):
+            yield piece
+
+    async def stream_prepared(self, prepared) -> AsyncIterator[str]:
+        with track_stage("mistral"):
+            stream = await self.client.chat.stream_async(**self._params(prepared))
+            async with stream:
+                async for event in stream:
+                    choices = event.data.choices
+                    if choices and isinstance(choices[0].delta.content, str) and choices[0].delta.content:
+                        yield choices[0].delta.content
@@ -1,9 +1,105 @@
 import os
+import time
 import base64
-from openai import OpenAI
-from typing import List, Dict, Any
+import asyncio
+import logging
+import threading
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
+from typing import List, Dict, Any, NamedTuple, Optional, AsyncIterator, Tuple
+from clients.image_preprocessing import ImageOptions, PreparedImage, prepare_image, prepare_images
+from clients.description_cache import DescriptionCache, description_cache_key, image_digest
+from clients.metrics import increment, registry, track_stage
+from clients.token_budget import BudgetPlan, TokenBudget, log_plan, output_token_cap, plan_request
 
 MODEL_NAME = "gpt-4o-mini"
+# Output cap of requests sent without a token budget
+MAX_TOKENS = 15000
+
+# Limits shared by every OpenAIClient in the process
+MAX_CONCURRENT_GENERATIONS = int(os.environ.get("OPENAI_MAX_CONCURRENT_GENERATIONS", "8"))
+MAX_CONNECTIONS = 20
+# Vision completions with many images routinely take up to a minute
+REQUEST_TIMEOUT_SECONDS = 180
+# Same as the SDK default
+DEFAULT_MAX_RETRIES = 2
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+_async_http_client: Optional[httpx.AsyncClient] = None
+_generation_semaphore: Optional[asyncio.Semaphore] = None
+
+logger = logging.getLogger(__name__)
+
+
+def _shared_async_http_client() -> httpx.AsyncClient:
+    """One pooled HTTP client for all async OpenAI requests of the process."""
+    global _async_http_client
+    if _async_http_client is None:
+        _async_http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT_SECONDS, connect=5.0),
+        )
+    return _async_http_client
+
+
+def _shared_generation_semaphore() -> asyncio.Semaphore:
+    global _generation_semaphore
+    if _generation_semaphore is None:
+        _generation_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+    return _generation_semaphore
+
+
+async def close_shared_http_client() -> None:
+    global _async_http_client
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+        _async_http_client = None
+
+class PreparedRequest(NamedTuple):
+    """
+    A description request with its photos preprocessed and its cache key computed, done once
+    and sent to any provider (see prepare_request).
+    """
+    params: Dict[str, Any]
+    plan: Optional[BudgetPlan]
+    cache_key: Optional[str]
+
+
+class UsageStats:
+    """
+    Token usage accumulated over the completions of one client.
+    `cached_prompt_tokens` are the prompt tokens served from the provider's prompt cache.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, usage) -> None:
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += usage.prompt_tokens
+            self.cached_prompt_tokens += cached_tokens
+            self.completion_tokens += usage.completion_tokens
+        increment("openai_tokens_total", usage.prompt_tokens - cached_tokens, kind="prompt_uncached")
+        increment("openai_tokens_total", cached_tokens, kind="prompt_cached")
+        increment("openai_tokens_total", usage.completion_tokens, kind="completion")
+        logger.info(
+            "OpenAI usage: prompt=%d (cached=%d, uncached=%d) completion=%d",
+            usage.prompt_tokens, cached_tokens, usage.prompt_tokens - cached_tokens, usage.completion_tokens,
+        )
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        return self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
 
 class OpenAIClient:
     """
@@ -11,11 +107,36 @@ class OpenAIClient:
     It combines user text, infrastructure data, and images to create a compelling description.
     """
 
-    def __init__(self, api_key: str, prompt_path: str = "prompt.txt"):
+    def __init__(
+        self,
+        api_key: str,
+        prompt_path: str = "prompt.txt",
+        image_options: Optional[ImageOptions] = ImageOptions(),
+        description_cache: Optional[DescriptionCache] = None,
+        base_url: Optional[str] = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        token_budget: Optional[TokenBudget] = TokenBudget(),
+    ):
+        """
+        `image_options` controls how photos are downscaled and re-encoded before upload,
+        None sends the original files.
+        `description_cache` stores finished descriptions, it is used by calls made with use_cache=True.
+        `base_url` points the client to another OpenAI-compatible server (default: OPENAI_BASE_URL or the OpenAI API).
+        `max_retries` is how often the SDK retries rate limits, timeouts and server errors, with backoff.
+        `token_budget` trims places and photos to fit the prompt budget and caps the output,
+        None sends everything with MAX_TOKENS.
+        """
         if not api_key:
             raise ValueError("OpenAI API key is required.")
-        self.client = OpenAI(api_key=api_key)
+        self.client = OpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries)
+        self.async_client = AsyncOpenAI(
+            api_key=api_key, base_url=base_url, max_retries=max_retries, http_client=_shared_async_http_client()
+        )
         self.system_prompt = self._load_prompt(prompt_path)
+        self.image_options = image_options
+        self.usage = UsageStats()
+        self.description_cache = description_cache
+        self.token_budget = token_budget
 
     @staticmethod
     def _load_prompt(file_path: str) -> str:
@@ -31,17 +152,45 @@ class OpenAIClient:
             return "You are a helpful assistant."
 
     @staticmethod
-    def _encode_image_to_base64(image_path: str) -> str:
-        """Encodes a single image file to a base64 string."""
+    def _read_original_image(image_path) -> Optional[PreparedImage]:
+        """Reads an image file without any preprocessing. Image bytes are passed through."""
+        if isinstance(image_path, bytes):
+            return PreparedImage(image_path, "image/jpeg", "auto")
+        if isinstance(image_path, (bytearray, memoryview)):
+            return PreparedImage(bytes(image_path), "image/jpeg", "auto")
         try:
             with open(image_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
+                return PreparedImage(image_file.read(), "image/jpeg", "auto")
         except FileNotFoundError:
             print(f"Warning: Image file not found at {image_path}. Skipping.")
-            return ""
         except Exception as e:
-            print(f"Error encoding image {image_path}: {e}")
-            return ""
+            print(f"Error reading image {image_path}: {e}")
+        return None
+
+    def _prepare_images(self, image_paths: List[str]) -> List[PreparedImage]:
+        with track_stage("image_encoding"):
+            if self.image_options is None:
+                images = [self._read_original_image(path) for path in image_paths]
+            else:
+                images = [prepare_image(path, self.image_options) for path in image_paths]
+        return [image for image in images if image is not None]
+
+    async def _prepare_images_async(self, image_paths: List[str]) -> List[PreparedImage]:
+        if self.image_options is None:
+            return await asyncio.to_thread(self._prepare_images, image_paths)
+        # Resizing and encoding are CPU-bound, they run in a process pool
+        return await prepare_images(image_paths, self.image_options)
+
+    @staticmethod
+    def _image_content(image: PreparedImage) -> Dict[str, Any]:
+        base64_image = base64.b64encode(image.data).decode('utf-8')
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{image.mime_type};base64,{base64_image}",
+                "detail": image.detail,
+            }
+        }
 
     def _format_infrastructure_prompt(self, summary: Dict[str, List[Dict[str, Any]]]) -> str:
         """Formats the infrastructure dictionary into a human-readable string for the LLM."""
@@ -59,21 +208,21 @@ class OpenAIClient:
         
         return "\n".join(prompt_parts)
 
-    def create_description(
+    def _build_content(
         self,
         user_prompt: str,
         infrastructure_summary: Dict[str, List[Dict[str, Any]]],
-        image_paths: List[str],
+        images: List[PreparedImage],
         address: str,
-    ) -> str:
+    ) -> List[Dict[str, Any]]:
         """
-        Generates a property description by combining text, infrastructure data, and images.
+        Builds the per-listing user message content: text parts first, then the images.
+        The static instructions are not part of it, they go into the system message.
         """
         infrastructure_text = self._format_infrastructure_prompt(infrastructure_summary)
-        
+
         # --- Build the message content ---
         content = [
-            {"type": "text", "text": self.system_prompt},
             {"type": "text", "text": f"АДРЕС ОБЪЕКТА: {address}"},
             {"type": "text", "text": "ДЕТАЛИ ОТ ПОЛЬЗОВАТЕЛЯ:\n" + user_prompt},
             {"type": "text", "text": infrastructure_text},
@@ -81,30 +230,253 @@ class OpenAIClient:
         ]
 
         # --- Add images ---
-        for image_path in image_paths:
-            base64_image = self._encode_image_to_base64(image_path)
-            if base64_image:
-                content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}"
-                    }
-                })
+        for image in images:
+            content.append(self._image_content(image))
+        return content
+
+    def _completion_params(self, content: List[Dict[str, Any]], max_tokens: int = MAX_TOKENS) -> Dict[str, Any]:
+        # The system prompt is the same for every request and comes first, so the
+        # provider's automatic prompt caching can reuse it. Everything that changes
+        # per listing comes after it.
+        return {
+            "model": MODEL_NAME,
+            "messages": [
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": content},
+            ],
+            "max_tokens": max_tokens,
+        }
+
+    def _request_params(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        images: List[PreparedImage],
+        address: str,
+    ) -> Tuple[Dict[str, Any], Optional[BudgetPlan]]:
+        """Completion params for one listing, trimmed to the token budget, and the budget plan."""
+        if self.token_budget is None:
+            return self._completion_params(self._build_content(user_prompt, infrastructure_summary, images, address)), None
+        plan = plan_request(
+            self.token_budget, self.system_prompt, infrastructure_summary, images,
+            lambda summary: self._build_content(user_prompt, summary, [], address),
+        )
+        content = self._build_content(user_prompt, plan.infrastructure_summary, plan.images, address)
+        return self._completion_params(content, plan.max_tokens), plan
+
+    def _cache_key(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+    ) -> Optional[str]:
+        if self.description_cache is None:
+            return None
+        return description_cache_key(
+            model=MODEL_NAME,
+            system_prompt=self.system_prompt,
+            address=address,
+            infrastructure_text=self._format_infrastructure_prompt(infrastructure_summary),
+            user_prompt=user_prompt,
+            image_digests=[image_digest(image) for image in image_paths],
+            image_options=self.image_options,
+            token_budget=self.token_budget,
+            max_tokens=MAX_TOKENS if self.token_budget is None else output_token_cap(self.token_budget.target_chars),
+        )
+
+    async def _cache_key_async(self, *args) -> Optional[str]:
+        # Hashing the photos reads and digests megabytes of data
+        return await asyncio.to_thread(self._cache_key, *args)
+
+    async def request_cache_key(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+    ) -> Optional[str]:
+        """Description cache key of a request, None without a description cache."""
+        if self.description_cache is None:
+            return None
+        return await self._cache_key_async(user_prompt, infrastructure_summary, image_paths, address)
+
+    async def prepare_request(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+        cache_key: Optional[str] = None,
+    ) -> PreparedRequest:
+        """
+        Preprocesses the photos and builds the request once, for complete_prepared and stream_prepared
+        of any provider. A description generated with a `cache_key` is stored under it.
+        """
+        images = await self._prepare_images_async(image_paths)
+        params, plan = self._request_params(user_prompt, infrastructure_summary, images, address)
+        return PreparedRequest(params, plan, cache_key)
+
+    def cached_description(self, cache_key: Optional[str]) -> Optional[str]:
+        """The description cached under `cache_key` (see request_cache_key), without generating anything."""
+        if cache_key is None:
+            return None
+        description = self.description_cache.get(cache_key)
+        increment("description_cache_total", outcome="hit" if description is not None else "miss")
+        return description
+
+    def _remember_description(self, cache_key: Optional[str], description: str) -> str:
+        if cache_key is not None and description:
+            self.description_cache.set(cache_key, description)
+        return description
+
+    def create_description(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+        use_cache: bool = False,
+    ) -> str:
+        """
+        Generates a property description by combining text, infrastructure data, and images.
+        `image_paths` may hold file paths or image bytes already in memory.
+        With `use_cache` an identical earlier request is answered from the description cache.
+        """
+        cache_key = self._cache_key(user_prompt, infrastructure_summary, image_paths, address) if use_cache else None
+        cached = self.cached_description(cache_key)
+        if cached is not None:
+            return cached
+
+        images = self._prepare_images(image_paths)
+        params, plan = self._request_params(user_prompt, infrastructure_summary, images, address)
 
         try:
-            response = self.client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[{
-                    "role": "user",
-                    "content": content
-                }],
-                max_tokens=15000,
-            )
-            return response.choices[0].message.content.strip()
+            with track_stage("openai"):
+                response = self.client.chat.completions.create(**params)
+            self.usage.record(response.usage)
+            log_plan(plan, response.usage)
+            return self._remember_description(cache_key, response.choices[0].message.content.strip())
         except Exception as e:
             print(f"An error occurred with the OpenAI API: {e}")
             return f"Error: Could not generate description. {e}"
 
+    async def create_description_async(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+        use_cache: bool = False,
+        raise_errors: bool = False,
+    ) -> str:
+        """
+        Same as create_description, but doesn't block the event loop.
+        At most MAX_CONCURRENT_GENERATIONS completions run at once across the process.
+        With `raise_errors` API errors are raised instead of being returned as the description.
+        """
+        cache_key = await self.request_cache_key(user_prompt, infrastructure_summary, image_paths, address) if use_cache else None
+        cached = self.cached_description(cache_key)
+        if cached is not None:
+            return cached
+        prepared = await self.prepare_request(user_prompt, infrastructure_summary, image_paths, address, cache_key)
+        return await self.complete_prepared(prepared, raise_errors=raise_errors)
+
+    async def complete_prepared(self, prepared: PreparedRequest, raise_errors: bool = False) -> str:
+        """Generates the description of a request built by prepare_request."""
+        try:
+            async with _shared_generation_semaphore():
+                with track_stage("openai"):
+                    response = await self.async_client.chat.completions.create(**prepared.params)
+            self.usage.record(response.usage)
+            log_plan(prepared.plan, response.usage)
+            return self._remember_description(prepared.cache_key, response.choices[0].message.content.strip())
+        except Exception as e:
+            if raise_errors:
+                raise
+            print(f"An error occurred with the OpenAI API: {e}")
+            return f"Error: Could not generate description. {e}"
+
+    async def create_batch_request(
+        self,
+        custom_id: str,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+    ) -> Dict[str, Any]:
+        """
+        One line of a Batch API input file: the same request create_description would send.
+        The completion comes back in the batch output under `custom_id`.
+        """
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": await self.build_request(user_prompt, infrastructure_summary, image_paths, address),
+        }
+
+    async def build_request(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+    ) -> Dict[str, Any]:
+        """
+        Chat completion params create_description would send: model, messages and max_tokens.
+        Other OpenAI-compatible providers reuse the messages.
+        """
+        prepared = await self.prepare_request(user_prompt, infrastructure_summary, image_paths, address)
+        return prepared.params
+
+    async def stream_description(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+        use_cache: bool = False,
+    ) -> AsyncIterator[str]:
+        """
+        Streaming variant of create_description_async: yields pieces of the description
+        as the model produces them. API errors are raised to the caller.
+        A cached description is yielded in one piece.
+        """
+        cache_key = await self.request_cache_key(user_prompt, infrastructure_summary, image_paths, address) if use_cache else None
+        cached = self.cached_description(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        prepared = await self.prepare_request(user_prompt, infrastructure_summary, image_paths, address, cache_key)
+        async for piece in self.stream_prepared(prepared):
+            yield piece
+
+    async def stream_prepared(self, prepared: PreparedRequest) -> AsyncIterator[str]:
+        """Streams the description of a request built by prepare_request. API errors are raised."""
+        async with _shared_generation_semaphore():
+            with track_stage("openai"):
+                started = time.perf_counter()
+                stream = await self.async_client.chat.completions.create(
+                    **prepared.params,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                parts = []
+                async for chunk in stream:
+                    # The last chunk has no choices, only the usage of the whole request
+                    if chunk.usage is not None:
+                        self.usage.record(chunk.usage)
+                        log_plan(prepared.plan, chunk.usage)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if not parts:
+                            registry.observe("openai_first_token", time.perf_counter() - started)
+                        parts.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+
+        # Only a stream that ran to the end is cached
+        self._remember_description(prepared.cache_key, "".join(parts).strip())
+
     # # For this real test, we need both API keys
     # OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
     # TWOGIS_API_KEY = os.environ.get("TWOGIS_API_KEY")
@@ -0,0 +1,123 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from clients.geo import haversine_meters
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+# Precision 7 tiles are about 153 x 153 m, roughly one city block
+PLACES_CACHE_PRECISION = 7
+PLACES_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+PLACES_CACHE_MAX_ENTRIES = 20_000
+
+
+def geohash_encode(lat: float, lon: float, precision: int = PLACES_CACHE_PRECISION) -> str:
+    """Encodes coordinates into a geohash string of the given length."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value, value_range = (lon, lon_range) if even else (lat, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = (bits << 1) | 1
+            value_range[0] = middle
+        else:
+            bits = bits << 1
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def geohash_bounds(geohash: str) -> Tuple[float, float, float, float]:
+    """Returns (lat_min, lat_max, lon_min, lon_max) of the geohash tile."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        bits = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lon_range if even else lat_range
+            middle = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = middle
+            else:
+                value_range[1] = middle
+            even = not even
+    return lat_range[0], lat_range[1], lon_range[0], lon_range[1]
+
+
+class PlacesTile:
+    """
+    A geohash tile around a search origin.
+    A search from the tile center with radius + `margin_meters` covers the search circle
+    of every point inside the tile, so its results can be reused for all of them.
+    """
+
+    def __init__(self, geohash: str):
+        lat_min, lat_max, lon_min, lon_max = geohash_bounds(geohash)
+        self.geohash = geohash
+        self.center = {"lat": (lat_min + lat_max) / 2, "lon": (lon_min + lon_max) / 2}
+        self.margin_meters = math.ceil(haversine_meters(self.center["lat"], self.center["lon"], lat_max, lon_max))
+
+
+class PlacesCache:
+    """
+    In-memory cache of raw places search results, keyed on geohash tile, query and radius.
+    Entries expire after `ttl_seconds`, the least recently used are evicted beyond `max_entries`.
+    """
+
+    def __init__(
+        self,
+        precision: int = PLACES_CACHE_PRECISION,
+        ttl_seconds: Optional[float] = PLACES_CACHE_TTL_SECONDS,
+        max_entries: int = PLACES_CACHE_MAX_ENTRIES,
+    ):
+        self.precision = precision
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, str, int], Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def tile_for(self, coords: Dict[str, float]) -> PlacesTile:
+        return PlacesTile(geohash_encode(coords["lat"], coords["lon"], self.precision))
+
+    def get(self, tile: PlacesTile, query: str, radius_meters: int) -> Optional[List[Dict[str, Any]]]:
+        """Returns copies of the cached places, or None on a miss."""
+        key = (tile.geohash, query, radius_meters)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl_seconds is not None and time.time() - entry[0] > self.ttl_seconds):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # Callers annotate places with per-origin distances, so they get their own dicts
+        return [dict(place) for place in entry[1]]
+
+    def set(self, tile: PlacesTile, query: str, radius_meters: int, places: List[Dict[str, Any]]) -> None:
+        key = (tile.geohash, query, radius_meters)
+        with self._lock:
+            self._entries[key] = (time.time(), [dict(place) for place in places])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
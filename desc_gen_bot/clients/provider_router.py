@@ -0,0 +1,269 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+from clients.metrics import increment
+
+# Providers in order of preference until their latencies are known
+DESCRIPTION_PROVIDERS = [name.strip() for name in os.environ.get("DESCRIPTION_PROVIDERS", "openai,mistral").split(",") if name.strip()]
+# The next provider is asked when the current one takes longer than this percentile of its latency
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0.9"))
+# Hedge delay until HEDGE_MIN_SAMPLES latencies of the primary are known
+HEDGE_DELAY_SECONDS = float(os.environ.get("HEDGE_DELAY_SECONDS", "30"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+EWMA_ALPHA = 0.3
+# Keeps the expected latency of a provider that fails most of the time finite
+MIN_SUCCESS_RATE = 0.05
+# Every PROBE_EVERY-th request goes to the runner-up first, so a provider that got faster
+# again is measured and can win its place back
+PROBE_EVERY = 10
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderStats:
+    """
+    Latency and error rate of one provider as EWMAs, and its recent latencies for the hedge delay.
+    Streaming requests are tracked apart, by the time to the first piece.
+    """
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, seconds: float) -> None:
+        self.latency = seconds if self.latency is None else self.latency + EWMA_ALPHA * (seconds - self.latency)
+        self.error_rate -= EWMA_ALPHA * self.error_rate
+        self.recent.append(seconds)
+
+    def record_censored(self, seconds: float) -> None:
+        """A request cancelled after `seconds`: it would have taken at least that long."""
+        if self.latency is None or seconds > self.latency:
+            self.latency = seconds if self.latency is None else self.latency + EWMA_ALPHA * (seconds - self.latency)
+            self.recent.append(seconds)
+
+    def record_error(self) -> None:
+        self.error_rate += EWMA_ALPHA * (1 - self.error_rate)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self.recent) < HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self.recent)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    @property
+    def expected_latency(self) -> float:
+        """Seconds until a good answer, counting retries after errors."""
+        if self.latency is None:
+            return float("inf")
+        return self.latency / max(MIN_SUCCESS_RATE, 1 - self.error_rate)
+
+
+class ProviderRouter:
+    """
+    Generates descriptions with several providers behind one interface.
+    The provider with the lowest expected latency goes first. If it hasn't answered after
+    HEDGE_PERCENTILE of its latencies, the next one is asked too, the first good answer
+    wins and the other request is cancelled. A provider that fails is replaced right away.
+    `request_builder` (an OpenAIClient) looks up the description cache and prepares the request,
+    photos included, once; every provider gets that request: complete_prepared(prepared, raise_errors)
+    and stream_prepared(prepared).
+    """
+
+    def __init__(
+        self,
+        providers: Dict[str, Any],
+        request_builder,
+        hedge_percentile: float = HEDGE_PERCENTILE,
+        hedge_delay: float = HEDGE_DELAY_SECONDS,
+    ):
+        if not providers:
+            raise ValueError("At least one provider is required.")
+        self.providers = providers
+        self.request_builder = request_builder
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.stats = {name: ProviderStats() for name in providers}
+        self.stream_stats = {name: ProviderStats() for name in providers}
+        self._requests = 0
+
+    def ranked(self, stats: Dict[str, ProviderStats]) -> List[str]:
+        """Providers from the fastest expected one, unmeasured ones in configuration order."""
+        order = list(self.providers)
+        return sorted(order, key=lambda name: (stats[name].expected_latency, stats[name].error_rate, order.index(name)))
+
+    def _probe(self, ranked: List[str]) -> List[str]:
+        self._requests += 1
+        if len(ranked) > 1 and self._requests % PROBE_EVERY == 0:
+            return [ranked[1], ranked[0]] + ranked[2:]
+        return list(ranked)
+
+    def _hedge_delay(self, stats: ProviderStats) -> float:
+        delay = stats.percentile(self.hedge_percentile)
+        return self.hedge_delay if delay is None else delay
+
+    @staticmethod
+    async def _timed(name: str, attempt: Awaitable, stats: ProviderStats):
+        started = time.perf_counter()
+        try:
+            result = await attempt
+        except asyncio.CancelledError:
+            # Mostly a hedge that lost: without this sample a slow provider would never be measured again
+            stats.record_censored(time.perf_counter() - started)
+            increment("provider_requests_total", provider=name, outcome="cancelled")
+            raise
+        except Exception:
+            stats.record_error()
+            increment("provider_requests_total", provider=name, outcome="error")
+            raise
+        stats.record(time.perf_counter() - started)
+        increment("provider_requests_total", provider=name, outcome="ok")
+        return result
+
+    async def _hedged(self, attempt: Callable[[str], Awaitable], stats: Dict[str, ProviderStats]) -> Tuple[str, Any]:
+        """Runs `attempt` with the ranked providers, hedging and failing over, and returns the first good result."""
+        ranked = self.ranked(stats)
+        # The fastest provider's delay, also when the runner-up is probed first
+        hedge_delay = self._hedge_delay(stats[ranked[0]])
+        waiting = self._probe(ranked)
+        running: Dict[asyncio.Task, str] = {}
+        last_error: Optional[BaseException] = None
+
+        def start() -> None:
+            name = waiting.pop(0)
+            running[asyncio.create_task(self._timed(name, attempt(name), stats[name]))] = name
+
+        start()
+        try:
+            while running:
+                timeout = hedge_delay if waiting else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info("No answer after %.1fs, hedging with %s", timeout, waiting[0])
+                    increment("provider_hedges_total", provider=waiting[0])
+                    start()
+                    continue
+                results = [(running.pop(task), task.exception(), task) for task in done]
+                for name, error, task in results:
+                    if error is None:
+                        return name, task.result()
+                for name, error, _ in results:
+                    logger.warning("Description provider %s failed: %s", name, error)
+                    last_error = error
+                if not running and waiting:
+                    start()
+            raise last_error
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+    async def _cached(self, request: Dict[str, Any], use_cache: bool) -> Tuple[Optional[str], Optional[str]]:
+        """The cache key of the request and its cached description. Cache hits stay out of the latency stats."""
+        if not use_cache:
+            return None, None
+        cache_key = await self.request_builder.request_cache_key(**request)
+        return cache_key, self.request_builder.cached_description(cache_key)
+
+    async def generate_description(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+        use_cache: bool = False,
+        raise_errors: bool = False,
+    ) -> str:
+        """
+        Same as OpenAIClient.create_description_async, answered by the fastest provider.
+        With `raise_errors` the error of the last provider is raised when all of them fail.
+        """
+        request = dict(
+            user_prompt=user_prompt,
+            infrastructure_summary=infrastructure_summary,
+            image_paths=image_paths,
+            address=address,
+        )
+        cache_key, cached = await self._cached(request, use_cache)
+        if cached is not None:
+            return cached
+
+        async def attempt(name: str) -> str:
+            description = await self.providers[name].complete_prepared(prepared, raise_errors=True)
+            if not description:
+                raise ValueError(f"{name} returned an empty description")
+            return description
+
+        try:
+            # Photos are preprocessed once, not again for a hedge or a failover
+            prepared = await self.request_builder.prepare_request(**request, cache_key=cache_key)
+            _, description = await self._hedged(attempt, self.stats)
+            return description
+        except Exception as e:
+            if raise_errors:
+                raise
+            print(f"An error occurred with all description providers: {e}")
+            return f"Error: Could not generate description. {e}"
+
+    async def stream_description(
+        self,
+        user_prompt: str,
+        infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+        image_paths: List[str],
+        address: str,
+        use_cache: bool = False,
+    ) -> AsyncIterator[str]:
+        """
+        Same as OpenAIClient.stream_description. Providers race to the first piece of the
+        description, the rest comes from the winner. Errors after that are raised to the caller.
+        """
+        request = dict(
+            user_prompt=user_prompt,
+            infrastructure_summary=infrastructure_summary,
+            image_paths=image_paths,
+            address=address,
+        )
+        cache_key, cached = await self._cached(request, use_cache)
+        if cached is not None:
+            yield cached
+            return
+        prepared = await self.request_builder.prepare_request(**request, cache_key=cache_key)
+
+        async def attempt(name: str) -> Tuple[AsyncIterator[str], str]:
+            pieces = self.providers[name].stream_prepared(prepared)
+            try:
+                return pieces, await pieces.__anext__()
+            except StopAsyncIteration:
+                raise ValueError(f"{name} returned an empty description") from None
+
+        name, (pieces, first_piece) = await self._hedged(attempt, self.stream_stats)
+        yield first_piece
+        try:
+            async for piece in pieces:
+                yield piece
+        except Exception:
+            self.stream_stats[name].record_error()
+            raise
+        finally:
+            await pieces.aclose()
+
+
+def description_router(openai_client, providers: List[str] = DESCRIPTION_PROVIDERS) -> ProviderRouter:
+    """
+    A router over `openai_client` and, with MISTRAL_API_KEY set, Mistral.
+    `providers` (DESCRIPTION_PROVIDERS) sets which of them are used and their initial order.
+    """
+    clients = {}
+    for name in providers:
+        if name == "openai":
+            clients[name] = openai_client
+        elif name == "mistral" and os.environ.get("MISTRAL_API_KEY"):
+            # mistralai is only needed with Mistral enabled
+            from clients.mistral import MistralClient
+            clients[name] = MistralClient(request_builder=openai_client)
+    return ProviderRouter(clients or {"openai": openai_client}, request_builder=openai_client)
@@ -0,0 +1,222 @@
+import io
+import os
+import math
+import logging
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from PIL import Image
+from clients.image_preprocessing import PreparedImage
+from clients.metrics import increment
+
+# Whole prompt (system prompt, listing text, infrastructure, photos) of one description in context
+# tokens, the default leaves room for the output in the 128k context of gpt-4o-mini
+INPUT_TOKEN_BUDGET = int(os.environ.get("OPENAI_INPUT_TOKEN_BUDGET", "120000"))
+# Only the nearest places of each category go into the prompt
+PLACES_PER_CATEGORY = int(os.environ.get("PLACES_PER_CATEGORY", "5"))
+# Intended description length, the output token cap is derived from it
+TARGET_DESCRIPTION_CHARS = int(os.environ.get("TARGET_DESCRIPTION_CHARS", "3000"))
+# Headroom over the target length for Markdown and slightly longer answers
+OUTPUT_TOKEN_MARGIN = 1.5
+
+# Tokenizer of the gpt-4o family
+TOKENIZER_ENCODING = "o200k_base"
+# Estimate for Russian text, used for the output cap and when tiktoken is not available
+CHARS_PER_TOKEN = 3
+# Every chat message is wrapped in a few service tokens, and the reply is primed with a few more
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+
+# Context tokens taken by an image: a base cost and a cost per 512px tile. "low" detail costs
+# the base only, other details are scaled to fit 2048x2048, then to 768px on the short side, and tiled.
+# gpt-4o-mini bills images at a multiple of this, but they take the same room in the context
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+# Assumed for images whose size can't be read: a typical 4:3 photo, 2x2 tiles
+DEFAULT_IMAGE_TILES = 4
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+_estimate_logged = False
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBudget(NamedTuple):
+    input_tokens: int = INPUT_TOKEN_BUDGET
+    places_per_category: int = PLACES_PER_CATEGORY
+    target_chars: int = TARGET_DESCRIPTION_CHARS
+
+
+class BudgetPlan(NamedTuple):
+    """What goes into one request after trimming, and the tokens it is expected to take."""
+    infrastructure_summary: Dict[str, List[Dict[str, Any]]]
+    images: List[PreparedImage]
+    input_tokens: int
+    max_tokens: int
+    dropped_places: int
+    downgraded_images: int
+    dropped_images: int
+
+
+def load_encoding() -> None:
+    """
+    Loads the tokenizer. Blocks: on a cold cache tiktoken downloads the encoding file
+    (without a timeout), set TIKTOKEN_CACHE_DIR to a pre-seeded directory to avoid that.
+    """
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if _encoding_loaded:
+            return
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+            logger.info("tiktoken encoding %s loaded, token counts are exact", TOKENIZER_ENCODING)
+        except Exception as e:
+            # Not installed, or the encoding file can't be downloaded
+            logger.warning("tiktoken is not available (%s), token counts are estimated from text length", e)
+        _encoding_loaded = True
+
+
+def preload_encoding() -> None:
+    """
+    Starts loading the tokenizer in a daemon thread, so neither the event loop nor the shutdown
+    waits for a download that hangs. Token counts are estimated until it is loaded.
+    """
+    threading.Thread(target=load_encoding, name="tiktoken-load", daemon=True).start()
+
+
+def count_tokens(text: str) -> int:
+    global _estimate_logged
+    # Never loads the encoding itself, that would block the event loop on the first request
+    encoding = _encoding
+    if encoding is None:
+        if not _estimate_logged:
+            _estimate_logged = True
+            logger.info("tiktoken encoding is not loaded, token counts are estimated from text length")
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def image_tokens(image: PreparedImage) -> int:
+    if image.detail == "low":
+        return IMAGE_BASE_TOKENS
+    try:
+        # Only the header is read
+        width, height = Image.open(io.BytesIO(image.data)).size
+    except Exception:
+        return IMAGE_BASE_TOKENS + DEFAULT_IMAGE_TILES * IMAGE_TILE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return IMAGE_BASE_TOKENS + math.ceil(width / 512) * math.ceil(height / 512) * IMAGE_TILE_TOKENS
+
+
+def output_token_cap(target_chars: int) -> int:
+    return math.ceil(target_chars / CHARS_PER_TOKEN * OUTPUT_TOKEN_MARGIN)
+
+
+def _chain_name(name: str) -> str:
+    return " ".join(name.casefold().replace("ё", "е").replace("«", "").replace("»", "").replace('"', "").split())
+
+
+def trim_places(
+    summary: Dict[str, List[Dict[str, Any]]], per_category: int
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Keeps the `per_category` nearest places of every category, with one branch per chain.
+    Places come sorted by distance, so the branch kept is the nearest one.
+    """
+    trimmed = {}
+    for category, places in summary.items():
+        kept, names = [], set()
+        for place in places:
+            name = _chain_name(str(place.get("name", "")))
+            if name and name in names:
+                continue
+            names.add(name)
+            kept.append(place)
+            if len(kept) == per_category:
+                break
+        trimmed[category] = kept
+    return trimmed
+
+
+def plan_request(
+    budget: TokenBudget,
+    system_prompt: str,
+    infrastructure_summary: Dict[str, List[Dict[str, Any]]],
+    images: List[PreparedImage],
+    build_content: Callable[[Dict[str, List[Dict[str, Any]]]], List[Dict[str, Any]]],
+) -> BudgetPlan:
+    """
+    Fits one request under `budget.input_tokens`. Photos outweigh the text by far, so while even
+    the nearest place of every category doesn't fit next to them, photos are switched to "low"
+    detail from the end, and only then dropped from the end, down to the first one.
+    Then as many places per category are kept as fit.
+    `build_content` builds the text parts of the user message for a trimmed summary.
+    """
+    fixed_tokens = count_tokens(system_prompt) + 2 * MESSAGE_OVERHEAD_TOKENS + REPLY_OVERHEAD_TOKENS
+    images = list(images)
+    image_costs = [image_tokens(image) for image in images]
+    text_tokens: Dict[int, int] = {}
+
+    def planned_tokens(per_category: int, image_count: int) -> int:
+        if per_category not in text_tokens:
+            parts = build_content(trim_places(infrastructure_summary, per_category))
+            text_tokens[per_category] = sum(count_tokens(part["text"]) for part in parts if part["type"] == "text")
+        return fixed_tokens + text_tokens[per_category] + sum(image_costs[:image_count])
+
+    image_count = len(images)
+    downgraded_images = 0
+    for index in reversed(range(image_count)):
+        if planned_tokens(1, image_count) <= budget.input_tokens:
+            break
+        if images[index].detail != "low":
+            images[index] = images[index]._replace(detail="low")
+            image_costs[index] = IMAGE_BASE_TOKENS
+            downgraded_images += 1
+    while image_count > 1 and planned_tokens(1, image_count) > budget.input_tokens:
+        image_count -= 1
+        logger.warning(
+            "Photo %d of %d dropped, the request doesn't fit the budget of %d tokens",
+            image_count + 1, len(images), budget.input_tokens,
+        )
+    per_category = max(1, budget.places_per_category)
+    while per_category > 1 and planned_tokens(per_category, image_count) > budget.input_tokens:
+        per_category -= 1
+    input_tokens = planned_tokens(per_category, image_count)
+    if input_tokens > budget.input_tokens:
+        logger.warning("Request takes ~%d tokens even trimmed, over the budget of %d", input_tokens, budget.input_tokens)
+
+    summary = trim_places(infrastructure_summary, per_category)
+
+    dropped_places = sum(len(places) for places in infrastructure_summary.values()) - sum(len(places) for places in summary.values())
+    dropped_images = len(images) - image_count
+    increment("prompt_items_dropped_total", dropped_places, kind="place")
+    increment("prompt_items_dropped_total", dropped_images, kind="image")
+    increment("prompt_images_downgraded_total", downgraded_images)
+    return BudgetPlan(
+        infrastructure_summary=summary,
+        images=images[:image_count],
+        input_tokens=input_tokens,
+        max_tokens=output_token_cap(budget.target_chars),
+        dropped_places=dropped_places,
+        downgraded_images=downgraded_images,
+        dropped_images=dropped_images,
+    )
+
+
+def log_plan(plan: Optional[BudgetPlan], usage) -> None:
+    """Planned against actual token counts of a finished completion."""
+    if plan is None or usage is None:
+        return
+    logger.info(
+        "Token budget: prompt planned=%d actual=%d, completion cap=%d actual=%d, dropped %d places, "
+        "%d photos in low detail, dropped %d photos",
+        plan.input_tokens, usage.prompt_tokens, plan.max_tokens, usage.completion_tokens,
+        plan.dropped_places, plan.downgraded_images, plan.dropped_images,
+    )
+    if usage.completion_tokens >= plan.max_tokens:
+        logger.warning("Description was cut at the output cap of %d tokens, raise TARGET_DESCRIPTION_CHARS", plan.max_tokens)
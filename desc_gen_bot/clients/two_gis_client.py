@@ -1,6 +1,15 @@
 import os
+import random
+import asyncio
+import httpx
 import requests
-from typing import List, Dict, Optional, Any
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import List, Dict, Optional, Any, Tuple
+from clients.geocode_cache import GeocodeCache
+from clients.places_cache import PlacesCache, PlacesTile
+from clients.geo import haversine_distances
+from clients.metrics import increment, track_stage
 
 INFRASTRUCTURE_CATEGORIES = {
     "Супермаркеты": "супермаркет",
@@ -12,6 +21,46 @@ INFRASTRUCTURE_CATEGORIES = {
     "Парки": "парк",
 }
 
+# 2GIS requests in flight at once in the whole process, all users together. One summary searches
+# every category at once, the default lets several summaries run side by side
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("TWOGIS_MAX_CONCURRENCY", str(8 * len(INFRASTRUCTURE_CATEGORIES))))
+
+# The synchronous Distance Matrix API accepts a limited number of points per request,
+# the origin included. Larger target lists are split into several requests.
+ROUTING_MAX_POINTS = 25
+
+# How distances to places are obtained:
+#   "routing"  - every candidate is sent to the Distance Matrix API
+#   "fast"     - candidates farther than the radius in a straight line are dropped before routing
+#   "straight" - no routing, great-circle distance
+#   "walking"  - no routing, great-circle distance times WALKING_DETOUR_FACTOR
+DISTANCE_MODES = ("routing", "fast", "straight", "walking")
+# Typical ratio between the street network distance and the straight line in a city
+WALKING_DETOUR_FACTOR = 1.3
+
+# HTTP settings. Connections are kept alive and shared, and there is a pool per API host.
+CONNECT_TIMEOUT_SECONDS = 3.05
+READ_TIMEOUT_SECONDS = 15
+CONNECTIONS_PER_HOST = 10
+MAX_RETRIES = 3
+# Retry n waits a random time up to BACKOFF_FACTOR * 2**n seconds
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# A longer Retry-After is not waited out in full, the request is inside a user's conversation
+RETRY_AFTER_MAX_SECONDS = 10
+# Can point to a local stand-in server, e.g. for the offline benchmarks
+CATALOG_API_URL = os.environ.get("TWOGIS_CATALOG_URL", "https://catalog.api.2gis.com/3.0/items")
+ROUTING_API_URL = os.environ.get("TWOGIS_ROUTING_URL", "https://routing.api.2gis.com/get_dist_matrix")
+
+
+class _CappedRetry(Retry):
+    """urllib3 Retry that waits at most RETRY_AFTER_MAX_SECONDS for a Retry-After."""
+
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        return min(retry_after, RETRY_AFTER_MAX_SECONDS) if retry_after is not None else None
+
+
 class TwoGisClient:
     """
     A client for interacting with the 2GIS API.
@@ -19,44 +68,124 @@ class TwoGisClient:
     search for nearby places within a specified radius, including the distance to them.
     """
 
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        routing_max_points: int = ROUTING_MAX_POINTS,
+        geocode_cache: Optional[GeocodeCache] = None,
+        places_cache: Optional[PlacesCache] = None,
+        distance_mode: str = "routing",
+        connect_timeout: float = CONNECT_TIMEOUT_SECONDS,
+        read_timeout: float = READ_TIMEOUT_SECONDS,
+        connections_per_host: int = CONNECTIONS_PER_HOST,
+        max_retries: int = MAX_RETRIES,
+        catalog_url: str = CATALOG_API_URL,
+        routing_url: str = ROUTING_API_URL,
+    ):
         if not api_key:
             raise ValueError("2GIS API key is required.")
+        if distance_mode not in DISTANCE_MODES:
+            raise ValueError(f"distance_mode must be one of {', '.join(DISTANCE_MODES)}.")
+        if routing_max_points < 2:
+            raise ValueError("routing_max_points must allow at least one target.")
         self.api_key = api_key
+        self.routing_max_points = routing_max_points
+        self.geocode_cache = geocode_cache
+        self.places_cache = places_cache
+        self.distance_mode = distance_mode
         # Note: geocode is a special endpoint, so we handle it separately
-        self.places_api_url = "https://catalog.api.2gis.com/3.0/items"
-        self.routing_api_url = "https://routing.api.2gis.com/get_dist_matrix"
+        self.places_api_url = catalog_url
+        self.routing_api_url = routing_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self._init_http(connections_per_host)
 
-    def _get_coordinates(self, address: str) -> Optional[Dict[str, float]]:
-        """
-        Converts a textual address to geographic coordinates (latitude and longitude).
-        """
-        params = {
+    def _init_http(self, connections_per_host: int) -> None:
+        retry = _CappedRetry(
+            total=self.max_retries,
+            backoff_factor=BACKOFF_FACTOR,
+            backoff_jitter=BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES,
+            # The Distance Matrix POST has no side effects, so it is safe to repeat
+            allowed_methods=frozenset({"GET", "POST"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        # urllib3 keeps a separate pool of pool_maxsize connections for each host
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=connections_per_host, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def close(self) -> None:
+        self._session.close()
+
+    # --- Request building and response parsing, shared by the sync and async clients ---
+
+    def _geocode_params(self, address: str) -> Dict[str, Any]:
+        return {
             "q": address,
             "key": self.api_key,
             "fields": "items.point",
         }
-        try:
-            # The geocode endpoint is a path under the main places API url
-            response = requests.get(f"{self.places_api_url}/geocode", params=params)
-            response.raise_for_status()
-            data = response.json()
-            if data.get("meta", {}).get("code") == 200 and data.get("result", {}).get("items"):
-                point = data["result"]["items"][0]["point"]
-                return {"lat": point["lat"], "lon": point["lon"]}
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching coordinates: {e}")
-        except (KeyError, IndexError) as e:
-            print(f"Could not parse coordinates from response: {e}")
+
+    @staticmethod
+    def _parse_coordinates(data: Dict[str, Any]) -> Optional[Dict[str, float]]:
+        if data.get("meta", {}).get("code") == 200 and data.get("result", {}).get("items"):
+            point = data["result"]["items"][0]["point"]
+            return {"lat": point["lat"], "lon": point["lon"]}
         return None
 
-    def _get_distances(self, start_point: Dict[str, float], places: List[Dict[str, Any]]) -> Dict[str, int]:
+    def _remember_coordinates(self, address: str, coordinates: Optional[Dict[str, float]]) -> Optional[Dict[str, float]]:
+        # Only successful lookups are cached, so a typo doesn't stick for the whole TTL
+        if coordinates is not None and self.geocode_cache is not None:
+            self.geocode_cache.set_coordinates(address, coordinates)
+        return coordinates
+
+    def _places_params(self, start_coords: Dict[str, float], query: str, radius_meters: int) -> Dict[str, Any]:
+        return {
+            "q": query,
+            "point": f"{start_coords['lon']},{start_coords['lat']}",
+            "radius": radius_meters,
+            "key": self.api_key,
+            "fields": "items.point,items.name,items.purpose_name,items.id",
+        }
+
+    @staticmethod
+    def _parse_places(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if data.get("meta", {}).get("code") == 200 and data.get("result", {}).get("items"):
+            return data["result"]["items"]
+        return []
+
+    def _cached_search(self, start_coords: Dict[str, float], query: str, radius_meters: int) -> Tuple[Optional[PlacesTile], Optional[List[Dict[str, Any]]]]:
         """
-        Calculates distances from a start point to a list of places using the Distance Matrix API.
+        Looks the search up in the places cache.
+        Returns the tile the search belongs to (None without a cache) and the cached places, if any.
         """
-        if not places:
-            return {}
+        if self.places_cache is None:
+            return None, None
+        tile = self.places_cache.tile_for(start_coords)
+        return tile, self.places_cache.get(tile, query, radius_meters)
+
+    @staticmethod
+    def _search_area(start_coords: Dict[str, float], radius_meters: int, tile: Optional[PlacesTile]) -> Tuple[Dict[str, float], int]:
+        # With a cache we search around the tile center, widened so the results are valid for the whole tile
+        if tile is None:
+            return start_coords, radius_meters
+        return tile.center, radius_meters + tile.margin_meters
 
+    def _remember_places(self, tile: Optional[PlacesTile], query: str, radius_meters: int, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        places = self._parse_places(data)
+        # 404 means the search went fine but nothing was found, which is worth remembering too
+        if tile is not None and data.get("meta", {}).get("code") in (200, 404):
+            self.places_cache.set(tile, query, radius_meters, places)
+        return places
+
+    def _distances_request(self, start_point: Dict[str, float], places: List[Dict[str, Any]]) -> Optional[Tuple[Dict[str, Any], List[str]]]:
+        """
+        Builds the Distance Matrix payload and the list of place ids in target order.
+        Returns None when there is nothing to route to.
+        """
         # The first point is our origin. The rest are destinations.
         points_payload = [{"lat": start_point["lat"], "lon": start_point["lon"]}]
         # Keep track of which place corresponds to which index in the payload
@@ -67,77 +196,163 @@ class TwoGisClient:
                 place_id_map.append(place["id"])
 
         if len(points_payload) <= 1:
-            return {}
+            return None
 
         payload = {
             "points": points_payload,
             "sources": [0],
             "targets": list(range(1, len(points_payload))),
         }
-        
-        headers = {"Content-Type": "application/json"}
-        params = {"key": self.api_key, "version": "2.0"}
-
-        try:
-            response = requests.post(self.routing_api_url, json=payload, headers=headers, params=params)
-            response.raise_for_status()
-            data = response.json()
-            
-            distances = {}
-            if "routes" in data:
-                # The routes are returned in the order of the targets
-                for i, route in enumerate(data["routes"]):
-                    place_id = place_id_map[i]
-                    if place_id and route.get("status") == "OK":
-                        distances[place_id] = route["distance"]
-                return distances
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching distances: {e}")
-        except (KeyError, IndexError) as e:
-            print(f"Could not parse distances from response: {e}")
-            
-        return {}
-    
-    def _find_nearby_with_distances(self, start_coords: Dict[str, float], query: str, radius_meters: int) -> List[Dict[str, Any]]:
+        return payload, place_id_map
+
+    def _routing_params(self) -> Dict[str, Any]:
+        return {"key": self.api_key, "version": "2.0"}
+
+    @staticmethod
+    def _parse_distances(data: Dict[str, Any], place_id_map: List[str]) -> Dict[str, int]:
+        distances = {}
+        if "routes" in data:
+            # The routes are returned in the order of the targets
+            for i, route in enumerate(data["routes"]):
+                place_id = place_id_map[i]
+                if place_id and route.get("status") == "OK":
+                    distances[place_id] = route["distance"]
+        return distances
+
+    @staticmethod
+    def _merge_places(places_by_category: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
         """
-        Internal method to find places using coordinates and calculate distances.
+        Collects the places of all categories, keeping one entry per 2GIS id,
+        so that a place matching several queries is routed only once.
         """
-        # Step 1: Find places
-        places_params = {
-            "q": query,
-            "point": f"{start_coords['lon']},{start_coords['lat']}",
-            "radius": radius_meters,
-            "key": self.api_key,
-            "fields": "items.point,items.name,items.purpose_name,items.id",
-        }
-        
-        found_places = []
-        try:
-            response = requests.get(self.places_api_url, params=places_params)
-            response.raise_for_status()
-            data = response.json()
-            if data.get("meta", {}).get("code") == 200 and data.get("result", {}).get("items"):
-                found_places = data["result"]["items"]
-        except requests.exceptions.RequestException as e:
-            print(f"Error searching for '{query}': {e}")
-            return []
-
-        if not found_places:
-            return []
-
-        # Step 2: Get distances for found places
-        distances = self._get_distances(start_coords, found_places)
+        unique_places = {}
+        for places in places_by_category.values():
+            for place in places:
+                if place.get("id") and place.get("point"):
+                    unique_places.setdefault(place["id"], place)
+        return list(unique_places.values())
 
-        # Step 3: Combine places with their distances
+    def _estimate_distances(self, start_point: Dict[str, float], places: List[Dict[str, Any]], radius_meters: int) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+        """
+        Applies the distance mode before any routing call.
+        Returns the places that still need routing and the distances already known without it.
+        """
+        if self.distance_mode == "routing" or not places:
+            return places, {}
+
+        straight = haversine_distances(start_point, [place["point"] for place in places])
+        if self.distance_mode == "fast":
+            # A route is never shorter than the straight line, so these can't be within the radius
+            return [place for place, distance in zip(places, straight) if distance <= radius_meters], {}
+
+        factor = WALKING_DETOUR_FACTOR if self.distance_mode == "walking" else 1.0
+        return [], {place["id"]: int(round(distance * factor)) for place, distance in zip(places, straight)}
+
+    def _routing_chunks(self, places: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        # One slot of every request is taken by the origin
+        chunk_size = self.routing_max_points - 1
+        return [places[i:i + chunk_size] for i in range(0, len(places), chunk_size)]
+
+    @staticmethod
+    def _combine_with_distances(found_places: List[Dict[str, Any]], distances: Dict[str, int], radius_meters: int) -> List[Dict[str, Any]]:
         for place in found_places:
             place["distance"] = distances.get(place["id"])
-        
+
         # Filter by radius and sort by distance
         found_places = [p for p in found_places if p.get("distance") is not None and p["distance"] <= radius_meters]
         found_places.sort(key=lambda p: p.get('distance', float('inf')))
-
         return found_places
 
+    @staticmethod
+    def _format_places(places: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Format the output to be just name and distance
+        return [
+            {"name": p.get("name"), "distance": p.get("distance")}
+            for p in places
+        ]
+
+    # --- Blocking API ---
+
+    def _get_coordinates(self, address: str) -> Optional[Dict[str, float]]:
+        """
+        Converts a textual address to geographic coordinates (latitude and longitude).
+        """
+        with track_stage("geocode") as stage:
+            if self.geocode_cache is not None:
+                cached = self.geocode_cache.get_coordinates(address)
+                if cached is not None:
+                    stage.outcome = "cache_hit"
+                    return cached
+            try:
+                # The geocode endpoint is a path under the main places API url
+                response = self._session.get(f"{self.places_api_url}/geocode", params=self._geocode_params(address), timeout=self.timeout)
+                response.raise_for_status()
+                return self._remember_coordinates(address, self._parse_coordinates(response.json()))
+            except requests.exceptions.RequestException as e:
+                stage.outcome = "error"
+                print(f"Error fetching coordinates: {e}")
+            except (KeyError, IndexError) as e:
+                stage.outcome = "error"
+                print(f"Could not parse coordinates from response: {e}")
+            return None
+
+    def _get_distances(self, start_point: Dict[str, float], places: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Calculates distances from a start point to a list of places using the Distance Matrix API.
+        """
+        if not places:
+            return {}
+
+        request = self._distances_request(start_point, places)
+        if request is None:
+            return {}
+        payload, place_id_map = request
+
+        headers = {"Content-Type": "application/json"}
+
+        with track_stage("routing") as stage:
+            try:
+                response = self._session.post(self.routing_api_url, json=payload, headers=headers, params=self._routing_params(), timeout=self.timeout)
+                response.raise_for_status()
+                return self._parse_distances(response.json(), place_id_map)
+            except requests.exceptions.RequestException as e:
+                stage.outcome = "error"
+                print(f"Error fetching distances: {e}")
+            except (KeyError, IndexError) as e:
+                stage.outcome = "error"
+                print(f"Could not parse distances from response: {e}")
+
+        return {}
+
+    def _find_nearby(self, start_coords: Dict[str, float], query: str, radius_meters: int) -> List[Dict[str, Any]]:
+        """
+        Internal method to find places of one category around the coordinates.
+        """
+        with track_stage("places") as stage:
+            tile, cached_places = self._cached_search(start_coords, query, radius_meters)
+            if cached_places is not None:
+                stage.outcome = "cache_hit"
+                return cached_places
+
+            search_coords, search_radius = self._search_area(start_coords, radius_meters, tile)
+            try:
+                response = self._session.get(self.places_api_url, params=self._places_params(search_coords, query, search_radius), timeout=self.timeout)
+                response.raise_for_status()
+                return self._remember_places(tile, query, radius_meters, response.json())
+            except requests.exceptions.RequestException as e:
+                stage.outcome = "error"
+                print(f"Error searching for '{query}': {e}")
+                return []
+
+    def _get_all_distances(self, start_point: Dict[str, float], places: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Routes to every place, using as few Distance Matrix requests as the point limit allows.
+        """
+        distances = {}
+        for chunk in self._routing_chunks(places):
+            distances.update(self._get_distances(start_point, chunk))
+        return distances
+
     def get_infrastructure_summary(self, address: str, radius_meters: int = 1000) -> Dict[str, List[Dict[str, Any]]]:
         """
         Searches for a predefined list of infrastructure categories and returns a structured summary.
@@ -146,25 +361,208 @@ class TwoGisClient:
         if not start_coords:
             print(f"Could not find coordinates for address: {address}")
             return {}
-        
-        infrastructure_summary = {}
+
         print(f"\nSearching for infrastructure within {radius_meters}m of {address}...\n")
-        
+
+        # Step 1: Find places for every category
+        places_by_category = {}
         for category_name, query in INFRASTRUCTURE_CATEGORIES.items():
             print(f"-> Searching for: {category_name}")
-            places = self._find_nearby_with_distances(start_coords, query, 2*radius_meters)
-            
+            places_by_category[category_name] = self._find_nearby(start_coords, query, 2*radius_meters)
+
+        # Step 2: Get distances for all found places at once
+        to_route, distances = self._estimate_distances(start_coords, self._merge_places(places_by_category), 2*radius_meters)
+        distances.update(self._get_all_distances(start_coords, to_route))
+
+        # Step 3: Combine places with their distances
+        return self._build_summary(places_by_category, distances, 2*radius_meters)
+
+    def _build_summary(self, places_by_category: Dict[str, List[Dict[str, Any]]], distances: Dict[str, int], radius_meters: int) -> Dict[str, List[Dict[str, Any]]]:
+        infrastructure_summary = {}
+        for category_name, found_places in places_by_category.items():
+            places = self._combine_with_distances(found_places, distances, radius_meters)
             if places:
-                # Format the output to be just name and distance
-                formatted_places = [
-                    {"name": p.get("name"), "distance": p.get("distance")}
-                    for p in places
-                ]
-                infrastructure_summary[category_name] = formatted_places
-        
+                infrastructure_summary[category_name] = self._format_places(places)
         return infrastructure_summary
 
 
+class AsyncTwoGisClient(TwoGisClient):
+    """
+    Asyncio variant of TwoGisClient.
+    All category searches run concurrently, at most `max_concurrency` HTTP requests
+    are in flight at once across all summaries; the client is meant to be shared by all users.
+    The summary has the same shape as the blocking client's.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        routing_max_points: int = ROUTING_MAX_POINTS,
+        geocode_cache: Optional[GeocodeCache] = None,
+        places_cache: Optional[PlacesCache] = None,
+        distance_mode: str = "routing",
+        connect_timeout: float = CONNECT_TIMEOUT_SECONDS,
+        read_timeout: float = READ_TIMEOUT_SECONDS,
+        connections_per_host: int = CONNECTIONS_PER_HOST,
+        max_retries: int = MAX_RETRIES,
+        catalog_url: str = CATALOG_API_URL,
+        routing_url: str = ROUTING_API_URL,
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1.")
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        super().__init__(
+            api_key,
+            routing_max_points=routing_max_points,
+            geocode_cache=geocode_cache,
+            places_cache=places_cache,
+            distance_mode=distance_mode,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            connections_per_host=connections_per_host,
+            max_retries=max_retries,
+            catalog_url=catalog_url,
+            routing_url=routing_url,
+        )
+
+    def _init_http(self, connections_per_host: int) -> None:
+        connect_timeout, read_timeout = self.timeout
+        timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        # Fewer connections than requests allowed in flight would queue the requests in the pool instead
+        connections_per_host = max(connections_per_host, self.max_concurrency)
+        limits = httpx.Limits(max_connections=connections_per_host, max_keepalive_connections=connections_per_host)
+        # One client per API host, so that each host gets its own connection limit
+        self._catalog_http = httpx.AsyncClient(timeout=timeout, limits=limits)
+        self._routing_http = httpx.AsyncClient(timeout=timeout, limits=limits)
+
+    async def aclose(self) -> None:
+        await self._catalog_http.aclose()
+        await self._routing_http.aclose()
+
+    async def _request(self, http: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Sends a request, retrying connection errors, timeouts and RETRY_STATUSES
+        with jittered exponential backoff.
+        """
+        for attempt in range(self.max_retries + 1):
+            is_last_attempt = attempt == self.max_retries
+            try:
+                async with self._semaphore:
+                    response = await http.request(method, url, **kwargs)
+            except httpx.TransportError:
+                if is_last_attempt:
+                    raise
+                increment("twogis_retries_total", reason="transport")
+                await asyncio.sleep(self._backoff_delay(attempt))
+                continue
+
+            if response.status_code not in RETRY_STATUSES or is_last_attempt:
+                return response
+            increment("twogis_retries_total", reason=str(response.status_code))
+            await asyncio.sleep(self._backoff_delay(attempt, response.headers.get("Retry-After")))
+        return response
+
+    @staticmethod
+    def _backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), RETRY_AFTER_MAX_SECONDS)
+        return random.uniform(0, BACKOFF_FACTOR * 2 ** attempt)
+
+    async def _get_coordinates(self, address: str) -> Optional[Dict[str, float]]:
+        with track_stage("geocode") as stage:
+            if self.geocode_cache is not None:
+                cached = self.geocode_cache.get_coordinates(address)
+                if cached is not None:
+                    stage.outcome = "cache_hit"
+                    return cached
+            try:
+                response = await self._request(self._catalog_http, "GET", f"{self.places_api_url}/geocode", params=self._geocode_params(address))
+                response.raise_for_status()
+                return self._remember_coordinates(address, self._parse_coordinates(response.json()))
+            except httpx.HTTPError as e:
+                stage.outcome = "error"
+                print(f"Error fetching coordinates: {e}")
+            except (KeyError, IndexError) as e:
+                stage.outcome = "error"
+                print(f"Could not parse coordinates from response: {e}")
+            return None
+
+    async def _get_distances(self, start_point: Dict[str, float], places: List[Dict[str, Any]]) -> Dict[str, int]:
+        if not places:
+            return {}
+
+        request = self._distances_request(start_point, places)
+        if request is None:
+            return {}
+        payload, place_id_map = request
+
+        with track_stage("routing") as stage:
+            try:
+                response = await self._request(self._routing_http, "POST", self.routing_api_url, json=payload, params=self._routing_params())
+                response.raise_for_status()
+                return self._parse_distances(response.json(), place_id_map)
+            except httpx.HTTPError as e:
+                stage.outcome = "error"
+                print(f"Error fetching distances: {e}")
+            except (KeyError, IndexError) as e:
+                stage.outcome = "error"
+                print(f"Could not parse distances from response: {e}")
+
+        return {}
+
+    async def _find_nearby(self, start_coords: Dict[str, float], query: str, radius_meters: int) -> List[Dict[str, Any]]:
+        with track_stage("places") as stage:
+            tile, cached_places = self._cached_search(start_coords, query, radius_meters)
+            if cached_places is not None:
+                stage.outcome = "cache_hit"
+                return cached_places
+
+            search_coords, search_radius = self._search_area(start_coords, radius_meters, tile)
+            try:
+                response = await self._request(self._catalog_http, "GET", self.places_api_url, params=self._places_params(search_coords, query, search_radius))
+                response.raise_for_status()
+                return self._remember_places(tile, query, radius_meters, response.json())
+            except httpx.HTTPError as e:
+                stage.outcome = "error"
+                print(f"Error searching for '{query}': {e}")
+                return []
+
+    async def _get_all_distances(self, start_point: Dict[str, float], places: List[Dict[str, Any]]) -> Dict[str, int]:
+        if not places:
+            return {}
+        distances = {}
+        chunk_distances = await asyncio.gather(*(
+            self._get_distances(start_point, chunk) for chunk in self._routing_chunks(places)
+        ))
+        for chunk_result in chunk_distances:
+            distances.update(chunk_result)
+        return distances
+
+    async def get_infrastructure_summary(self, address: str, radius_meters: int = 1000) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Same as TwoGisClient.get_infrastructure_summary, but searches all categories concurrently.
+        """
+        start_coords = await self._get_coordinates(address)
+        if not start_coords:
+            print(f"Could not find coordinates for address: {address}")
+            return {}
+
+        print(f"\nSearching for infrastructure within {radius_meters}m of {address}...\n")
+
+        # gather keeps the order of INFRASTRUCTURE_CATEGORIES in the results
+        results = await asyncio.gather(*(
+            self._find_nearby(start_coords, query, 2*radius_meters)
+            for query in INFRASTRUCTURE_CATEGORIES.values()
+        ))
+        places_by_category = dict(zip(INFRASTRUCTURE_CATEGORIES, results))
+
+        to_route, distances = self._estimate_distances(start_coords, self._merge_places(places_by_category), 2*radius_meters)
+        distances.update(await self._get_all_distances(start_coords, to_route))
+        return self._build_summary(places_by_category, distances, 2*radius_meters)
+
+
 if __name__ == '__main__':
     API_KEY = os.environ.get("TWOGIS_API_KEY")
     if not API_KEY:
@@ -172,9 +570,9 @@ if __name__ == '__main__':
     else:
         client = TwoGisClient(api_key=API_KEY)
         test_address = "Москва, ул. Тверская, 6"
-        
+
         summary = client.get_infrastructure_summary(test_address)
-        
+
         print("\n--- INFRASTRUCTURE SUMMARY ---")
         if summary:
             for category, places in summary.items():
@@ -185,4 +583,4 @@ if __name__ == '__main__':
                 else:
                     print("  - Not found nearby.")
         else:
-            print("Could not retrieve infrastructure summary.") 
\ No newline at end of file
+            print("Could not retrieve infrastructure summary.")
@@ -1,8 +1,9 @@
+import asyncio
 from telegram import Update
 from telegram.ext import ContextTypes
 from clients import mistral
 from localdb import append_line_to_file, read_file
-from rate_limits import build_filename_for_current_date, create_or_append_request_info, get_current_rate_limit
+from rate_limits import increment_request_count
 
 USER_POSTS_FILENAME = "user_posts/data.txt"
 USER_DATA = "user_data"
@@ -17,13 +18,13 @@ async def generate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user_id = update.effective_user.id
         user_context = read_file(f'{USER_DATA}/{user_id}')
 
-        current_request_count = get_current_rate_limit(user_id)
-        if current_request_count > MAX_REQUESTS_PER_USER_IN_DAY:
+        # Counted in one atomic step, concurrent requests can't both slip under the quota
+        request_count = await asyncio.to_thread(increment_request_count, user_id)
+        if request_count > MAX_REQUESTS_PER_USER_IN_DAY:
             await update.message.reply_text("Вы превысыли вашу дневную квоту на кол-во запросов. Попробуйте завтра или оформите подписку.")
             return
-        
-        print(f"{user_id}: {current_request_count} + 1 request for generate")
-        create_or_append_request_info(build_filename_for_current_date(user_id), current_request_count+1)
+
+        print(f"{user_id}: request {request_count} for generate")
 
         await update.message.reply_text("Обрабатываю запрос... 🤓")
         result = mistral.req(TASK, user_context)
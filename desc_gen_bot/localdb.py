@@ -1,22 +1,142 @@
 import platform
 import os
+import queue
+import atexit
+import logging
+import threading
+import time
+
+from clients.metrics import increment
+
+logger = logging.getLogger(__name__)
 
 user_data_path = "user_data/"
 
+# Lines are written by a background thread that keeps one open handle per file
+FLUSH_INTERVAL_SECONDS = 1.0
+FLUSH_SIZE_BYTES = 64 * 1024
+# When this many lines wait for the disk, new lines are dropped: writers are event loop handlers
+# and must not wait for the disk
+MAX_PENDING_LINES = 10_000
+
+
+class BufferedLineWriter:
+    """
+    Appends lines to files from a background thread.
+    Files stay open, writes are flushed every `flush_interval` seconds or once
+    `flush_size` bytes are buffered, and everything is flushed on close().
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL_SECONDS, flush_size=FLUSH_SIZE_BYTES, max_pending=MAX_PENDING_LINES):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._files = {}
+        self._closed = False
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="localdb-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, filename, text):
+        """Queues text for the file. Never blocks: when MAX_PENDING_LINES are already waiting, the text is dropped."""
+        if self._closed:
+            raise RuntimeError("The writer is closed.")
+        try:
+            self._queue.put_nowait((filename, text))
+        except queue.Full:
+            self.dropped += 1
+            increment("local_lines_dropped")
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning("The disk can't keep up, dropped %d lines so far (last one for %s)", self.dropped, filename)
+
+    def flush(self):
+        """Blocks until everything queued so far is written and flushed."""
+        done = threading.Event()
+        self._queue.put((None, done))
+        done.wait()
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._queue.put((None, None))
+        self._thread.join()
+
+    def _file(self, filename):
+        file = self._files.get(filename)
+        if file is None:
+            file = open(filename, 'a')
+            self._files[filename] = file
+        return file
+
+    def _flush_files(self):
+        for filename, file in self._files.items():
+            try:
+                file.flush()
+            except Exception as e:
+                print(f"An error occurred while flushing {filename}: {e}")
+
+    def _run(self):
+        buffered = 0
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                filename, item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                filename, item = None, False
+
+            if filename is not None:
+                try:
+                    self._file(filename).write(item)
+                    buffered += len(item)
+                except Exception as e:
+                    print(f"An error occurred: {e}")
+
+            stop = filename is None and item is None
+            if filename is None or buffered >= self.flush_size or time.monotonic() - last_flush >= self.flush_interval:
+                if buffered:
+                    self._flush_files()
+                buffered = 0
+                last_flush = time.monotonic()
+            if isinstance(item, threading.Event):
+                item.set()
+            if stop:
+                for file in self._files.values():
+                    file.close()
+                self._files.clear()
+                return
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BufferedLineWriter()
+            atexit.register(_writer.close)
+        return _writer
+
+
 def append_line_to_file(filename, line_to_append):
     """
     Appends a new line to the specified file.
+    The line is handed to a background writer, so the call doesn't wait for the disk.
 
     Args:
         filename (str): The name of the file to which the line will be appended.
         line_to_append (str): The line that will be appended to the file.
     """
-    try:
-        with open(filename, 'a') as file:  # Open the file in append mode
-            file.write(line_to_append + '\n')  # Write the line and add a newline character
-        print(f"Successfully appended the line to {filename}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    get_writer().write(filename, line_to_append + '\n')
+
+
+def flush_files():
+    """Writes out all lines appended so far."""
+    get_writer().flush()
 
 
 def make_file_append_only(filename):
@@ -2,16 +2,19 @@ import logging
 import const
 import texts
 from telegram import Update
+from telegram.request import BaseRequest
 from typing import Optional
-from telegram.ext import Updater, ApplicationBuilder, CommandHandler, MessageHandler, ChatMemberHandler, filters, ContextTypes
+from telegram.ext import Application, Updater, ApplicationBuilder, CommandHandler, MessageHandler, ChatMemberHandler, filters, ContextTypes
 import start
-from process_input import process_input
+from process_input import process_input, regenerate, get_user_steps
 from track_chats import show_chats, track_chats
 from error import error
 from analyze import analyze
 from generate import generate
 from help import help_command
-from user_steps import UserSteps
+from webhook import run_application
+from clients.metrics import start_metrics_reporting, stop_metrics_reporting
+from clients.token_budget import preload_encoding
 
 
 
@@ -24,9 +27,24 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-def main() -> None:
+async def post_init(application) -> None:
+    # Opens (or creates) the step store before the first update
+    get_user_steps()
+    # The tokenizer may have to be downloaded, that must not happen inside the first request
+    preload_encoding()
+    # Stage latencies on /metrics with METRICS_PORT, JSON summaries in the log otherwise
+    await start_metrics_reporting()
+
+async def post_shutdown(application) -> None:
+    await stop_metrics_reporting()
+
+def build_application(token: str = const.DESC_GEN_BOT_TOKEN, request: Optional[BaseRequest] = None) -> Application:
+    """Builds the bot with all its handlers. `request` replaces the Bot API transport, e.g. in load tests."""
     # Create the Application and pass it your bot's token
-    application = ApplicationBuilder().token(const.DESC_GEN_BOT_TOKEN).build()
+    builder = ApplicationBuilder().token(token)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.post_init(post_init).post_shutdown(post_shutdown).build()
 
     # Add command and message handlers
     application.add_handler(CommandHandler("start", start.start))
@@ -35,12 +53,17 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.PHOTO, process_input))
     application.add_handler(CommandHandler("analyze", analyze))
     application.add_handler(CommandHandler("generate", generate))
+    application.add_handler(CommandHandler("regenerate", regenerate))
     application.add_handler(CommandHandler("help", help_command))
     application.add_error_handler(error)
+    return application
 
+def main() -> None:
+    application = build_application()
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Long polling, or a webhook server with BOT_MODE=webhook
+    run_application(application, allowed_updates=Update.ALL_TYPES)
 
 
 
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Telegram delivers the messages of an album one by one, usually within a fraction of a second
+MEDIA_GROUP_DEBOUNCE_SECONDS = 1.0
+
+BatchHandler = Callable[[List], Awaitable[None]]
+
+
+class _PendingGroup:
+    __slots__ = ("messages", "on_complete", "timer")
+
+    def __init__(self, on_complete: BatchHandler):
+        self.messages = []
+        self.on_complete = on_complete
+        self.timer = None
+
+
+class MediaGroupCollector:
+    """
+    Groups the messages of an album (same `media_group_id`) into one batch.
+    The batch is handled once no new message of the album has arrived for `debounce` seconds.
+    With `group_singles` messages sent one by one are batched the same way, per chat.
+    Handlers return right away, so the next messages of the album are not blocked by the wait.
+    """
+
+    def __init__(self, debounce: float = MEDIA_GROUP_DEBOUNCE_SECONDS, group_singles: bool = False):
+        self.debounce = debounce
+        self.group_singles = group_singles
+        self._groups: Dict[Tuple[int, Optional[str]], _PendingGroup] = {}
+        self._running: Set[asyncio.Task] = set()
+
+    async def submit(self, message, on_complete: BatchHandler) -> None:
+        """
+        Handles a single message right away (unless `group_singles`), or adds an album message to its batch.
+        `on_complete` is called with the messages of the batch in the order they were sent.
+        """
+        if message.media_group_id is None and not self.group_singles:
+            await on_complete([message])
+            return
+
+        key = (message.chat_id, message.media_group_id)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _PendingGroup(on_complete)
+        group.messages.append(message)
+        if group.timer is not None:
+            group.timer.cancel()
+        group.timer = asyncio.create_task(self._flush_later(key, group))
+        self._running.add(group.timer)
+        group.timer.add_done_callback(self._running.discard)
+
+    async def _flush_later(self, key: Tuple[int, Optional[str]], group: _PendingGroup) -> None:
+        await asyncio.sleep(self.debounce)
+        # From here on the timer is not cancelled, messages arriving later start a new batch
+        if self._groups.get(key) is group:
+            del self._groups[key]
+        group.timer = None
+        messages = sorted(group.messages, key=lambda message: message.message_id)
+        try:
+            await group.on_complete(messages)
+        except Exception:
+            logger.exception("Could not handle media group %s", key[1])
+
+    def discard(self, chat_id: int) -> None:
+        """Drops the batches of a chat that are still being collected, e.g. when the step is over."""
+        for key in [key for key in self._groups if key[0] == chat_id]:
+            group = self._groups.pop(key)
+            if group.timer is not None:
+                group.timer.cancel()
+
+    async def close(self) -> None:
+        """Drops albums that are still being collected and waits for the running batches."""
+        for group in self._groups.values():
+            if group.timer is not None:
+                group.timer.cancel()
+        self._groups.clear()
+        await asyncio.gather(*self._running, return_exceptions=True)
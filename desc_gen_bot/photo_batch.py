@@ -0,0 +1,122 @@
+import io
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional
+from clients.metrics import track_stage
+
+# Photos of a conversation that got no new photo for this long are dropped from memory
+PHOTO_BATCH_TTL_SECONDS = float(os.environ.get("PHOTO_BATCH_TTL_SECONDS", "3600"))
+
+logger = logging.getLogger(__name__)
+
+
+async def download_photo(attachment) -> bytes:
+    """Downloads a PhotoSize or Document straight into memory."""
+    return await _download(await attachment.get_file())
+
+
+async def download_file_id(bot, file_id: str) -> bytes:
+    return await _download(await bot.get_file(file_id))
+
+
+async def _download(telegram_file) -> bytes:
+    # The response body is copied into the buffer once, getvalue() hands over the buffer itself
+    buffer = io.BytesIO()
+    with track_stage("telegram_download"):
+        await telegram_file.download_to_memory(buffer)
+    return buffer.getvalue()
+
+
+class PhotoBatch:
+    """
+    Photos of one conversation.
+    Every photo starts downloading into memory as soon as it arrives,
+    `images()` waits for the downloads and returns the bytes in upload order.
+    """
+
+    __slots__ = ("file_ids", "_downloads", "updated_at")
+
+    def __init__(self):
+        self.file_ids: List[str] = []
+        self._downloads: List[asyncio.Task] = []
+        self.updated_at = time.monotonic()
+
+    def add(self, attachment) -> None:
+        # file_id is known without any request, it is used to send the photos back
+        self.updated_at = time.monotonic()
+        self.file_ids.append(attachment.file_id)
+        self._downloads.append(asyncio.create_task(download_photo(attachment)))
+
+    @classmethod
+    def from_file_ids(cls, bot, file_ids: List[str]) -> "PhotoBatch":
+        """Downloads photos again by their file ids, e.g. for a job restored after a restart."""
+        batch = cls()
+        for file_id in file_ids:
+            batch.file_ids.append(file_id)
+            batch._downloads.append(asyncio.create_task(download_file_id(bot, file_id)))
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.file_ids)
+
+    async def images(self) -> List[bytes]:
+        """Returns the downloaded photos, leaving out the ones that failed to download."""
+        results = await asyncio.gather(*self._downloads, return_exceptions=True)
+        images = []
+        for file_id, result in zip(self.file_ids, results):
+            if isinstance(result, BaseException):
+                logger.warning("Could not download photo %s: %s", file_id, result)
+            else:
+                images.append(result)
+        return images
+
+    def cancel(self) -> None:
+        """Stops downloads of an abandoned conversation."""
+        for download in self._downloads:
+            download.cancel()
+
+
+class PhotoBatches:
+    """
+    Photo batches of the conversations in progress, by user id.
+    Batches of conversations abandoned for `ttl` seconds are cancelled and dropped
+    whenever a batch is started or looked up.
+    """
+
+    def __init__(self, ttl: float = PHOTO_BATCH_TTL_SECONDS):
+        self.ttl = ttl
+        self._batches: Dict[int, PhotoBatch] = {}
+
+    def _evict_stale(self) -> None:
+        deadline = time.monotonic() - self.ttl
+        stale = [user_id for user_id, batch in self._batches.items() if batch.updated_at < deadline]
+        for user_id in stale:
+            self._batches.pop(user_id).cancel()
+        if stale:
+            logger.info("Dropped photos of %d abandoned conversations", len(stale))
+
+    def start(self, user_id: int) -> PhotoBatch:
+        """A new empty batch, the previous one of the user is cancelled."""
+        self._evict_stale()
+        previous = self._batches.pop(user_id, None)
+        if previous is not None:
+            previous.cancel()
+        batch = self._batches[user_id] = PhotoBatch()
+        return batch
+
+    def get(self, user_id: int) -> PhotoBatch:
+        """The batch of the user, a new one if there is none (e.g. it was started by another replica)."""
+        self._evict_stale()
+        batch = self._batches.get(user_id)
+        if batch is None:
+            batch = self._batches[user_id] = PhotoBatch()
+        return batch
+
+    def pop(self, user_id: int) -> Optional[PhotoBatch]:
+        self._evict_stale()
+        return self._batches.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._batches)
@@ -1,10 +1,16 @@
 from telegram import Update
 from telegram.ext import ContextTypes
 from user_steps import UserSteps
-import base64
 from clients import two_gis_client, openai_client
+from clients.geocode_cache import GeocodeCache
+from clients.places_cache import PlacesCache
+from clients.description_cache import DescriptionCache
+from clients.provider_router import description_router
+from media_group import MediaGroupCollector
+from photo_batch import download_photo
 import os
-import time
+import asyncio
+from functools import partial
 
 step_to_reply_msg = {
     0: "Спасибо за адрес. Далее загрузите фотографию квартиры.",
@@ -14,10 +20,125 @@ step_to_reply_msg = {
     4: "Спасибо за доп.детали, генерируем финальное описание ..."
 }
 
-user_steps = UserSteps()
+media_groups = MediaGroupCollector()
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 TWOGIS_API_KEY = os.environ.get("TWOGIS_API_KEY")
+TWOGIS_DISTANCE_MODE = os.environ.get("TWOGIS_DISTANCE_MODE", "routing")
+
+# Infrastructure lookups started at the address step, by user id, until they finish
+infrastructure_tasks = {}
+
+# Shared between users so that concurrent requests reuse one connection pool
+_two_gis_client = None
+_openai_client = None
+_description_router = None
+_user_steps = None
+
+def get_user_steps():
+    # Created in post_init rather than at import, since it opens data/user_steps.sqlite3.
+    # Steps may live in SQLite or Redis, they are read and written from a thread
+    global _user_steps
+    if _user_steps is None:
+        _user_steps = UserSteps()
+    return _user_steps
+
+def get_two_gis_client():
+    global _two_gis_client
+    if _two_gis_client is None:
+        _two_gis_client = two_gis_client.AsyncTwoGisClient(
+            api_key=TWOGIS_API_KEY,
+            geocode_cache=GeocodeCache(),
+            places_cache=PlacesCache(),
+            distance_mode=TWOGIS_DISTANCE_MODE,
+        )
+    return _two_gis_client
+
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = openai_client.OpenAIClient(api_key=OPENAI_API_KEY, description_cache=DescriptionCache())
+    return _openai_client
+
+def get_description_router():
+    # OpenAI, hedged with Mistral when MISTRAL_API_KEY is set
+    global _description_router
+    if _description_router is None:
+        _description_router = description_router(get_openai_client())
+    return _description_router
+
+async def save_infrastructure(user_id, address) -> None:
+    infra_summary = await get_two_gis_client().get_infrastructure_summary(address)
+    await asyncio.to_thread(get_user_steps().set_infra_summary, user_id, address, infra_summary)
+
+def start_infrastructure_lookup(context, update, user_id, address) -> None:
+    """Looks up the infrastructure in a task, the user goes on with the next steps meanwhile."""
+    task = context.application.create_task(save_infrastructure(user_id, address), update=update)
+    infrastructure_tasks[user_id] = task
+
+    def forget(done_task):
+        if infrastructure_tasks.get(user_id) is done_task:
+            del infrastructure_tasks[user_id]
+
+    task.add_done_callback(forget)
+
+async def wait_for_infrastructure(user_id, steps) -> None:
+    """Fills in the infrastructure of `steps`, waiting for its lookup or repeating it if needed."""
+    if steps._infra_summary is not None:
+        return
+    task = infrastructure_tasks.get(user_id)
+    if task is not None:
+        # Errors of the lookup are reported by the task itself, the lookup is repeated below
+        await asyncio.gather(task, return_exceptions=True)
+        stored = await asyncio.to_thread(get_user_steps().get_current_user_data, user_id)
+        if stored and stored._address == steps._address:
+            steps._infra_summary = stored._infra_summary
+    if steps._infra_summary is None:
+        # The lookup failed, or ran on another replica that hasn't finished it yet
+        steps._infra_summary = await get_two_gis_client().get_infrastructure_summary(steps._address)
+        await asyncio.to_thread(get_user_steps().set_infra_summary, user_id, steps._address, steps._infra_summary)
+
+async def save_photos(user_id, messages):
+    images = await asyncio.gather(*(download_photo(message.photo[-1]) for message in messages))
+    await asyncio.to_thread(get_user_steps().update_user_data, user_id, images=images)
+
+    await messages[-1].reply_text(step_to_reply_msg[1])
+    await asyncio.to_thread(get_user_steps().increment_user_step, user_id)
+
+def description_request(steps) -> dict:
+    user_promt = f"Адрес: {steps._address}\nОписание квартиры: {steps._flat_description}\nОписание дома: {steps._options}\nУсловия сделки: {steps._deal_details}"
+    return dict(
+        user_prompt=user_promt,
+        address=steps._address,
+        infrastructure_summary=steps._infra_summary,
+        image_paths=list(steps._images),
+    )
+
+async def send_description(message, user_id, steps, use_cache=True) -> None:
+    await wait_for_infrastructure(user_id, steps)
+    description = await get_description_router().generate_description(**description_request(steps), use_cache=use_cache)
+    await message.reply_text(description)
+    await message.reply_text(
+        "Чтобы попробовать снова - просто введите адрес обьекта недвижимости. "
+        "Другой вариант описания этого обьекта - /regenerate"
+    )
+
+async def regenerate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Generates the description of the last finished listing again, bypassing the description cache."""
+    if update.message is None or update.message.chat.type != 'private':
+        return
+    user_id = update.effective_user.id
+    current_user_steps = await asyncio.to_thread(get_user_steps().get_current_user_data, user_id)
+    # Step 0 with the deal details filled in: the listing is finished and no new address came yet
+    if not current_user_steps or current_user_steps._current_step != 0 or not current_user_steps._deal_details:
+        await update.message.reply_text("Пока нечего генерировать заново - введите адрес обьекта недвижимости.")
+        return
+
+    await update.message.reply_text("Генерирую новый вариант описания ... 🤓")
+    context.application.create_task(
+        send_description(update.message, user_id, current_user_steps, use_cache=False),
+        update=update,
+    )
 
 async def process_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message is None:
@@ -36,59 +157,49 @@ async def process_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
         user_id = update.effective_user.id
 
-        current_user_step = user_steps.get_current_user_step(user_id)
+        current_user_step = await asyncio.to_thread(get_user_steps().get_current_user_step, user_id)
 
 
         if current_user_step <= 4:
             reply_msg = step_to_reply_msg[current_user_step]
             if current_user_step == 0:
                 await update.message.reply_text("Ищу супермаркеты, торговые центры, станции метро и другие обьекты поблизости...")
-                client = two_gis_client.TwoGisClient(api_key=TWOGIS_API_KEY)
-                infra_summary = client.get_infrastructure_summary(user_message)
-                user_steps.update_user_data(user_id, address = user_message)
-                user_steps.update_user_data(user_id, infra_summary = infra_summary)
+                # Updates are handled one at a time, the lookup of several seconds must not hold up the other users
+                await asyncio.to_thread(get_user_steps().start_listing, user_id, user_message, None)
+                start_infrastructure_lookup(context, update, user_id, user_message)
             if current_user_step == 1:
                 if len(update.message.photo) < 1:
                     print("not a photo")
                     return
-                photo_file = await update.message.photo[-1].get_file()
-                image_bytes = await photo_file.download_as_bytearray()
-                base64_image = base64.b64encode(image_bytes).decode("utf-8")
-                user_steps.update_user_data(user_id, image = base64_image)
+                # An album arrives as several updates, it is saved and acknowledged once
+                await media_groups.submit(update.message, partial(save_photos, user_id))
+                return
             if current_user_step == 2:
-                user_steps.update_user_data(user_id, flat_description = user_message)
+                await asyncio.to_thread(get_user_steps().update_user_data, user_id, flat_description=user_message)
             if current_user_step == 3:
-                user_steps.update_user_data(user_id, options = user_message)
+                await asyncio.to_thread(get_user_steps().update_user_data, user_id, options=user_message)
             if current_user_step == 4:
-                user_steps.update_user_data(user_id, deal_details = user_message)
+                await asyncio.to_thread(get_user_steps().update_user_data, user_id, deal_details=user_message)
 
         if current_user_step == 4:
             reply_msg = "Спасибо, генерирую финальное описание ... 🤓"
             await update.message.reply_text(reply_msg)
 
-            current_user_steps = user_steps.get_current_user_data(user_id)
-            ai_client = openai_client.OpenAIClient(api_key=OPENAI_API_KEY)
-            user_promt = f"Адрес: {current_user_steps._address}\nОписание квартиры: {current_user_steps._flat_description}\nОписание дома: {current_user_steps._options}\nУсловия сделки: {current_user_steps._deal_details}"
-
-            description = ai_client.create_description(
-                user_prompt=user_promt,
-                address=current_user_steps._address,
-                infrastructure_summary=current_user_steps._infra_summary,
-                image_paths=current_user_steps._image
-            )
+            current_user_steps = await asyncio.to_thread(get_user_steps().get_current_user_data, user_id)
             #resp = mistral.req_final_description(user_id, current_user_steps)
 
-            reply_msg = description
-
+            # The completion takes up to a minute, the other users' updates are handled meanwhile.
+            # The flow is over as far as the user's steps are concerned, a new address starts the next one
+            context.application.create_task(
+                send_description(update.message, user_id, current_user_steps),
+                update=update,
+            )
+            await asyncio.to_thread(get_user_steps().increment_user_step, user_id)
+            return
 
-        current_user_data = user_steps.get_current_user_data(user_id)
         await update.message.reply_text(reply_msg)
 
-        if current_user_step == 4:
-            time.sleep(3)
-            await update.message.reply_text("Чтобы попробовать снова - просто введите адрес обьекта недвижимости.")
-
-        user_steps.increment_user_step(user_id)
+        await asyncio.to_thread(get_user_steps().increment_user_step, user_id)
 
    
         
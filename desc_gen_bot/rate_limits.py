@@ -1,26 +1,154 @@
+import os
+import json
+import atexit
 import datetime
-from localdb import file_exists, clear_file
+import threading
+from state_store import get_state_store
 
 RATE_LIMITS_FOLDER = "rate_limits"
+SNAPSHOT_FILENAME = f"{RATE_LIMITS_FOLDER}/snapshot.json"
+SNAPSHOT_INTERVAL_SECONDS = 30
+# Windows in a shared store expire on their own once the day is over
+SHARED_WINDOW_TTL_SECONDS = 2 * 24 * 60 * 60
+
+
+class RateLimiter:
+    """
+    Per-user daily request counters kept in memory.
+    Counters are saved to a single snapshot file every `snapshot_interval` seconds and at exit,
+    so quotas survive restarts. Windows of previous days are dropped automatically.
+    """
+
+    def __init__(self, snapshot_path=SNAPSHOT_FILENAME, snapshot_interval=SNAPSHOT_INTERVAL_SECONDS):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._stopped = threading.Event()
+        self._load()
+        self._thread = threading.Thread(target=self._snapshot_loop, name="rate-limits-snapshot", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def window_key(user_id, date=None):
+        # The key keeps the format of the old per-day files: "rate_limits/{user_id}_{date}"
+        date = date or datetime.datetime.now().strftime('%Y-%m-%d')
+        return f"{RATE_LIMITS_FOLDER}/{user_id}_{date}"
+
+    @staticmethod
+    def _is_current(key):
+        return key.endswith("_" + datetime.datetime.now().strftime('%Y-%m-%d'))
+
+    def get(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def set(self, key, request_count):
+        with self._lock:
+            self._counters[key] = request_count
+            self._dirty = True
+
+    def increment(self, key):
+        """Atomically adds one request to the window and returns the new count."""
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            self._dirty = True
+            return self._counters[key]
+
+    def _expire(self):
+        expired = [key for key in self._counters if not self._is_current(key)]
+        for key in expired:
+            del self._counters[key]
+        if expired:
+            self._dirty = True
+
+    def _load(self):
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                self._counters = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Could not load rate limits snapshot: {e}")
+            return
+        self._expire()
+
+    def snapshot(self):
+        """Writes the current windows to the snapshot file if anything changed."""
+        with self._lock:
+            self._expire()
+            if not self._dirty:
+                return
+            data = json.dumps(self._counters)
+            self._dirty = False
+
+        directory = os.path.dirname(self.snapshot_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first, so a crash never leaves a half-written snapshot
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as file:
+                file.write(data)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            print(f"Could not save rate limits snapshot: {e}")
+            with self._lock:
+                self._dirty = True
+
+    def _snapshot_loop(self):
+        while not self._stopped.wait(self.snapshot_interval):
+            self.snapshot()
+
+    def close(self):
+        self._stopped.set()
+        self.snapshot()
+
+
+class SharedRateLimiter:
+    """Per-user daily request counters in a shared StateStore, the same for every replica."""
+
+    def __init__(self, state_store, window_ttl=SHARED_WINDOW_TTL_SECONDS):
+        self._state_store = state_store
+        self.window_ttl = window_ttl
+
+    def get(self, key):
+        return int(self._state_store.get(key) or 0)
+
+    def set(self, key, request_count):
+        self._state_store.set(key, str(request_count), ttl=self.window_ttl)
+
+    def increment(self, key):
+        """Atomically adds one request to the window and returns the new count."""
+        return self._state_store.incr(key, ttl=self.window_ttl)
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            state_store = get_state_store()
+            _rate_limiter = SharedRateLimiter(state_store) if state_store.shared else RateLimiter()
+        return _rate_limiter
+
 
 def create_or_append_request_info(filename, request_count):
-    # Get the current date
-    current_date = datetime.datetime.now().strftime('%Y-%m-%d')
-    clear_file(filename)
+    get_rate_limiter().set(filename, request_count)
 
-    # Open the file in append mode. If it does not exist, it will be created.
-    with open(filename, 'a') as file:
-        file.write(str(request_count))
-        
 
 def get_current_rate_limit(user_id):
-    filename = build_filename_for_current_date(user_id)
-    if not file_exists(filename):
-        return 0
-    
-    with open(filename, 'r') as file:
-        return int(file.read())
+    return get_rate_limiter().get(build_filename_for_current_date(user_id))
+
+
+def increment_request_count(user_id):
+    return get_rate_limiter().increment(build_filename_for_current_date(user_id))
+
 
 def build_filename_for_current_date(user_id):
-    current_date = datetime.datetime.now().strftime('%Y-%m-%d')
-    return f"{RATE_LIMITS_FOLDER}/{user_id}_{current_date}"
\ No newline at end of file
+    return RateLimiter.window_key(user_id)
@@ -0,0 +1,214 @@
+import os
+import time
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+# "memory" keeps the state in this process, "redis" shares it between replicas
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+STATE_KEY_PREFIX = os.environ.get("STATE_KEY_PREFIX", "descgen:")
+
+
+class StateStore:
+    """
+    Key/value storage for the mutable bot state: conversations, quotas and chat membership.
+    Values are strings (usually JSON). `ttl` is in seconds, None means the key never expires.
+    """
+
+    # False when every process has its own copy of the state
+    shared = False
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def incr(self, key: str, ttl: Optional[float] = None) -> int:
+        """Atomically adds one to a counter and returns the new value. `ttl` is set when the counter is created."""
+        raise NotImplementedError
+
+    def expire(self, key: str, ttl: float) -> None:
+        """Sets the ttl of an existing key, values and lists alike."""
+        raise NotImplementedError
+
+    def rpush(self, key: str, values: List[str], ttl: Optional[float] = None) -> None:
+        """Appends to a list, creating it if needed. `ttl` is set again on every push."""
+        raise NotImplementedError
+
+    def lrange(self, key: str) -> List[str]:
+        """The whole list, empty if there is none."""
+        raise NotImplementedError
+
+    def sadd(self, key: str, member: str) -> None:
+        raise NotImplementedError
+
+    def srem(self, key: str, member: str) -> None:
+        raise NotImplementedError
+
+    def smembers(self, key: str) -> Set[str]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryStateStore(StateStore):
+    """State of a single process, nothing leaves memory."""
+
+    def __init__(self):
+        self._values: Dict[str, Tuple[str, Optional[float]]] = {}
+        self._lists: Dict[str, Tuple[List[str], Optional[float]]] = {}
+        self._sets: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def _get_alive(self, key, items=None):
+        items = self._values if items is None else items
+        item = items.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.monotonic():
+            del items[key]
+            return None
+        return item
+
+    @staticmethod
+    def _expires_at(ttl):
+        return time.monotonic() + ttl if ttl is not None else None
+
+    def get(self, key):
+        with self._lock:
+            item = self._get_alive(key)
+            return item[0] if item is not None else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, self._expires_at(ttl))
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+            self._lists.pop(key, None)
+            self._sets.pop(key, None)
+
+    def incr(self, key, ttl=None):
+        with self._lock:
+            item = self._get_alive(key)
+            if item is None:
+                item = ("0", self._expires_at(ttl))
+            count = int(item[0]) + 1
+            self._values[key] = (str(count), item[1])
+            return count
+
+    def expire(self, key, ttl):
+        with self._lock:
+            for items in (self._values, self._lists):
+                item = self._get_alive(key, items)
+                if item is not None:
+                    items[key] = (item[0], self._expires_at(ttl))
+
+    def rpush(self, key, values, ttl=None):
+        with self._lock:
+            item = self._get_alive(key, self._lists)
+            stored = item[0] if item is not None else []
+            stored.extend(values)
+            self._lists[key] = (stored, self._expires_at(ttl) if ttl is not None else (item[1] if item else None))
+
+    def lrange(self, key):
+        with self._lock:
+            item = self._get_alive(key, self._lists)
+            return list(item[0]) if item is not None else []
+
+    def sadd(self, key, member):
+        with self._lock:
+            self._sets.setdefault(key, set()).add(str(member))
+
+    def srem(self, key, member):
+        with self._lock:
+            self._sets.get(key, set()).discard(str(member))
+
+    def smembers(self, key):
+        with self._lock:
+            return set(self._sets.get(key, ()))
+
+
+class RedisStateStore(StateStore):
+    """
+    State kept in Redis (or anything speaking its protocol), shared by all replicas.
+    Every key is prefixed with `prefix`, so several bots can use one database.
+    """
+
+    shared = True
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = STATE_KEY_PREFIX):
+        # redis is only needed with STATE_BACKEND=redis
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def get(self, key):
+        return self._redis.get(self._key(key))
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(self._key(key), value, px=int(ttl * 1000) if ttl is not None else None)
+
+    def delete(self, key):
+        self._redis.delete(self._key(key))
+
+    def incr(self, key, ttl=None):
+        # One MULTI: the counter is created with its ttl, or not at all, even if the process dies
+        with self._redis.pipeline(transaction=True) as pipe:
+            if ttl is not None:
+                pipe.set(self._key(key), 0, nx=True, px=int(ttl * 1000))
+            pipe.incr(self._key(key))
+            return pipe.execute()[-1]
+
+    def expire(self, key, ttl):
+        self._redis.pexpire(self._key(key), int(ttl * 1000))
+
+    def rpush(self, key, values, ttl=None):
+        if not values:
+            return
+        with self._redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(self._key(key), *values)
+            if ttl is not None:
+                pipe.pexpire(self._key(key), int(ttl * 1000))
+            pipe.execute()
+
+    def lrange(self, key):
+        return self._redis.lrange(self._key(key), 0, -1)
+
+    def sadd(self, key, member):
+        self._redis.sadd(self._key(key), str(member))
+
+    def srem(self, key, member):
+        self._redis.srem(self._key(key), str(member))
+
+    def smembers(self, key):
+        return set(self._redis.smembers(self._key(key)))
+
+    def close(self):
+        self._redis.close()
+
+
+_state_store = None
+_state_store_lock = threading.Lock()
+
+
+def get_state_store() -> StateStore:
+    """The store selected with STATE_BACKEND, shared by everything in the process."""
+    global _state_store
+    with _state_store_lock:
+        if _state_store is None:
+            if STATE_BACKEND == "memory":
+                _state_store = MemoryStateStore()
+            elif STATE_BACKEND == "redis":
+                _state_store = RedisStateStore()
+            else:
+                raise ValueError(f"Unknown STATE_BACKEND {STATE_BACKEND!r}, expected 'memory' or 'redis'.")
+        return _state_store
@@ -1,5 +1,6 @@
 WELCOME_TEXT = 'Привет! Я бот для AI генерации описания квартир. Что я умею:\n\n - 🔑 Автоматически генерирую продающие описания квартир.\n - 💁‍♂️ Оцениваю текущее описание и даю рекомендации по их исправлению.\n🔑 Для старта работы, напишите мне адрес квартиры. \nНапример: "г. Москва, ул. Победы, 17'
 HELP_TEXT = 'Что я умею:\n' \
 '/generate - Автоматическая генерация продающео описания квартиры\n' \
+'/regenerate - Другой вариант описания последней квартиры\n' \
 '/analyze - Анализ вашего текущего описания квартиры, поиск грамматических, синтаксических ошибок и рекомендации по улучшению.\n' \
 '/help - Подсказка по работе с ботом.\n\n'
\ No newline at end of file
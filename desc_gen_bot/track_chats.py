@@ -1,5 +1,7 @@
+import asyncio
 import logging
 from localdb import append_line_to_file
+from state_store import get_state_store
 from typing import Optional
 from telegram import Chat, ChatMember, ChatMemberUpdated, Update
 from telegram.ext import CallbackContext, ContextTypes
@@ -17,9 +19,10 @@ logger = logging.getLogger(__name__)
 
 async def show_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows which chats the bot is in"""
-    user_ids = ", ".join(str(uid) for uid in context.bot_data.setdefault("user_ids", set()))
-    group_ids = ", ".join(str(gid) for gid in context.bot_data.setdefault("group_ids", set()))
-    channel_ids = ", ".join(str(cid) for cid in context.bot_data.setdefault("channel_ids", set()))
+    # Membership is kept in the state store, so every replica sees the same chats
+    user_ids = ", ".join(str(uid) for uid in await asyncio.to_thread(get_state_store().smembers, "chats:user_ids"))
+    group_ids = ", ".join(str(gid) for gid in await asyncio.to_thread(get_state_store().smembers, "chats:group_ids"))
+    channel_ids = ", ".join(str(cid) for cid in await asyncio.to_thread(get_state_store().smembers, "chats:channel_ids"))
     text = (
         f"@{context.bot.username} is currently in a conversation with the user IDs {user_ids}."
         f" Moreover it is a member of the groups with IDs {group_ids} "
@@ -73,28 +76,28 @@ async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             # will add the user to "user_ids".
             # We're including this here for the sake of the example.
             logger.info("{} разблокировал бота", cause_name)
-            context.bot_data.setdefault("user_ids", set()).add(chat.id)
+            await asyncio.to_thread(get_state_store().sadd, "chats:user_ids", chat.id)
         elif was_member and not is_member:
             logger.info("{} заблокировал", cause_name)
-            context.bot_data.setdefault("user_ids", set()).discard(chat.id)
+            await asyncio.to_thread(get_state_store().srem, "chats:user_ids", chat.id)
     elif chat.type in [Chat.GROUP, Chat.SUPERGROUP]:
         if not was_member and is_member:
             msg = "{} добавил бота в группу {}".format(cause_name, chat.title)
             logger.info(msg)
-            context.bot_data.setdefault("group_ids", set()).add(chat.id)
+            await asyncio.to_thread(get_state_store().sadd, "chats:group_ids", chat.id)
             append_line_to_file(f"{LOG_FOLDER}/log.txt", msg)
         elif was_member and not is_member:
             msg = "{} удалил бота из группы {}".format(cause_name, chat.title)
             logger.info(msg)
-            context.bot_data.setdefault("group_ids", set()).discard(chat.id)
+            await asyncio.to_thread(get_state_store().srem, "chats:group_ids", chat.id)
             append_line_to_file(f"{LOG_FOLDER}/log.txt", msg)
     elif not was_member and is_member:
         msg = "{} добавил бота в канал {}".format(cause_name, chat.title)
         logger.info(msg)
-        context.bot_data.setdefault("channel_ids", set()).add(chat.id)
+        await asyncio.to_thread(get_state_store().sadd, "chats:channel_ids", chat.id)
         append_line_to_file(f"{LOG_FOLDER}/log.txt", msg)
     elif was_member and not is_member:
         msg = "{} удалил бота из канала {}".format(cause_name, chat.title)
         logger.info(msg)
-        context.bot_data.setdefault("channel_ids", set()).discard(chat.id)
+        await asyncio.to_thread(get_state_store().srem, "chats:channel_ids", chat.id)
         append_line_to_file(f"{LOG_FOLDER}/log.txt", msg)
@@ -1,34 +1,227 @@
+import os
+import json
+import time
+import base64
+import sqlite3
+import threading
+from collections import OrderedDict
+from state_store import get_state_store
+
+# Conversations idle for longer than this are forgotten
+USER_STEPS_TTL_SECONDS = 24 * 60 * 60
+# At most this many conversations are kept in memory, older ones are reloaded from disk on demand
+USER_STEPS_MAX_IN_MEMORY = 10_000
+# Photos held in memory, only without a store: with one they are read from it when needed
+USER_STEPS_MAX_MEMORY_BYTES = 512 * 1024 * 1024
+# Empty value turns persistence off
+USER_STEPS_DB_PATH = os.environ.get("USER_STEPS_DB_PATH", "data/user_steps.sqlite3")
+
+
 class Steps:
-    def __init__(self, address="", image="",
-                 flat_description="", 
+    __slots__ = (
+        "_address", "_images", "_flat_description", "_options",
+        "_deal_details", "_current_step", "_infra_summary", "_updated_at",
+    )
+
+    def __init__(self, address="", images=None,
+                 flat_description="",
                  options="", deal_details = "",
                  current_step = 0,
                  infra_summary = None,
+                 updated_at = None,
                  ):
         self._address = address
-        self._image = image
+        # Raw photo bytes, in upload order; None when they were left in the store
+        self._images = images if images is not None else []
         self._flat_description = flat_description
         self._options = options
         self._deal_details = deal_details
         self._current_step = current_step
 
         self._infra_summary = infra_summary
+        self._updated_at = updated_at if updated_at is not None else time.time()
 
 
     def get(self):
-        return {
+        return (
             self._address,
-            self._image,
+            self._images,
             self._flat_description,
             self._options,
             self._deal_details,
             self._current_step,
 
             self._infra_summary
-        }
+        )
+
+
+class StepsStore:
+    """SQLite persistence for Steps, so a restart doesn't reset people mid-flow."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS steps ("
+            " user_id INTEGER PRIMARY KEY,"
+            " current_step INTEGER NOT NULL,"
+            " address TEXT NOT NULL,"
+            " flat_description TEXT NOT NULL,"
+            " options TEXT NOT NULL,"
+            " deal_details TEXT NOT NULL,"
+            " infra_summary TEXT,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS step_images ("
+            " user_id INTEGER NOT NULL,"
+            " position INTEGER NOT NULL,"
+            " data BLOB NOT NULL,"
+            " PRIMARY KEY (user_id, position))"
+        )
+
+    def load(self, user_id, with_images=True):
+        """Without `with_images` the photos stay on disk and `_images` is None."""
+        row = self._conn.execute(
+            "SELECT current_step, address, flat_description, options, deal_details, infra_summary, updated_at"
+            " FROM steps WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        steps = Steps(
+            address=row[1], flat_description=row[2], options=row[3], deal_details=row[4],
+            current_step=row[0], infra_summary=json.loads(row[5]) if row[5] is not None else None,
+            updated_at=row[6],
+        )
+        steps._images = self.load_images(user_id) if with_images else None
+        return steps
+
+    def load_images(self, user_id):
+        return [
+            image_row[0] for image_row in self._conn.execute(
+                "SELECT data FROM step_images WHERE user_id = ? ORDER BY position", (user_id,)
+            )
+        ]
+
+    def save(self, user_id, steps, new_images=(), clear_images=False):
+        """Saves the text fields; photos are only added (`new_images`) or all removed (`clear_images`)."""
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO steps"
+                " (user_id, current_step, address, flat_description, options, deal_details, infra_summary, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    user_id, steps._current_step, steps._address, steps._flat_description, steps._options,
+                    steps._deal_details,
+                    json.dumps(steps._infra_summary, ensure_ascii=False) if steps._infra_summary is not None else None,
+                    steps._updated_at,
+                ),
+            )
+            if clear_images:
+                self._conn.execute("DELETE FROM step_images WHERE user_id = ?", (user_id,))
+            if new_images:
+                start = self._conn.execute(
+                    "SELECT COALESCE(MAX(position) + 1, 0) FROM step_images WHERE user_id = ?", (user_id,)
+                ).fetchone()[0]
+                self._conn.executemany(
+                    "INSERT INTO step_images (user_id, position, data) VALUES (?, ?, ?)",
+                    [(user_id, start + offset, image) for offset, image in enumerate(new_images)],
+                )
+
+    def delete(self, user_id):
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM steps WHERE user_id = ?", (user_id,))
+            self._conn.execute("DELETE FROM step_images WHERE user_id = ?", (user_id,))
+
+    def delete_older_than(self, timestamp):
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "DELETE FROM step_images WHERE user_id IN (SELECT user_id FROM steps WHERE updated_at < ?)",
+                (timestamp,),
+            )
+            self._conn.execute("DELETE FROM steps WHERE updated_at < ?", (timestamp,))
+
+
+class KeyValueStepsStore:
+    """Steps kept in a shared StateStore, so every replica sees the same conversation."""
+
+    def __init__(self, state_store, ttl_seconds):
+        self._state_store = state_store
+        self._ttl_seconds = ttl_seconds
+
+    @staticmethod
+    def _key(user_id):
+        return f"user_steps:{user_id}"
+
+    def _images_key(self, user_id):
+        # One list entry per photo, adding a photo doesn't rewrite the others
+        return self._key(user_id) + ":images"
+
+    def load(self, user_id, with_images=True):
+        value = self._state_store.get(self._key(user_id))
+        if value is None:
+            return None
+        data = json.loads(value)
+        steps = Steps(
+            address=data["address"],
+            flat_description=data["flat_description"], options=data["options"], deal_details=data["deal_details"],
+            current_step=data["current_step"], infra_summary=data["infra_summary"], updated_at=data["updated_at"],
+        )
+        steps._images = self.load_images(user_id) if with_images else None
+        return steps
+
+    def load_images(self, user_id):
+        return [base64.b64decode(image) for image in self._state_store.lrange(self._images_key(user_id))]
+
+    def save(self, user_id, steps, new_images=(), clear_images=False):
+        if clear_images:
+            self._state_store.delete(self._images_key(user_id))
+        if new_images:
+            self._state_store.rpush(
+                self._images_key(user_id),
+                [base64.b64encode(image).decode("ascii") for image in new_images],
+                ttl=self._ttl_seconds,
+            )
+        else:
+            # The photos expire together with the rest of the conversation
+            self._state_store.expire(self._images_key(user_id), self._ttl_seconds)
+        self._state_store.set(self._key(user_id), json.dumps({
+            "current_step": steps._current_step,
+            "address": steps._address,
+            "flat_description": steps._flat_description,
+            "options": steps._options,
+            "deal_details": steps._deal_details,
+            "infra_summary": steps._infra_summary,
+            "updated_at": steps._updated_at,
+        }, ensure_ascii=False), ttl=self._ttl_seconds)
+
+    def delete(self, user_id):
+        self._state_store.delete(self._key(user_id))
+        self._state_store.delete(self._images_key(user_id))
+
+    def delete_older_than(self, timestamp):
+        # Keys expire on their own
+        pass
 
 
 class UserSteps:
+    """
+    Conversation state of every user.
+    Idle conversations expire after `ttl_seconds`. Only the `max_in_memory` most recently
+    active ones stay in memory; with a `db_path` the rest live on disk and survive restarts.
+    Photos of conversations in memory count against `max_memory_bytes`.
+    With a store the memory holds no photos, they are only read for get_current_user_data.
+    With a shared state store (STATE_BACKEND=redis) the state lives there instead and
+    nothing is cached in memory, so any replica can continue a conversation.
+    The methods do blocking I/O with a store, call them from a thread in async code.
+    """
     _instance = None
 
     def __new__(cls, *args, **kwargs):
@@ -37,44 +230,166 @@ class UserSteps:
         return cls._instance
 
 
-    def __init__(self):
-        self._user_steps = {}
+    def __init__(self, db_path=USER_STEPS_DB_PATH, ttl_seconds=USER_STEPS_TTL_SECONDS,
+                 max_in_memory=USER_STEPS_MAX_IN_MEMORY, max_memory_bytes=USER_STEPS_MAX_MEMORY_BYTES,
+                 state_store=None):
+        # The singleton is set up only once, later UserSteps() calls return it as is
+        if getattr(self, "_initialized", False):
+            return
+        self._initialized = True
+        self._user_steps = OrderedDict()
+        # Bytes of photos held by every conversation in memory
+        self._image_sizes = {}
+        self._memory_bytes = 0
+        self._max_memory_bytes = max_memory_bytes
+        self._ttl_seconds = ttl_seconds
+        state_store = state_store or get_state_store()
+        if state_store.shared:
+            self._max_in_memory = 0
+            self._store = KeyValueStepsStore(state_store, ttl_seconds)
+        else:
+            self._max_in_memory = max_in_memory
+            self._store = StepsStore(db_path) if db_path else None
+        self._lock = threading.RLock()
+        self._last_cleanup = 0.0
+
+    def _is_expired(self, steps):
+        return time.time() - steps._updated_at > self._ttl_seconds
+
+    def _get(self, user_id, with_images=False):
+        with self._lock:
+            self._cleanup()
+            steps = self._user_steps.get(user_id)
+            if steps is not None:
+                self._user_steps.move_to_end(user_id)
+            elif self._store is not None:
+                steps = self._store.load(user_id, with_images=False)
+                if steps is not None:
+                    self._remember(user_id, steps)
+            if steps is not None and self._is_expired(steps):
+                self._forget(user_id)
+                return None
+            if steps is not None and with_images and steps._images is None:
+                # A copy with the photos, the one in memory stays without them
+                steps = Steps(
+                    address=steps._address, images=self._store.load_images(user_id),
+                    flat_description=steps._flat_description, options=steps._options,
+                    deal_details=steps._deal_details, current_step=steps._current_step,
+                    infra_summary=steps._infra_summary, updated_at=steps._updated_at,
+                )
+            return steps
+
+    def _remember(self, user_id, steps):
+        if self._store is not None:
+            # The store has the photos
+            steps._images = None
+        size = sum(len(image) for image in steps._images) if steps._images is not None else 0
+        self._memory_bytes += size - self._image_sizes.get(user_id, 0)
+        self._image_sizes[user_id] = size
+        self._user_steps[user_id] = steps
+        self._user_steps.move_to_end(user_id)
+        # Least recently active conversations leave memory, the store still has them.
+        # The current one stays even when its photos alone are over the limit
+        while len(self._user_steps) > self._max_in_memory or (
+            len(self._user_steps) > 1 and self._memory_bytes > self._max_memory_bytes
+        ):
+            self._drop(next(iter(self._user_steps)))
+
+    def _drop(self, user_id):
+        """Removes a conversation from memory only."""
+        self._user_steps.pop(user_id, None)
+        self._memory_bytes -= self._image_sizes.pop(user_id, 0)
+
+    def _forget(self, user_id):
+        self._drop(user_id)
+        if self._store is not None:
+            self._store.delete(user_id)
+
+    def _cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        expired = [user_id for user_id, steps in self._user_steps.items() if self._is_expired(steps)]
+        for user_id in expired:
+            self._drop(user_id)
+        if self._store is not None:
+            self._store.delete_older_than(now - self._ttl_seconds)
+
+    def _save(self, user_id, steps, new_images=(), clear_images=False):
+        steps._updated_at = time.time()
+        self._remember(user_id, steps)
+        if self._store is not None:
+            self._store.save(user_id, steps, new_images, clear_images)
 
     def get_current_user_step(self, user_id):
-        return self._user_steps.get(user_id)._current_step if self._user_steps.get(user_id) is not None else 0
+        steps = self._get(user_id)
+        return steps._current_step if steps is not None else 0
 
     def get_current_user_data(self, user_id):
-        return self._user_steps.get(user_id) if self._user_steps.get(user_id) is not None else {}
+        steps = self._get(user_id, with_images=True)
+        return steps if steps is not None else {}
 
 
     def update_user_data(self, user_id, address = None, image = None,
                          flat_description = None, options = None, deal_details = None,
-                         infra_summary = None,
+                         infra_summary = None, images = None,
                          ):
-        user_data = self._user_steps.get(user_id)
-        if user_data is None:
-            user_data = Steps()
-
-        if address != None:
-            user_data._address = address
-        if image != None:
-            user_data._image = image
-        if flat_description != None:
-            user_data._flat_description = flat_description
-        if options != None:
-            user_data._options = options
-        if deal_details != None:
-            user_data._deal_details = deal_details
-        if infra_summary != None:
-            user_data._infra_summary = infra_summary
+        """Updates the given fields. `image` (raw bytes of a photo) and `images` are added to the stored photos."""
+        with self._lock:
+            user_data = self._get(user_id)
+            if user_data is None:
+                user_data = Steps()
+
+            if address != None:
+                user_data._address = address
+            new_images = []
+            if image != None:
+                new_images.append(bytes(image))
+            if images != None:
+                new_images.extend(bytes(item) for item in images)
+            # Not loaded with a shared store, the photos are only appended there
+            if user_data._images is not None:
+                user_data._images.extend(new_images)
+            if flat_description != None:
+                user_data._flat_description = flat_description
+            if options != None:
+                user_data._options = options
+            if deal_details != None:
+                user_data._deal_details = deal_details
+            if infra_summary != None:
+                user_data._infra_summary = infra_summary
 
-        self._user_steps[user_id] = user_data
+            self._save(user_id, user_data, new_images=new_images)
+
+    def start_listing(self, user_id, address, infra_summary):
+        """Replaces the data of the previous listing, photos included, with a new one at step 0."""
+        with self._lock:
+            self._save(user_id, Steps(address=address, infra_summary=infra_summary), clear_images=True)
+
+    def set_infra_summary(self, user_id, address, infra_summary):
+        """Stores the infrastructure looked up for `address`, unless the user has moved on to another listing."""
+        with self._lock:
+            user_data = self._get(user_id)
+            if user_data is None or user_data._address != address:
+                return
+            user_data._infra_summary = infra_summary
+            self._save(user_id, user_data)
 
     def increment_user_step(self, user_id):
-        if self._user_steps[user_id]._current_step is None:
-            self._user_steps[user_id]._current_step = 1
-        else:
-            self._user_steps[user_id]._current_step += 1
+        with self._lock:
+            user_data = self._get(user_id)
+            if user_data is None:
+                user_data = Steps()
+
+            if user_data._current_step is None:
+                user_data._current_step = 1
+            else:
+                user_data._current_step += 1
+
+            if user_data._current_step > 4:
+                # The flow is over, the next message starts a new listing.
+                # Until then the data is kept, the description can be generated again
+                user_data._current_step = 0
 
-        if self._user_steps[user_id]._current_step > 4:
-            self._user_steps[user_id]._current_step = 0
\ No newline at end of file
+            self._save(user_id, user_data)
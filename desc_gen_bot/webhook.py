@@ -0,0 +1,157 @@
+import os
+import re
+import hmac
+import json
+import signal
+import asyncio
+import logging
+from typing import NamedTuple, Optional, Sequence
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# "polling" (default) or "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+HEALTH_PATH = "healthz"
+# Telegram keeps at most this many simultaneous connections to the webhook
+WEBHOOK_MAX_CONNECTIONS = 40
+# Off by default: during a rolling restart the old instance stops after the new one has set
+# the webhook, deleting it then would leave the bot without updates
+WEBHOOK_DELETE_ON_SHUTDOWN = False
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Telegram accepts 1-256 characters A-Z, a-z, 0-9, _ and -
+SECRET_TOKEN_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+
+
+class WebhookConfig(NamedTuple):
+    url: str
+    secret_token: str
+    listen: str = WEBHOOK_LISTEN
+    port: int = WEBHOOK_PORT
+    path: str = WEBHOOK_PATH
+    health_path: str = HEALTH_PATH
+    max_connections: int = WEBHOOK_MAX_CONNECTIONS
+    # With several instances behind one token, only the last one to stop should remove the webhook
+    delete_on_shutdown: bool = WEBHOOK_DELETE_ON_SHUTDOWN
+
+    @classmethod
+    def from_env(cls) -> "WebhookConfig":
+        """
+        Reads WEBHOOK_URL (public base URL, e.g. https://bot.example.com), WEBHOOK_SECRET,
+        and optionally WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_MAX_CONNECTIONS
+        and WEBHOOK_DELETE_ON_SHUTDOWN.
+        """
+        url = os.environ.get("WEBHOOK_URL")
+        secret_token = os.environ.get("WEBHOOK_SECRET")
+        if not url:
+            raise ValueError("WEBHOOK_URL is required in webhook mode.")
+        if not secret_token or not SECRET_TOKEN_PATTERN.match(secret_token):
+            raise ValueError("WEBHOOK_SECRET is required in webhook mode: 1-256 characters A-Z, a-z, 0-9, _ or -.")
+        return cls(
+            url=url,
+            secret_token=secret_token,
+            listen=os.environ.get("WEBHOOK_LISTEN", WEBHOOK_LISTEN),
+            port=int(os.environ.get("WEBHOOK_PORT", WEBHOOK_PORT)),
+            path=os.environ.get("WEBHOOK_PATH", WEBHOOK_PATH).strip("/"),
+            max_connections=int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", WEBHOOK_MAX_CONNECTIONS)),
+            delete_on_shutdown=os.environ.get("WEBHOOK_DELETE_ON_SHUTDOWN", "0").lower() in ("1", "true", "yes"),
+        )
+
+    @property
+    def webhook_url(self) -> str:
+        return f"{self.url.rstrip('/')}/{self.path}"
+
+
+def run_application(application: Application, allowed_updates: Optional[Sequence[str]] = None) -> None:
+    """Runs the bot with long polling or a webhook server, depending on BOT_MODE."""
+    if BOT_MODE == "polling":
+        application.run_polling(allowed_updates=allowed_updates)
+    elif BOT_MODE == "webhook":
+        asyncio.run(serve_webhook(application, WebhookConfig.from_env(), allowed_updates))
+    else:
+        raise ValueError(f"Unknown BOT_MODE {BOT_MODE!r}, expected 'polling' or 'webhook'.")
+
+
+def make_web_app(application: Application, config: WebhookConfig):
+    """Tornado app with the update endpoint and a health check."""
+    # Tornado comes with python-telegram-bot[webhooks], polling works without it
+    import tornado.web
+
+    class UpdateHandler(tornado.web.RequestHandler):
+        async def post(self):
+            secret_token = self.request.headers.get(SECRET_TOKEN_HEADER, "")
+            if not hmac.compare_digest(secret_token, config.secret_token):
+                logger.warning("Rejected webhook request with a wrong secret token from %s", self.request.remote_ip)
+                raise tornado.web.HTTPError(403)
+            try:
+                update = Update.de_json(json.loads(self.request.body), application.bot)
+            except (ValueError, TypeError):
+                raise tornado.web.HTTPError(400)
+            # Handlers run in the application, Telegram gets its answer right away
+            await application.update_queue.put(update)
+            self.set_status(200)
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            healthy = application.running
+            self.set_status(200 if healthy else 503)
+            self.write({
+                "status": "ok" if healthy else "unavailable",
+                "pending_updates": application.update_queue.qsize(),
+            })
+
+    return tornado.web.Application([
+        (f"/{config.path}", UpdateHandler),
+        (f"/{config.health_path}", HealthHandler),
+    ])
+
+
+async def serve_webhook(
+    application: Application, config: WebhookConfig, allowed_updates: Optional[Sequence[str]] = None
+) -> None:
+    """
+    Serves updates from Telegram until SIGINT or SIGTERM.
+    Runs the application's post_init/post_shutdown like run_polling() does.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    web_app = make_web_app(application, config)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    server = None
+    try:
+        await application.bot.set_webhook(
+            url=config.webhook_url,
+            secret_token=config.secret_token,
+            allowed_updates=allowed_updates,
+            max_connections=config.max_connections,
+        )
+        await application.start()
+        server = web_app.listen(config.port, address=config.listen, xheaders=True)
+        logger.info("Webhook server is listening on %s:%d/%s", config.listen, config.port, config.path)
+        await stop.wait()
+    finally:
+        if server is not None:
+            server.stop()
+        if config.delete_on_shutdown:
+            try:
+                await application.bot.delete_webhook()
+            except Exception:
+                logger.exception("Could not delete the webhook")
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The bots import their modules by bare name (`from clients.x import ...`, `import state_store`)
+for directory in ("desc_gen_bot", "bot", "benchmarks"):
+    path = os.path.join(ROOT, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture(scope="session")
+def redis_stand_in():
+    from redis_stand_in import RedisStandIn
+
+    with RedisStandIn() as stand_in:
+        yield stand_in
@@ -0,0 +1,50 @@
+from clients.description_cache import description_cache_key, image_digest
+
+
+def key(**overrides):
+    parts = dict(
+        model="gpt-4o-mini",
+        system_prompt="system",
+        address="Москва, ул Тверская, д 6",
+        infrastructure_text="школа: 300 м",
+        user_prompt="3 комнаты, 7 этаж",
+        image_digests=["a" * 64, "b" * 64],
+        image_options=(1536, "JPEG", 80),
+        token_budget=(120000, 5, 3000),
+        max_tokens=1500,
+    )
+    parts.update(overrides)
+    return description_cache_key(**parts)
+
+
+def test_key_is_stable():
+    assert key() == key()
+    # Any iterable of digests, e.g. a generator
+    assert key(image_digests=iter(["a" * 64, "b" * 64])) == key()
+
+
+def test_every_input_changes_the_key():
+    changed = [
+        key(model="gpt-4o"),
+        key(system_prompt="other"),
+        key(address="Москва, ул Тверская, д 7"),
+        key(infrastructure_text="школа: 400 м"),
+        key(user_prompt="2 комнаты"),
+        key(image_digests=["a" * 64]),
+        key(image_digests=["b" * 64, "a" * 64]),
+        key(image_options=(1024, "JPEG", 80)),
+        key(token_budget=(60000, 5, 3000)),
+        key(max_tokens=1000),
+    ]
+    assert len({key(), *changed}) == len(changed) + 1
+
+
+def test_parts_are_not_concatenated():
+    assert key(address="ab", infrastructure_text="c") != key(address="a", infrastructure_text="bc")
+
+
+def test_image_digest_of_bytes_and_file_match(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(b"\xff\xd8 photo")
+    assert image_digest(str(path)) == image_digest(b"\xff\xd8 photo") == image_digest(bytearray(b"\xff\xd8 photo"))
+    assert image_digest(str(tmp_path / "missing.jpg")) == "missing"
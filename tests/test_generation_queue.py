@@ -0,0 +1,124 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import generation_queue
+from generation_queue import FAILED, MAX_ATTEMPTS, RUNNING, GenerationQueue
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(generation_queue, "RETRY_DELAY_SECONDS", 0.05)
+
+
+def statuses(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT status, attempts FROM jobs").fetchall()
+
+
+async def run_until(queue, handler, done, timeout=5):
+    await queue.start(handler)
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+        # Let the worker record the outcome
+        await asyncio.sleep(0.05)
+    finally:
+        await queue.stop()
+
+
+def test_failed_job_is_retried_with_its_extras(tmp_path, fast_retries):
+    path = str(tmp_path / "jobs.sqlite3")
+    calls = []
+
+    async def main():
+        queue = GenerationQueue(path, workers=2)
+        done = asyncio.Event()
+
+        async def handler(job, extras):
+            calls.append((job.attempts, job.payload, extras))
+            if job.attempts == 1:
+                raise RuntimeError("provider is down")
+            done.set()
+
+        job = await queue.enqueue(1, {"user_prompt": "текст"}, extras="photos")
+        assert job.attempts == 0
+        await run_until(queue, handler, done)
+
+    asyncio.run(main())
+    assert calls == [(1, {"user_prompt": "текст"}, "photos"), (2, {"user_prompt": "текст"}, "photos")]
+    # Finished jobs are deleted
+    assert statuses(path) == []
+
+
+def test_job_fails_after_max_attempts(tmp_path, fast_retries):
+    path = str(tmp_path / "jobs.sqlite3")
+    attempts = []
+
+    async def main():
+        queue = GenerationQueue(path, workers=1)
+        done = asyncio.Event()
+
+        async def handler(job, extras):
+            attempts.append(job.attempts)
+            if job.attempts == MAX_ATTEMPTS:
+                done.set()
+            raise RuntimeError("provider is down")
+
+        await queue.enqueue(1, {})
+        await run_until(queue, handler, done)
+
+    asyncio.run(main())
+    assert attempts == list(range(1, MAX_ATTEMPTS + 1))
+    assert statuses(path) == [(FAILED, MAX_ATTEMPTS)]
+
+
+def test_retry_delay_doubles(tmp_path, monkeypatch):
+    monkeypatch.setattr(generation_queue, "RETRY_DELAY_SECONDS", 10)
+    path = str(tmp_path / "jobs.sqlite3")
+
+    async def main():
+        queue = GenerationQueue(path, workers=1)
+        job = await queue.enqueue(1, {})
+        delays = []
+        for _ in range(MAX_ATTEMPTS - 1):
+            claimed = await queue._db(queue._claim_next)
+            assert claimed.id == job.id
+            await queue._db(queue._fail, claimed)
+            delays.append(await queue._db(queue._next_run_delay))
+            # Not claimable before its retry is due
+            assert await queue._db(queue._claim_next) is None
+            await queue._db(queue._conn.execute, "UPDATE jobs SET run_after = 0")
+        await queue.stop()
+        return delays
+
+    delays = asyncio.run(main())
+    assert [round(delay) for delay in delays] == [10 * 2 ** i for i in range(MAX_ATTEMPTS - 1)]
+
+
+def test_unfinished_jobs_are_recovered_on_start(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    handled = []
+
+    async def interrupted():
+        queue = GenerationQueue(path, workers=1)
+        await queue.enqueue(1, {"n": 1})
+        await queue._db(queue._claim_next)
+        await queue.stop()
+
+    async def restarted():
+        queue = GenerationQueue(path, workers=1)
+        assert await queue.pending_count() == 0
+        done = asyncio.Event()
+
+        async def handler(job, extras):
+            handled.append((job.payload, job.attempts, extras))
+            done.set()
+
+        await run_until(queue, handler, done)
+
+    asyncio.run(interrupted())
+    assert statuses(path) == [(RUNNING, 1)]
+    asyncio.run(restarted())
+    # Extras don't survive a restart
+    assert handled == [({"n": 1}, 2, None)]
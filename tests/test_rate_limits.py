@@ -0,0 +1,36 @@
+import json
+
+from rate_limits import RateLimiter
+
+
+def test_counters_survive_a_restart(tmp_path):
+    path = str(tmp_path / "rate_limits" / "snapshot.json")
+    limiter = RateLimiter(snapshot_path=path, snapshot_interval=3600)
+    key = RateLimiter.window_key(1)
+    assert [limiter.increment(key) for _ in range(3)] == [1, 2, 3]
+    limiter.close()
+
+    restarted = RateLimiter(snapshot_path=path, snapshot_interval=3600)
+    assert restarted.get(key) == 3
+    assert restarted.get(RateLimiter.window_key(2)) == 0
+    restarted.close()
+
+
+def test_old_windows_are_dropped(tmp_path):
+    path = tmp_path / "snapshot.json"
+    current = RateLimiter.window_key(1)
+    old = RateLimiter.window_key(1, "2020-01-01")
+    path.write_text(json.dumps({current: 5, old: 7}))
+
+    limiter = RateLimiter(snapshot_path=str(path), snapshot_interval=3600)
+    assert (limiter.get(current), limiter.get(old)) == (5, 0)
+    limiter.close()
+    assert json.loads(path.read_text()) == {current: 5}
+
+
+def test_unreadable_snapshot_starts_empty(tmp_path):
+    path = tmp_path / "snapshot.json"
+    path.write_text("{not json")
+    limiter = RateLimiter(snapshot_path=str(path), snapshot_interval=3600)
+    assert limiter.get(RateLimiter.window_key(1)) == 0
+    limiter.close()
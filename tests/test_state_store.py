@@ -0,0 +1,158 @@
+import time
+import asyncio
+import threading
+import uuid
+
+import pytest
+
+from state_store import MemoryStateStore, RedisStateStore
+from bot_persistence import StateStorePersistence
+from rate_limits import SharedRateLimiter
+from user_steps import UserSteps
+
+
+@pytest.fixture
+def prefix():
+    # Every test gets its own keys on the shared stand-in
+    return f"test:{uuid.uuid4().hex}:"
+
+
+@pytest.fixture
+def redis_store(redis_stand_in, prefix):
+    store = RedisStateStore(redis_stand_in.url, prefix=prefix)
+    yield store
+    store.close()
+
+
+@pytest.fixture(params=["memory", "redis"])
+def any_store(request, redis_stand_in, prefix):
+    if request.param == "memory":
+        yield MemoryStateStore()
+        return
+    store = RedisStateStore(redis_stand_in.url, prefix=prefix)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def fresh_user_steps():
+    """UserSteps is a singleton, every call to the returned factory builds a new one, like another replica."""
+    original = UserSteps._instance
+
+    def build(state_store):
+        UserSteps._instance = None
+        return UserSteps(state_store=state_store)
+
+    yield build
+    UserSteps._instance = original
+
+
+def test_values_expire(any_store):
+    any_store.set("key", "value", ttl=0.1)
+    any_store.set("forever", "value")
+    assert any_store.get("key") == "value"
+    time.sleep(0.15)
+    assert any_store.get("key") is None
+    assert any_store.get("forever") == "value"
+    any_store.delete("forever")
+    assert any_store.get("forever") is None
+
+
+def test_incr_sets_ttl_only_on_creation(any_store):
+    assert any_store.incr("counter", ttl=0.2) == 1
+    time.sleep(0.1)
+    # A later increment must not extend the window
+    assert any_store.incr("counter", ttl=0.2) == 2
+    time.sleep(0.15)
+    assert any_store.incr("counter", ttl=0.2) == 1
+
+
+def test_lists_and_sets(any_store):
+    any_store.rpush("list", ["a", "b"], ttl=10)
+    any_store.rpush("list", ["c"])
+    assert any_store.lrange("list") == ["a", "b", "c"]
+    any_store.expire("list", 0.1)
+    time.sleep(0.15)
+    assert any_store.lrange("list") == []
+
+    any_store.sadd("set", 1)
+    any_store.sadd("set", 2)
+    any_store.srem("set", 1)
+    assert any_store.smembers("set") == {"2"}
+    assert any_store.smembers("missing") == set()
+
+
+def test_persistence_round_trip(redis_stand_in, prefix):
+    async def scenario():
+        writer = StateStorePersistence(RedisStateStore(redis_stand_in.url, prefix=prefix))
+        reader = StateStorePersistence(RedisStateStore(redis_stand_in.url, prefix=prefix))
+
+        await writer.update_user_data(1, {"photo_ids": ["a", "b"], "address": "Москва"})
+        user_data = {"stale": True}
+        await reader.refresh_user_data(1, user_data)
+        assert user_data == {"photo_ids": ["a", "b"], "address": "Москва"}
+
+        await writer.update_chat_data(5, {"count": 3})
+        chat_data = {}
+        await reader.refresh_chat_data(5, chat_data)
+        assert chat_data == {"count": 3}
+
+        await writer.update_conversation("description", (5, 1), 2)
+        assert await reader.load_conversation("description", (5, 1)) == 2
+        await writer.update_conversation("description", (5, 1), None)
+        assert await reader.load_conversation("description", (5, 1)) is None
+
+        await writer.drop_user_data(1)
+        await reader.refresh_user_data(1, user_data)
+        assert user_data == {}
+
+    asyncio.run(scenario())
+
+
+def test_user_steps_are_shared_between_replicas(redis_stand_in, prefix, fresh_user_steps):
+    first = fresh_user_steps(RedisStateStore(redis_stand_in.url, prefix=prefix))
+    second = fresh_user_steps(RedisStateStore(redis_stand_in.url, prefix=prefix))
+    # Nothing is cached with a shared store, or the replicas would see stale steps
+    assert first._max_in_memory == 0 and second._max_in_memory == 0
+
+    first.start_listing(7, "Москва, Тверская 1", {"metro": []})
+    first.increment_user_step(7)
+    second.update_user_data(7, images=[b"photo-1"])
+    first.update_user_data(7, image=b"photo-2")
+    second.increment_user_step(7)
+
+    assert first.get_current_user_step(7) == 2
+    data = second.get_current_user_data(7)
+    assert data._address == "Москва, Тверская 1"
+    assert data._infra_summary == {"metro": []}
+    assert data._images == [b"photo-1", b"photo-2"]
+    assert len(first._user_steps) == 0 and len(second._user_steps) == 0
+
+    # A new listing drops the photos of the previous one
+    second.start_listing(7, "Москва, Арбат 2", {})
+    assert first.get_current_user_data(7)._images == []
+
+
+def test_shared_rate_limiter_counts_across_instances(redis_stand_in, prefix):
+    limiters = [
+        SharedRateLimiter(RedisStateStore(redis_stand_in.url, prefix=prefix), window_ttl=60) for _ in range(2)
+    ]
+    counts = []
+    lock = threading.Lock()
+
+    def hammer(limiter):
+        for _ in range(25):
+            count = limiter.increment("rate_limits/1_2026-01-01")
+            with lock:
+                counts.append(count)
+
+    threads = [threading.Thread(target=hammer, args=(limiter,)) for limiter in limiters for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every increment got its own count, none were lost between the replicas
+    assert sorted(counts) == list(range(1, 101))
+    assert limiters[0].get("rate_limits/1_2026-01-01") == 100
+    assert limiters[1].get("rate_limits/2_2026-01-01") == 0
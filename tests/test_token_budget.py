@@ -0,0 +1,106 @@
+import io
+
+import pytest
+from PIL import Image
+
+from clients.image_preprocessing import PreparedImage
+from clients.token_budget import (
+    DEFAULT_IMAGE_TILES,
+    IMAGE_BASE_TOKENS,
+    IMAGE_TILE_TOKENS,
+    TokenBudget,
+    image_tokens,
+    plan_request,
+    trim_places,
+)
+
+
+def jpeg(width, height, detail="high"):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), "white").save(output, format="JPEG")
+    return PreparedImage(output.getvalue(), "image/jpeg", detail)
+
+
+@pytest.mark.parametrize("size, tiles", [
+    ((512, 512), 1),
+    # Scaled to 768 x 768
+    ((1024, 1024), 4),
+    # Scaled to 1024 x 2048, then to 768 x 1536
+    ((2048, 4096), 6),
+])
+def test_image_tokens_follow_the_tiling(size, tiles):
+    assert image_tokens(jpeg(*size)) == IMAGE_BASE_TOKENS + tiles * IMAGE_TILE_TOKENS
+
+
+def test_image_tokens_of_low_detail_and_unreadable_images():
+    assert image_tokens(jpeg(2048, 2048, detail="low")) == IMAGE_BASE_TOKENS
+    unreadable = PreparedImage(b"not an image", "image/jpeg", "auto")
+    assert image_tokens(unreadable) == IMAGE_BASE_TOKENS + DEFAULT_IMAGE_TILES * IMAGE_TILE_TOKENS
+
+
+def test_trim_places_keeps_the_nearest_branch_of_each_chain():
+    summary = {
+        "магазины": [
+            {"name": "Пятёрочка", "distance": 100},
+            {"name": "«Пятерочка»", "distance": 150},
+            {"name": "Магнит", "distance": 200},
+            {"name": "ВкусВилл", "distance": 300},
+        ],
+        "школы": [],
+    }
+    trimmed = trim_places(summary, 2)
+    assert [place["distance"] for place in trimmed["магазины"]] == [100, 200]
+    assert trimmed["школы"] == []
+
+
+SUMMARY = {
+    category: [{"name": f"{category} {i}", "distance": 100 * i} for i in range(1, 6)]
+    for category in ("школы", "аптеки", "парки")
+}
+
+
+def build_content(summary):
+    lines = [f"{place['name']}: {place['distance']} м" for places in summary.values() for place in places]
+    return [{"type": "text", "text": "\n".join(lines)}, {"type": "image_url"}]
+
+
+def plan(input_tokens, images=(), places_per_category=5):
+    return plan_request(TokenBudget(input_tokens, places_per_category), "system prompt", SUMMARY, list(images), build_content)
+
+
+def text_tokens(places_per_category):
+    """Tokens of the request without photos."""
+    return plan(10 ** 6, places_per_category=places_per_category).input_tokens
+
+
+def test_everything_fits_a_large_budget():
+    images = [jpeg(1024, 1024)] * 3
+    result = plan(10 ** 6, images)
+    assert result.images == images
+    assert result.infrastructure_summary == SUMMARY
+    assert (result.dropped_places, result.downgraded_images, result.dropped_images) == (0, 0, 0)
+    assert result.input_tokens == text_tokens(5) + 3 * image_tokens(images[0])
+
+
+def test_photos_are_downgraded_from_the_end_first():
+    high = image_tokens(jpeg(1024, 1024))
+    result = plan(text_tokens(1) + high + 2 * IMAGE_BASE_TOKENS, [jpeg(1024, 1024)] * 3)
+    assert [image.detail for image in result.images] == ["high", "low", "low"]
+    assert (result.downgraded_images, result.dropped_images) == (2, 0)
+    assert result.input_tokens <= text_tokens(1) + high + 2 * IMAGE_BASE_TOKENS
+
+
+def test_photos_are_dropped_down_to_one():
+    result = plan(text_tokens(1) + IMAGE_BASE_TOKENS, [jpeg(1024, 1024)] * 3)
+    assert [image.detail for image in result.images] == ["low"]
+    assert (result.downgraded_images, result.dropped_images) == (3, 2)
+
+
+def test_places_are_trimmed_to_fit():
+    result = plan(text_tokens(2))
+    assert all(len(places) == 2 for places in result.infrastructure_summary.values())
+    assert result.dropped_places == 9
+    # Even when nothing fits, one place per category and one photo stay
+    result = plan(1, [jpeg(1024, 1024)] * 2)
+    assert all(len(places) == 1 for places in result.infrastructure_summary.values())
+    assert len(result.images) == 1
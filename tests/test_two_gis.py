@@ -0,0 +1,45 @@
+import pytest
+
+from clients.geocode_cache import normalize_address
+from clients.places_cache import geohash_bounds, geohash_encode
+from clients.two_gis_client import TwoGisClient
+
+
+def test_geohash_matches_the_reference_encoding():
+    assert geohash_encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+
+
+@pytest.mark.parametrize("lat, lon", [(55.7575, 37.6136), (-33.8688, 151.2093), (0.0, 0.0)])
+def test_geohash_tile_contains_the_point(lat, lon):
+    lat_min, lat_max, lon_min, lon_max = geohash_bounds(geohash_encode(lat, lon))
+    assert lat_min <= lat < lat_max
+    assert lon_min <= lon < lon_max
+
+
+def test_nearby_points_share_a_tile():
+    tile = geohash_encode(55.75750, 37.61360)
+    assert geohash_encode(55.75755, 37.61365) == tile
+    # About 1 km to the north
+    assert geohash_encode(55.7665, 37.6136) != tile
+
+
+@pytest.mark.parametrize("address", [
+    "Москва, Улица  Тверская, дом 6",
+    "москва, ул. тверская, д. 6",
+    "МОСКВА ,ул.Тверская,д.6",
+])
+def test_normalize_address(address):
+    assert normalize_address(address) == "москва, ул тверская, д 6"
+
+
+def test_normalize_address_folds_yo_and_abbreviations():
+    assert normalize_address("Королёв, проспект Космонавтов, 1") == normalize_address("королев, пр-кт космонавтов, 1")
+
+
+def test_routing_chunks_leave_a_slot_for_the_origin():
+    client = TwoGisClient("key", routing_max_points=4)
+    places = [{"id": str(i)} for i in range(7)]
+    chunks = client._routing_chunks(places)
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+    assert [place for chunk in chunks for place in chunk] == places
+    assert client._routing_chunks([]) == []